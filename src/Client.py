@@ -5,12 +5,14 @@ import random
 from datetime import datetime
 from collections import deque
 from connection.Node import Node, Connection
+from connection.AsyncNode import AsyncNode
 from lib.MessageInfo import MessageInfo
 from lib.Segment import Segment
 import threading
 import os
+import socket
 import time
-from lib.Constant import TIMEOUT_TIME, WINDOW_SIZE, MESSAGES_LIMIT, HEARTBEAT_INTERVAL, MAX_WIDTH
+from lib.Constant import TIMEOUT_TIME, TIMEOUT_HANDSHAKE, WINDOW_SIZE, MESSAGES_LIMIT, HEARTBEAT_INTERVAL, MAX_WIDTH
 
 class Client(Node):
     def __init__(self, username: str, client_ip: str, client_port: int,
@@ -21,18 +23,19 @@ class Client(Node):
         self.server_ip = server_ip
         self.server_port = server_port
 
-        # Sliding window state
-        self.window_base: int = 0
-        self.next_seq_num: int = 0
-        self.window_buffer: dict[int, Segment] = {}  # {seq_num: segment}
-        self.ack_received: set[int] = set()          # ACKed sequence numbers
-        self.send_times: dict[int, float] = {}       # {seq_num: time sent}
-
         # Receiving state
-        self.receive_buffer: dict[int, Segment] = {} # {seq_num: segment}
         self.expected_receive_seq: int = 1000        # Expected seq from server
+        self.last_receive_time: float = time.time()
 
         self.messages = deque(maxlen=MESSAGES_LIMIT)
+        self.updates = 0                        # bumped whenever messages change, the GUI redraws on it
+        # Messages render as they stream in: the last one grows in place
+        # until its text is complete. (connection, message) while it does.
+        self.streaming = True
+        self.partial: tuple[Connection, MessageInfo] | None = None
+
+        self.syn_ack: Segment | None = None     # handed over by the receive loop on a reconnect
+        self.heartbeating = False
 
         # Connect to Server
         self.connect(server_ip, server_port)
@@ -40,159 +43,144 @@ class Client(Node):
         # Start listening for incoming messages
         self._start_message_listener()
 
-    # Three-way Handshake in Client
+    # Three-way Handshake in Client. Connecting again while the connection
+    # is up (e.g. the NAT rebound our address) resumes it in one round trip.
     def connect(self, ip: str, port: int) -> None:
 
         # [Step 1] Send SYN_FLAG
         initial_seq = random.randint(1000, 50000)
+        self.syn_ack = None
         syn_segment = Segment.syn(
             username = self.username,
-            seq_num  = initial_seq
+            seq_num  = initial_seq,
+            options  = self._syn_options((ip, port))
         )
 
         self.send_segment(syn_segment, ip, port)
         print("[>] Sent SYN")
 
-        # [Step 2] Wait for SYN_FLAG and ACK_FLAG
+        # [Step 2] Wait for SYN_FLAG and ACK_FLAG, send SYN again on a timeout
         while True:
             try:
-                segment, _, checksum_valid = self._Node__listen_recv(timeout=5)
+                segment = self._wait_syn_ack(timeout=TIMEOUT_HANDSHAKE)
 
                 # TODO: checksum validation
                 if segment.get_flag().is_syn_ack_flag():
-                    server_seq = segment.get_header()['seqNumber']
-                    server_ack = segment.get_header()['ackNumber']
                     print("[<] Received SYN-ACK")
                     break
+            except socket.timeout as e:
+                print(f"[!] Error waiting for SYN-ACK: {e}")
+                self.send_segment(syn_segment, ip, port)
             except Exception as e:
                 print(f"[!] Error waiting for SYN-ACK: {e}")
                 continue
 
-        #[Step 3] Send ACK
-        ack_segment = Segment.ack(
-            username = self.username,
-            seq_num  = initial_seq + 1,
-            ack_num  = server_seq + 1
-        )
-
-        self.send_segment(ack_segment, ip, port)
-        print("[>] Sent ACK")
-        print("[!] Handshake complete")
-
-        # store connection
-        self.connections[(ip, port)] = Connection(
-            self.ip, 
-            self.port, 
-            ip, 
-            port, 
-            initial_seq + 1, 
-            server_seq + 1
-        )
+        if self._open_connection((ip, port), initial_seq, segment):
+            print("[!] Session resumed")
+        else:
+            #[Step 3] Send ACK
+            ack_segment = Segment.ack(
+                username = self.username,
+                seq_num  = initial_seq + 1,
+                ack_num  = segment.get_seq_number() + 1,
+                options  = self._ack_options(segment)
+            )
 
-        # Start heartbeat thread
-        heartbeat_thread = threading.Thread(target=self.heartbeat, args=(ip, port), daemon=True)
-        heartbeat_thread.start()
+            self.send_segment(ack_segment, ip, port)
+            print("[>] Sent ACK")
+            print("[!] Handshake complete")
+
+        self._start_heartbeat(ip, port)
+
+    def _wait_syn_ack(self, timeout: float) -> Segment:
+        if self._receiver is not None and self._receiver.is_alive():
+            # The receive loop reads the socket, receive() hands it over
+            with self._activity:
+                self._activity.wait_for(lambda: self.syn_ack is not None, timeout)
+                segment, self.syn_ack = self.syn_ack, None
+            if segment is None:
+                raise socket.timeout("timed out")
+            return segment
+        segment, _, _ = self._Node__listen_recv(timeout=timeout)
+        return segment
+
+    def _start_heartbeat(self, ip: str, port: int) -> None:
+        # Heartbeats run off the timer wheel, the first one right away
+        if not self.heartbeating:
+            self.heartbeating = True
+            self._repeat(HEARTBEAT_INTERVAL, lambda: self.heartbeat(ip, port), first=0)
 
     def _start_message_listener(self):
-        def clear_terminal():
-            if os.name == 'nt':
-                os.system('cls')
-            else:
-                os.system('clear')
-
-        # TODO [low]: change to receive method in Node
         def listen_for_messages():
-            last_receive_time = time.time()
-            TIMEOUT_REASSEMBLY = 5.0  # seconds
             while True:
                 try:
-                    segment, addr, checksum_valid = self._Node__listen_recv(timeout=1)
-                    payload = segment.get_data()
-                    # Skip jika ini adalah ACK untuk pesan yang kita kirim
-                    if segment.get_flag().is_ack_flag():
-                        continue
-
-                    # send fin-ack to close connections
-                    if segment.get_flag().is_fin_flag() and not payload:
-                        self.send_segment(Segment.fin_ack(), self.server_ip, self.server_port)
-                        os._exit(0)
-
-                    # Handle pesan data yang masuk
-                    if payload and len(payload) > 0:
-                        seq_num = segment.header.get('seqNumber', 0)
-                        
-                        print(f"[<] Received message segment {seq_num}")
-
-                        self.receive_buffer[seq_num] = segment
-                        ack_segment = Segment.ack(
-                            self.username,
-                            ack_num=seq_num + len(payload.decode())
-                        )
-
-                        self.send_segment(
-                            ack_segment,
-                            self.server_ip,
-                            self.server_port
-                        )
-                        print(f"[>] Sent ACK for message segment {seq_num}")
-
-
-                        if segment.get_flag().is_fin_flag():
-                            print(f"[!] FIN received from {self.server_ip}:{self.server_port}")
-    
-                            # Reconstruct full message
-                            segments = self.receive_buffer
-                            full_message = b''.join(
-                                segments[seq].get_data() for seq in sorted(segments)
-                            )
-
-                            # Print final message
-                            # print(f"[O] Full message from {self.server_ip}:{self.server_port}: {full_message.decode(errors='ignore')}")
-                            self.messages.append(MessageInfo(
-                                segment.get_username(),
-                                datetime.now(),
-                                f"{full_message.decode(errors='ignore')}"
-                            ))
-
-                            clear_terminal()
-                            print("┌" + "─" * (MAX_WIDTH - 2) + "┐")
-                            print(f"│{'CHAT ROOM'.center(MAX_WIDTH - 2)}│")
-                            print("├" + "─" * (MAX_WIDTH - 2) + "┤")
-                            for i, msg in enumerate(self.messages):
-                                print(msg)
-                                if i < len(self.messages) - 1:
-                                    print("│" + " " * (MAX_WIDTH - 2) + "│") 
-                            print("└" + "─" * (MAX_WIDTH - 2) + "┘")
-
-                            self.receive_buffer.clear()
-
-                            if (segment.get_username() == "Server" and 
-                                full_message.decode(errors='ignore').startswith("Server shutting down")):
-                                self.connections.pop((self.server_ip, self.server_port), None)
-
+                    self.poll(1)
                 except Exception as e:
-                    if self.receive_buffer and time.time() - last_receive_time > TIMEOUT_REASSEMBLY:
-                        # If nothing received for timeout, try to reassemble anyway
-                        self.reassemble_and_display()
-                        self.receive_buffer.clear()
                     continue
-        
+
         listener_thread = threading.Thread(target=listen_for_messages)
         listener_thread.daemon = True
         listener_thread.start()
 
-    def reassemble_and_display(self):
-        segments = self.receive_buffer
-        if not segments:
+    def _handle_data_segment(self, segment: Segment):
+        seq_num = segment.get_seq_number()
+        self.last_receive_time = time.time()
+
+        print(f"[<] Received message segment {seq_num}")
+
+        key = (self.server_ip, self.server_port)
+        conn = self.connections.get(key)
+        if conn is None:
             return
-        try:
-            full_message = b''.join(
-                segments[seq].get_data() for seq in sorted(segments)
-            )
-            username = next(iter(segments.values())).get_username()
-            self.messages.append(MessageInfo(username, datetime.now(), full_message.decode(errors='ignore')))
-        except Exception as e:
-            print(f"[!] Failed to reassemble message: {e}")
+        # Cumulative ACK, then the text of every message as far as it is in order
+        received = []
+        for author, text, done in self._accept_text(key, segment):
+            info = self._grow_message(conn, author, text)
+            if done:
+                self.partial = None
+                received.append(info)
+        if not received:
+            return
+        print(f"[!] FIN received from {self.server_ip}:{self.server_port}")
+        self.render_messages()
+
+        if any(info.get_username() == "Server" and info.get_msg().startswith("Server shutting down")
+               for info in received):
+            conn = self.connections.pop(key, None)
+            if conn is not None and conn.ack_deadline is not None:
+                # the server waits for this ACK before it can exit
+                self._send_ack(key, conn)
+
+    def _grow_message(self, conn: Connection, author: str, text: str) -> MessageInfo:
+        # Append to the message being streamed in, or start the next one
+        if self.partial is not None and self.partial[0] is not conn:
+            # The session was resumed, the server sends that message again whole
+            if self.partial[1] in self.messages:
+                self.messages.remove(self.partial[1])
+            self.partial = None
+        if self.partial is None:
+            info = MessageInfo(author, datetime.now(), text)
+            self.messages.append(info)
+            self.partial = (conn, info)
+        else:
+            info = self.partial[1]
+            info.msg += text
+        self.updates += 1
+        return info
+
+    def render_messages(self):
+        if os.name == 'nt':
+            os.system('cls')
+        else:
+            os.system('clear')
+        print("┌" + "─" * (MAX_WIDTH - 2) + "┐")
+        print(f"│{'CHAT ROOM'.center(MAX_WIDTH - 2)}│")
+        print("├" + "─" * (MAX_WIDTH - 2) + "┤")
+        for i, msg in enumerate(self.messages):
+            print(msg)
+            if i < len(self.messages) - 1:
+                print("│" + " " * (MAX_WIDTH - 2) + "│") 
+        print("└" + "─" * (MAX_WIDTH - 2) + "┘")
 
     def send_private_message(self, target_port: int, message: str):
         formatted_message = f"@{target_port}:{message}"
@@ -209,39 +197,59 @@ class Client(Node):
 
     def receive(self, ip_dest: str, port_dest: str, segment: Segment):
         flag = segment.get_flag()
+        payload = segment.get_data()
 
-        # FIN Flag for close connection
-        if flag.is_fin_flag() and not flag.is_ack_flag():
-            # print("[<] FIN received")
-            self.send_segment(Segment.fin_ack(), ip_dest, port_dest)
-            self.connections.pop((ip_dest, port_dest), None)
+        # Answer to a reconnect, connect() is waiting for it
+        if flag.is_syn_ack_flag():
+            self.syn_ack = segment
             return
-        
-        # ACK for close connection
-        elif flag.is_fin_ack_flag():
+
+        # ACK for close connection (data segments carry FIN+ACK too)
+        if flag.is_fin_ack_flag() and not payload:
             # print("[<] FIN-ACK received → link closed")
             self.connections.pop((ip_dest, port_dest), None)
             return
 
+        # Skip jika ini adalah ACK untuk pesan yang kita kirim
+        if flag.is_ack_flag() and not payload:
+            return
+
+        # FIN Flag for close connection, the server is closing us
+        if flag.is_fin_flag() and not payload:
+            # print("[<] FIN received")
+            self.send_segment(Segment.fin_ack(), ip_dest, port_dest)
+            self.connections.pop((ip_dest, port_dest), None)
+            os._exit(0)
+
+        # Handle pesan data yang masuk
+        if payload and len(payload) > 0:
+            self._handle_data_segment(segment)
+
     
-    def heartbeat(self, server_ip, server_port):
-        while True:
-            try:
-                if (server_ip, server_port) not in self.connections:
-                    print("[DEBUG] Connection lost, stopping heartbeat")
-                    break
-                conn = self.connections[(server_ip, server_port)]
-                segment = Segment.psh(
-                    self.username,
-                    seq_num=conn.send_seq,
-                    ack_num=conn.recv_seq
-                )
-
-                self.send_segment(segment, server_ip, server_port)
-            except:
-                print("Failed to send heartbeat.")
-                break
-            time.sleep(HEARTBEAT_INTERVAL)
+    def heartbeat(self, server_ip, server_port) -> bool:
+        # One beat, repeated every HEARTBEAT_INTERVAL until it returns False
+        try:
+            if self.send_heartbeat(server_ip, server_port):
+                return True
+            print("[DEBUG] Connection lost, stopping heartbeat")
+        except:
+            print("Failed to send heartbeat.")
+        self.heartbeating = False
+        return False
+
+    def send_heartbeat(self, server_ip, server_port) -> bool:
+        conn = self.connections.get((server_ip, server_port))
+        if conn is None:
+            return False
+        segment = Segment.psh(
+            self.username,
+            seq_num=conn.send_seq,
+            ack_num=conn.recv_seq,
+            sender_id=conn.local_id
+        )
+
+        self.send_segment(segment, server_ip, server_port)
+        return True
 
 
     def send_command(self, text: str):
@@ -253,6 +261,16 @@ class Client(Node):
         return
 
 
+class AsyncClient(Client, AsyncNode):
+    # Client on the asyncio engine: incoming segments are dispatched to
+    # receive() by the event loop, heartbeats run off its timer wheel
+    def connect(self, ip: str, port: int) -> None:
+        self._run(self.connect_async(ip, port))
+        self._start_heartbeat(ip, port)
+
+    def _start_message_listener(self):
+        return
+
 # Config Argument
 def load_args():
     # parsing argument from CLI
@@ -262,6 +280,7 @@ def load_args():
     arg.add_argument('-si', '--server_ip', type=str, required=True, help='ip to listen on')
     arg.add_argument('-sp', '--server_port', type=int, required=True, help='port to listen on')
     arg.add_argument('-un', '--username', type=str, default='User', help='username of the client')
+    arg.add_argument('-a', '--asyncio', action='store_true', help='run on the asyncio engine')
     args = arg.parse_args()
     return args
 
@@ -271,11 +290,12 @@ if __name__ == '__main__':
     if args.username.lower() == "server":
         exit()
         
-    client = Client(username=args.username,
-                    client_ip=args.client_ip,
-                    client_port=None,
-                    server_ip=args.server_ip,
-                    server_port=args.server_port)
+    client_class = AsyncClient if args.asyncio else Client
+    client = client_class(username=args.username,
+                          client_ip=args.client_ip,
+                          client_port=None,
+                          server_ip=args.server_ip,
+                          server_port=args.server_port)
 
     print(f"Connected to {client.server_ip} {client.server_port} chat room ()" )
     
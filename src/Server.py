@@ -1,60 +1,98 @@
 import argparse
 from connection.Node import Node, Connection
+from connection.AsyncNode import AsyncNode
+from connection.RoomBus import RoomBus, BUS_RECORDS, BUS_SHUTDOWN, BUS_SHUTDOWN_TIMEOUT
 from lib.Segment import SegmentError, Segment
-from lib.MessageInfo import MessageInfo
-from collections import deque
+from lib.SegmentOption import encode_options, encode_mss, encode_sender_id, decode_sender_id, encode_resume, decode_resume, encode_compress, OPTION_MSS, OPTION_SENDER_ID, OPTION_RESUME, OPTION_COMPRESS, RESUME_TOKEN_SIZE
+from lib.Compression import DICTIONARY_ID
+from lib.SynCookie import SynCookies
+from lib.SharedRing import SharedRing
+from lib.MessageInfo import MessageInfo, encode_record, decode_records, record_parts
+from lib.HistoryLog import HistoryLog
+from lib.MessageLog import MessageLog
+from lib.EncodedMessage import EncodedMessage
+from weakref import WeakKeyDictionary
 import socket
 import datetime
 import time
-import threading
+import asyncio
+import multiprocessing
+import os
 
 HEARTBEAT_TIMEOUT = 30  # seconds
+HEARTBEAT_CHECK_INTERVAL = 5
+STATUS_INTERVAL = 10
 KILL_PASSWORD = "jarkom"
 import random
+import secrets
 from datetime import datetime
-from lib.Constant import TIMEOUT_LISTEN, MESSAGES_LIMIT
+from lib.Constant import TIMEOUT_LISTEN, MESSAGES_LIMIT, PSH_FLAG, FORMAT_FLAGS, CONGESTION_CONTROL, HISTORY_SYNC_INTERVAL, RESUME_LIFETIME, SYN_BACKLOG, EMOTICONS
+from connection.CongestionControl import CONGESTION_CONTROLS
 from typing import List
 
-EMOTICONS = {
-    ":smile:": "😊",
-    ":sad:": "😢",
-    ":laugh:": "😂",
-    ":grin:": "😁",
-    ":cool:": "😎",
-    ":cry:": "😭",
-    ":sleeping:": "😴",
-    ":heart:": "❤️",
-    ":wink:": "😉",
-    ":angry:": "😠",
-    ":surprise:": "😲",
-    ":thumbsup:": "👍",
-    ":wave:": "👋"
-}
-
 class Server(Node):
-    def __init__(self, ip: str, port: int,  kill_password: str = KILL_PASSWORD):
-        super().__init__("Server", ip, port)
-        self.client_buffers = {}                # {(ip, port): {seq_num: segment}}
-        self.expected_seq = {}                  # {(ip, port): next_expected_seq}
-        self.temp_seqs = {}
+    def __init__(self, ip: str, port: int,  kill_password: str = KILL_PASSWORD, congestion: str = CONGESTION_CONTROL,
+                 history: str | None = None, syn_cookies: str = 'auto', reuse_port: bool = False, bus: RoomBus | None = None):
+        super().__init__("Server", ip, port, reuse_port)
+        self.congestion = congestion
+        self.temp_seqs = {}                     # half-open handshakes, at most SYN_BACKLOG unless syn_cookies is 'off'
+        self.syn_cookies = syn_cookies          # 'on', 'off', or 'auto': once temp_seqs is full
+        self.cookies = SynCookies()
         self.kill_password = kill_password
         self.client_usernames = {}
-
-        self.messages = deque()
+        self.next_sender_id = 0                 # last compact-header id handed out, 0 is the server
+        self.resumable = {}                     # {token: {'key', 'conn', 'username', 'left'}}, live or dropped
+
+        # Bounded in-memory history, clients hold a cursor into it. The
+        # optional on-disk history keeps everything: ids carry on from what
+        # it holds, and clients behind the in-memory log are replayed from it
+        self.history = HistoryLog(history) if history else None
+        self.messages = MessageLog(start_id=len(self.history) if self.history else 0)
+        # Resumable sessions of the last run, {token: cursor}: a client that
+        # comes back with one gets a new connection but carries on from its
+        # cursor, so it is replayed what it missed. By address while the
+        # handshake is under way.
+        self.restored = self.history.load_sessions() if self.history is not None else {}
+        self.rejoining = {}
+        self.encoded_messages = WeakKeyDictionary()     # {MessageInfo: {(mss, sender id, compressed): EncodedMessage}}, shared by clients
+        self.shutdown_deadline = None           # set once a shutdown is draining
+
+        # Running as one of several workers: the bus carries the room to the
+        # clients the other workers hold
+        self.bus = bus
+        if bus is not None:
+            self._add_reader(bus, self._on_bus)
         
     # Running server and listening to messages
     def run_server(self):
-        threading.Thread(target=self.monitor_heartbeats, daemon=True).start()
+        self._repeat(STATUS_INTERVAL, self.get_client_status)
+        self._start_history()
         listen = True
         while listen:
             try:
-                self.listen(TIMEOUT_LISTEN)
+                self.poll(TIMEOUT_LISTEN)
             except socket.error:
                 continue
+            if self.shutdown_deadline is not None:
+                # Wait for every client to ACK the goodbye and FIN, then exit
+                if not self.connections or time.monotonic() > self.shutdown_deadline:
+                    self.close_history()
+                    exit(0)
 
 
     def connect(self, ip, port):
         return
+
+    def receive_batch(self, batch):
+        # A client can have several heartbeats queued by the time we wake up,
+        # one per batch is enough to refresh it and flush its backlog
+        heartbeats = set()
+        for ip_dest, port_dest, segment in batch:
+            if segment.get_flag_value() & ~FORMAT_FLAGS == PSH_FLAG and not segment.get_data():
+                if (ip_dest, port_dest) in heartbeats:
+                    continue
+                heartbeats.add((ip_dest, port_dest))
+            self.receive(ip_dest, port_dest, segment)
     
 
     def receive(self, ip_dest: str, port_dest: int, segment: Segment) -> None:
@@ -64,13 +102,32 @@ class Server(Node):
             # print(f"[<] Heartbeat received from {ip_dest}:{port_dest}")
     
             conn_key = (ip_dest, port_dest)
-            if (len(self.messages) > 0):
-                length = self.connections[conn_key].get_current_index()
-                for i in range(length, len(self.messages)):
-                    self._send_message(self.messages[i], ip_dest, port_dest)
-                    self.connections[conn_key].increase_index()
-            if conn_key in self.connections:
-                self.connections[conn_key].last_heartbeat = datetime.now()
+            if conn_key not in self.connections:
+                return
+            conn = self.connections[conn_key]
+            cursor = conn.get_current_index()
+            if self.history is not None and cursor < self.messages.first_id():
+                # Older than the in-memory log reaches: straight from disk
+                self._replay_history(conn, cursor, self.messages.first_id())
+                cursor = self.messages.first_id()
+            missed, backlog = self.messages.since(cursor)
+            if missed:
+                # Fell behind further than the log reaches: say so, then
+                # carry on from the oldest message still kept
+                self._queue_encoded(self._encode_message(MessageInfo(
+                    "Server",
+                    datetime.now(),
+                    f"History truncated: {missed} older messages are no longer available"
+                ), conn), ip_dest, port_dest)
+            if conn.local_id is not None and len(backlog) > 1:
+                # Compact connection: the whole backlog goes as one run of records
+                self._queue_encoded(self._encode_records(backlog, conn), ip_dest, port_dest)
+                conn.messages_coalesced += len(backlog) - 1
+            else:
+                for messageInfo in backlog:
+                    self._queue_encoded(self.get_encoded(messageInfo, conn), ip_dest, port_dest)
+            conn.set_current_index(self.messages.next_id)
+            self.connections[conn_key].last_heartbeat = datetime.now()
             return
           
         if flag.is_fin_flag() and not flag.is_ack_flag() and not flag.is_psh_flag():
@@ -91,136 +148,179 @@ class Server(Node):
 
         # SYN_FLAG
         if segment.get_flag().is_syn_flag():
-            client_seq = segment.get_header()['seqNumber']
+            client_seq = segment.get_seq_number()
             # print("[<] Received SYN")
 
             # print("[>] Sending SYN-ACK")
-            # Send: SYN
-            server_seq = random.randint(1000, 50000)
-
-            self.temp_seqs[(ip_dest, port_dest)] = {
-                'server_seq': server_seq,
-                'client_seq': client_seq
-            }
+            # Only what the client offered is answered: an MSS (else it gets
+            # PAYLOAD_SIZE), compact headers (else full ones), compression
+            # and a token to resume the session with. A SYN presenting a token we still
+            # know is answered in one round trip instead.
+            offered = segment.get_options()
+            resume = decode_resume(offered.get(OPTION_RESUME, b""))
+            if resume is not None and self._resume(ip_dest, port_dest, segment, *resume):
+                return
+            if resume is not None and resume[0] in self.restored:
+                self.rejoining[(ip_dest, port_dest)] = self.restored.pop(resume[0])
+            pending = self.temp_seqs.get((ip_dest, port_dest), {})
+            stateless = self._use_syn_cookies(ip_dest, port_dest)
+            mss = self._negotiate_mss(segment)
+            peer_id = None
+            if OPTION_SENDER_ID in offered:
+                # A resent SYN keeps the id it was given
+                peer_id = pending.get('peer_id') or self._new_sender_id()
+            if stateless:
+                # Send: SYN, its seq is the cookie
+                server_seq, mss = self.cookies.make((ip_dest, port_dest), client_seq, mss, peer_id)
+            else:
+                # Send: SYN
+                server_seq = random.randint(1000, 50000)
+
+            reply = {}
+            if OPTION_MSS in offered:
+                reply[OPTION_MSS] = encode_mss(mss if stateless else self.mss)
+            if peer_id is not None:
+                reply[OPTION_SENDER_ID] = encode_sender_id(peer_id)
+            compress = self._negotiate_compress(segment)
+            if compress:
+                reply[OPTION_COMPRESS] = encode_compress(DICTIONARY_ID)
+            token = None
+            if OPTION_RESUME in offered:
+                if stateless:
+                    token = self.cookies.token((ip_dest, port_dest), client_seq, server_seq, RESUME_TOKEN_SIZE)
+                else:
+                    # A resent SYN keeps its token too
+                    token = pending.get('token') or secrets.token_bytes(RESUME_TOKEN_SIZE)
+                reply[OPTION_RESUME] = encode_resume(token, client_seq + 1)
+
+            if not stateless:
+                self.temp_seqs[(ip_dest, port_dest)] = {
+                    'server_seq': server_seq,
+                    'client_seq': client_seq,
+                    'mss': mss,
+                    'peer_id': peer_id,
+                    'compress': compress,
+                    'token': token,
+                    'username': segment.get_username()
+                }
 
             syn_ack = Segment.syn_ack(
                 username = "Server",
                 seq_num = server_seq, 
-                ack_num = client_seq + 1
+                ack_num = client_seq + 1,
+                options = encode_options(reply) if reply else b""
             )
 
             self.send_segment(syn_ack, ip_dest, port_dest)
         
         # ACK_FLAG in handshake
         elif segment.get_flag().is_ack_flag() and not segment.get_flag().is_psh_flag():
-            if not hasattr(segment, 'payload') or not segment.payload:
-                # print("[<] Received final ACK")
-                # print("[!] Handshake complete")
-                # print(f"[!] {ip_dest}:{port_dest} Connected!")
-
-                self.client_usernames[(ip_dest, port_dest)] = segment.get_username()
-                # Add log to messages
-                self.messages.append(MessageInfo(
-                    "Server",
-                    datetime.now(),
-                    f"{segment.get_username()} joined!"
-                ))
-                
-                if (ip_dest, port_dest) not in self.connections:
-                    # Add client ke list of Connections
-                    client_seq = segment.get_header()['seqNumber']
-
-                    server_seq = self.temp_seqs[(ip_dest, port_dest)]['server_seq']
-
-                    self.connections[(ip_dest, port_dest)] = Connection(
-                        self.ip, 
-                        self.port, 
-                        ip_dest, 
-                        port_dest, 
-                        server_seq + 1, 
-                        client_seq + 1,
-                        current_index=len(self.messages) - 1
-                    )
-
-                    # Initialize client buffer
-                    self.client_buffers[(ip_dest, port_dest)] = {}
-                    del self.temp_seqs[(ip_dest, port_dest)]
-        
+            # Only the final ACK of a pending handshake (or one acknowledging
+            # a valid SYN cookie), late data ACKs are ignored
+            self._complete_handshake(ip_dest, port_dest, segment)
+
         else: # kasus kirim pesan (ada payload)
             payload_data = segment.get_data()
             if payload_data and len(payload_data) > 0:
+                if (ip_dest, port_dest) not in self.connections and segment.get_flag().is_ack_flag():
+                    # The final ACK got lost: the client's first data ACKs
+                    # our SYN-ACK just as well (RFC 4987)
+                    self._complete_handshake(ip_dest, port_dest, segment)
                 self._handle_data_segment(ip_dest, port_dest, segment)
             else:
                 print(f"[DEBUG] Received segment with no payload, ignoring")
 
+    def _complete_handshake(self, ip_dest: str, port_dest: int, segment: Segment) -> bool:
+        # Open the connection of the pending handshake (or valid SYN cookie)
+        # the segment ACKs. False if it ACKs neither.
+        pending = self.temp_seqs.pop((ip_dest, port_dest), None)
+        if pending is None and (ip_dest, port_dest) not in self.connections:
+            pending = self._check_syn_cookie(ip_dest, port_dest, segment)
+        if pending is None:
+            return False
+        # print("[<] Received final ACK")
+        # print("[!] Handshake complete")
+        # print(f"[!] {ip_dest}:{port_dest} Connected!")
+
+        # Data standing in for the ACK has no name on a compact header
+        username = segment.get_username() or pending['username'] or f"{ip_dest}:{port_dest}"
+        self.client_usernames[(ip_dest, port_dest)] = username
+        # Add log to messages
+        self.broadcast(MessageInfo(
+            "Server",
+            datetime.now(),
+            f"{username} joined!"
+        ))
+        
+        if (ip_dest, port_dest) not in self.connections:
+            # Add client ke list of Connections
+            # The client's data starts right after its SYN
+            client_seq = pending['client_seq']
+
+            server_seq = pending['server_seq']
+
+            peer_id = pending['peer_id']
+
+            self.connections[(ip_dest, port_dest)] = Connection(
+                self.ip, 
+                self.port, 
+                ip_dest, 
+                port_dest, 
+                server_seq + 1, 
+                client_seq + 1,
+                current_index=self.rejoining.pop((ip_dest, port_dest), max(self.messages.next_id - 1, 0)),
+                congestion=self.congestion,
+                mss=pending['mss'],
+                local_id=None if peer_id is None else 0,
+                peer_id=peer_id,
+                pool=self.reassembly,
+                compress=pending['compress']
+            )
+
+            self._watch_idle((ip_dest, port_dest), HEARTBEAT_TIMEOUT)
+            token = pending['token']
+            if token is not None:
+                conn = self.connections[(ip_dest, port_dest)]
+                conn.token = token
+                self.resumable[token] = {'key': (ip_dest, port_dest), 'conn': conn, 'username': None, 'left': False}
+        return True
+
 
     def _handle_data_segment(self, ip_dest: str, port_dest: int, segment: Segment):
         client_key = (ip_dest, port_dest)
-        seq_num = segment.header.get('seqNumber', 0)
-        payload = segment.get_data().decode()
     
-        # print(f"[<] Received segment seq={seq_num} from {ip_dest}:{port_dest}")
+        # print(f"[<] Received segment seq={segment.get_seq_number()} from {ip_dest}:{port_dest}")
     
         if client_key not in self.connections:
             print(f"[!] Received data from unknown client {ip_dest}:{port_dest}, ignoring")
             return
-        
-        # Initialize buffer for new client
-        if client_key not in self.client_buffers:
-            self.client_buffers[client_key] = {}
-            self.expected_seq[client_key] = 0
-    
-        # Handle duplicate
-        if seq_num in self.client_buffers[client_key]:
-            # print(f"[DEBUG] Duplicate segment {seq_num}, resending ACK")
-            
-            ack_segment = Segment.ack(
-                username = "Server",
-                ack_num  = seq_num + 1
-            )
-
-            self.send_segment(ack_segment, ip_dest, port_dest)
+        peer_id = self.connections[client_key].peer_id
+        if peer_id is not None and segment.get_sender_id() != peer_id:
+            print(f"[!] Dropped segment from {ip_dest}:{port_dest} with sender id {segment.get_sender_id()}, expected {peer_id}")
             return
-    
-        # Buffer the segment
-        self.client_buffers[client_key][seq_num] = segment
-    
-        # Always ACK
-        ack_segment = Segment.ack(
-            username = "Server",
-            ack_num=seq_num + len(payload)
-        )
-        self.send_segment(ack_segment, ip_dest, port_dest)
-        # print(f"[>] Sent ACK for segment {seq_num} (ack={seq_num + 1})")
-    
-        # If this is the final segment (FIN)
-        if segment.get_flag().is_fin_flag():
-            # print(f"[!] FIN received from {ip_dest}:{port_dest}")
-    
-            # Reconstruct full message
-            segments = self.client_buffers[client_key]
-            full_message = b''.join(
-                segments[seq].get_data() for seq in sorted(segments)
-            )
-    
+        
+        # Buffer (out of order too), ACK the next expected seq, and get back
+        # every message the in-order data completes. Whole ones: commands,
+        # the log and the records fanned out all take a message at a time,
+        # so the server leaves self.streaming off.
+        for author, full_message_str, _ in self._accept_text(client_key, segment):
             # Print final message
-            full_message_str = full_message.decode(errors='ignore')
             full_message_str = self.replace_emoticons(full_message_str)
             print(f"[O] Full message from {ip_dest}:{port_dest}: {full_message_str}")
 
-            if self.handle_command(ip_dest, port_dest, segment.get_username(), full_message_str):
-                return
-            
-            self.messages.append(MessageInfo(
-                segment.get_username(),
+            # Names are known from the handshake and !change, compact headers carry none
+            username = self.client_usernames.get(client_key) or author
+            if self.handle_command(ip_dest, port_dest, username, full_message_str):
+                if client_key not in self.connections:
+                    return
+                continue
+
+            self.broadcast(MessageInfo(
+                username,
                 datetime.now(),
                 full_message_str
             ))
 
-            # Clean up
-            if client_key in self.client_buffers:
-                del self.client_buffers[client_key]
-
 
     def handle_command(self, ip_dest: str, port_dest: int, username: str, message: str) -> bool:
         client_key = (ip_dest, port_dest)
@@ -233,21 +333,10 @@ class Server(Node):
             password = message[6:].strip()
             
             if password == self.kill_password:
-                shutdown_message = MessageInfo(
-                    "Server",
-                    datetime.now(),
-                    f"Server shutting down by {username}"
-                )
-                
-                for client_key in list(self.connections.keys()):
-                    try:
-                        self._send_message(shutdown_message, client_key[0], client_key[1])
-                    except:
-                        pass
-                for (ip, port) in list(self.connections.keys()):
-                    self.close_connection(ip, port)
-                print(f"[!] Server shutdown command accepted from {username}")
-                exit(0)
+                if self.bus is not None:
+                    # Unlike a doorbell it cannot be dropped, worth waiting for
+                    self.bus.publish(BUS_SHUTDOWN, username.encode(), timeout=BUS_SHUTDOWN_TIMEOUT)
+                self.shutdown(username)
                 return True
             else:
                 print(f"[!] KILL COMMAND REJECTED! Wrong password from {username}")
@@ -273,7 +362,7 @@ class Server(Node):
                 
                 self.client_usernames[client_key] = new_name
                 
-                self.messages.append(MessageInfo(
+                self.broadcast(MessageInfo(
                     "Server",
                     datetime.now(),
                     f"{old_name} changed name to {new_name}"
@@ -286,38 +375,176 @@ class Server(Node):
             return True
         return False
     
+    def shutdown(self, username: str):
+        shutdown_message = MessageInfo(
+            "Server",
+            datetime.now(),
+            f"Server shutting down by {username}"
+        )
+
+        for client_key, conn in list(self.connections.items()):
+            try:
+                self._queue_encoded(self.get_encoded(shutdown_message, conn), client_key[0], client_key[1])
+            except:
+                pass
+        # Queued behind the goodbye message, run_server exits once they are done
+        for (ip, port) in list(self.connections.keys()):
+            self.close_connection(ip, port)
+        print(f"[!] Server shutdown command accepted from {username}")
+        self.shutdown_deadline = time.monotonic() + TIMEOUT_LISTEN
+
     def replace_emoticons(self, message: str) -> str:
         for text_emoticon, emoji in EMOTICONS.items():
             message = message.replace(text_emoticon, emoji)
         return message
     
-    def broadcast(self, messageInfo: MessageInfo):
-        # print(f"[DEBUG] Broadcasting message to {len(self.connections)} clients: '{message}'")
-        
-        message = messageInfo.get_msg()
-        username = messageInfo.get_username()
-
-        for conn_key, conn in self.connections:
-
+    def get_encoded(self, messageInfo: MessageInfo, conn: Connection) -> EncodedMessage:
+        # Every client with the same MSS, header format and compression gets
+        # the same frames, only seq/ack differ: a message is compressed once
+        by_format = self.encoded_messages.setdefault(messageInfo, {})
+        encoded = by_format.get((conn.mss, conn.local_id, conn.compress))
+        if encoded is None:
+            encoded = self._encode_message(messageInfo, conn)
+            by_format[(conn.mss, conn.local_id, conn.compress)] = encoded
+        return encoded
+
+    def _record_author(self, message: MessageInfo) -> str:
+        # Everything the server sends is relayed, clients need the author
+        return message.get_username()
+
+    def _replay_history(self, conn: Connection, start: int, end: int):
+        # Queue ids [start, end) from the on-disk history. The file holds
+        # them as wire records: a compact connection gets them as they are,
+        # others only need the author pulled out for the header.
+        key = (conn.to_ip, conn.to_port)
+        records = self.history.records(start, end)
+        if conn.local_id is not None:
+            self._queue_encoded(EncodedMessage(self._split_message_to_segments(
+                "", b''.join(records), mss=conn.mss, sender_id=conn.local_id, compress=conn.compress
+            )), *key)
+            conn.messages_coalesced += end - start - 1
+        else:
+            for record in records:
+                author, text = record_parts(record)
+                self._queue_encoded(EncodedMessage(self._split_message_to_segments(author, text, mss=conn.mss, compress=conn.compress)), *key)
+
+    def _start_history(self):
+        if self.history is not None:
+            self._repeat(HISTORY_SYNC_INTERVAL, self._sync_history)
+            # Sessions from before the restart last as long as dropped ones.
+            # Through _repeat: this runs before (or off) the receive thread
+            self._repeat(RESUME_LIFETIME, self._forget_restored)
+
+    def _forget_restored(self) -> bool:
+        self.restored.clear()
+        return False
 
-            segments: List[Segment] = self._split_message_to_segments(
-                username,
-                message,
-                conn.send_seq,
-                conn.recv_seq
-            )
+    def _sync_history(self):
+        # The log made durable, then where every resumable client is up to
+        # in it: a restart replays them from there
+        self.history.sync()
+        sessions = dict(self.restored)
+        for token, session in self.resumable.items():
+            sessions[token] = session['conn'].acked_cursor()
+        self.history.save_sessions(sessions)
+
+    def close_history(self):
+        if self.history is not None:
+            self._sync_history()
+            self.history.close()
+
+    # SYN cookies: under a storm of SYNs (or always, with 'on') the
+    # handshake keeps no state, everything the final ACK needs is in the
+    # SYN-ACK's seq. The client echoes its sender id in that ACK.
+    def _use_syn_cookies(self, ip: str, port: int) -> bool:
+        if self.syn_cookies == 'auto':
+            return (ip, port) not in self.temp_seqs and len(self.temp_seqs) >= SYN_BACKLOG
+        return self.syn_cookies == 'on'
+
+    def _check_syn_cookie(self, ip: str, port: int, ack: Segment) -> dict | None:
+        # What temp_seqs would hold for this handshake, None if the ACK is
+        # not for a cookie of ours. The client's first data stands in for
+        # a lost final ACK: it echoes nothing, but a compact header carries
+        # the sender id and ZIP_FLAG says compression was agreed.
+        if self.syn_cookies == 'off':
+            return None
+        key = (ip, port)
+        client_seq = ack.get_seq_number() - 1
+        server_seq = ack.get_ack_number() - 1
+        echo = ack.get_options().get(OPTION_SENDER_ID)
+        peer_id = decode_sender_id(echo) if echo is not None else ack.get_sender_id()
+        mss = self.cookies.check(key, client_seq, server_seq, peer_id)
+        if mss is None:
+            return None
+        return {
+            'server_seq': server_seq,
+            'client_seq': client_seq,
+            'mss': mss,
+            'peer_id': peer_id,
+            'compress': self._negotiate_compress(ack) or (self.compression and ack.get_flag().is_zip_flag()),
+            'token': self.cookies.token(key, client_seq, server_seq, RESUME_TOKEN_SIZE),
+            'username': ""
+        }
+
+    def _new_sender_id(self) -> int:
+        # Next free compact-header id, 1 to 65535
+        in_use = {conn.peer_id for conn in self.connections.values()}
+        in_use.update(pending['peer_id'] for pending in self.temp_seqs.values())
+        while True:
+            self.next_sender_id = self.next_sender_id % 0xffff + 1
+            if self.next_sender_id not in in_use:
+                return self.next_sender_id
 
-            ip, port = conn_key
-            # print(f"[>] Broadcasting to {ip}:{port}")
-            
+    def broadcast(self, messageInfo: MessageInfo):
+        self._deliver(messageInfo)
+        if self.bus is not None and self.bus.write(encode_record(messageInfo)):
+            # One doorbell for everything broadcast in this loop turn
+            self._schedule(time.monotonic(), self.bus.doorbell)
+
+    def _on_bus(self):
+        # What the other workers broadcast, for the clients on this one
+        for kind, index, payload in self.bus.receive():
+            if kind == BUS_RECORDS:
+                missed, batches = self.bus.read(index, decode_records)
+                if missed:
+                    print(f"[!] Room bus: {missed} messages from worker {index} overwritten before we read them")
+                for messages in batches:
+                    for messageInfo in messages:
+                        self._deliver(messageInfo)
+            elif kind == BUS_SHUTDOWN and self.shutdown_deadline is None:
+                self.shutdown(payload.decode(errors='ignore'))
+
+    def _deliver(self, messageInfo: MessageInfo):
+        # Log the message and queue it for every client that is caught up.
+        # It is split and encoded once, each client only gets its own seq/ack
+        # stamped into the frames when they go out. Clients still behind on
+        # the log get it, in order, from their heartbeat catch-up.
+        index = self.messages.append(messageInfo)
+        if self.history is not None:
+            self.history.append(messageInfo)
+        # print(f"[DEBUG] Broadcasting message to {len(self.connections)} clients: '{messageInfo.get_msg()}'")
+
+        with self._lock:
+            for (ip, port), conn in list(self.connections.items()):
+                if conn.get_current_index() != index or conn.send_window.closing:
+                    continue
+                self._queue_encoded(self.get_encoded(messageInfo, conn), ip, port)
+                conn.increase_index()
 
     def get_client_status(self):
-        print(f"\n[STATUS] Connected clients: {len(self.connections)}")
-        for i, (client_key, conn) in enumerate(self.connections.items(), 1):
+        shard = "" if self.bus is None else f" (worker {self.bus.index})"
+        print(f"\n[STATUS] Connected clients{shard}: {len(self.connections)}, "
+              f"reassembly: {self.reassembly.held} bytes held, {self.reassembly.evicted} evicted")
+        for i, (client_key, conn) in enumerate(list(self.connections.items()), 1):
             ip, port = client_key
-            expected_seq = self.expected_seq.get(client_key, 'Unknown')
-            buffer_size = len(self.client_buffers.get(client_key, {}))
-            print(f"  {i}. {ip}:{port} - Expected seq: {expected_seq}, Buffer: {buffer_size} segments")
+            expected_seq = conn.recv_seq
+            stats = conn.get_stats()
+            srtt = "-" if stats['srtt'] is None else f"{stats['srtt'] * 1000:.1f}ms"
+            print(f"  {i}. {ip}:{port} - Expected seq: {expected_seq}, Buffer: {stats['reassembly']['held']} bytes "
+                  f"({stats['reassembly']['out_of_order']} out of order, {stats['reassembly']['messages_dropped']} messages too big), "
+                  f"MSS: {stats['mss']}, SRTT: {srtt}, RTO: {stats['rto'] * 1000:.0f}ms, Retransmits: {stats['retransmits']} (fast {stats['fast_retransmits']}), "
+                  f"cwnd: {stats['cwnd']:.1f}, ssthresh: {stats['ssthresh']}, ACKs saved: {stats['acks_saved']} (piggybacked {stats['acks_piggybacked']}), "
+                  f"Coalesced: {stats['messages_coalesced']}, Compressed: {'yes' if conn.compress else 'no'}")
 
 
     def list_clients(self):
@@ -327,21 +554,24 @@ class Server(Node):
             print(f"  {i}. {ip}:{port}")
         return list(self.connections.keys())
 
-    # Mornitor heartbeats from all connections
-    def monitor_heartbeats(self):
-        while True:
-            now = datetime.now()
-            to_remove = []
-
-            for key, conn in list(self.connections.items()):
-                if (now - conn.last_heartbeat).total_seconds() > HEARTBEAT_TIMEOUT:
-                    # print(f"[!] Connection {key} timed out (AFK), removing.")
-                    to_remove.append(key)
-
-            for key in to_remove:
-                self.connections.pop(key, None)
+    # Idle timer per connection: a heartbeat only moves last_heartbeat, the
+    # timer looks at it when it fires and goes back to sleep if it moved
+    def _watch_idle(self, key, delay: float):
+        conn = self.connections[key]
+        self._set_timer(conn, 'idle', time.monotonic() + delay, self.evict_if_idle, key)
 
-            time.sleep(5)  # periksa tiap 5 detik
+    def evict_if_idle(self, key):
+        conn = self.connections.get(key)
+        if conn is None:
+            return
+        idle = (datetime.now() - conn.last_heartbeat).total_seconds()
+        if idle > HEARTBEAT_TIMEOUT:
+            # print(f"[!] Connection {key} timed out (AFK), removing.")
+            self._drop_timers(conn)
+            self.connections.pop(key, None)
+            self._park(conn, self.client_usernames.get(key), left=False)
+        else:
+            self._watch_idle(key, HEARTBEAT_TIMEOUT - idle + 0.001)
 
             
     def remove_client(self, ip: str, port: int):
@@ -349,46 +579,194 @@ class Server(Node):
         if key not in self.connections:
             return
         username = self.client_usernames.get(key, "Unknown")
-        self.connections.pop(key, None)
-        self.client_buffers.pop(key, None)
-        self.expected_seq.pop(key, None)
+        conn = self.connections.pop(key)
+        self._drop_timers(conn)
         self.client_usernames.pop(key, None)
         print(f"[!] Client {username} ({ip}:{port}) removed from server.")
         if username != "Unknown":  # Only add if we knew the user
-            self.messages.append(MessageInfo(
+            self._park(conn, username, left=True)
+            self.broadcast(MessageInfo(
                 "Server",
                 datetime.now(),
                 f"{username} left the chat"
             ))
+
+    # Session resumption: every client that asked gets a token in its
+    # SYN-ACK. Once it drops, its connection is kept for RESUME_LIFETIME so
+    # a SYN with that token picks up where it left off.
+    def _park(self, conn: Connection, username: str | None, left: bool):
+        session = self.resumable.get(conn.token)
+        if session is None or session['conn'] is not conn:
+            return
+        session['username'] = username
+        session['left'] = left      # said goodbye, so it is announced when it comes back
+        self._set_timer(conn, 'resume', time.monotonic() + RESUME_LIFETIME, self._forget_session, conn.token)
+
+    def _forget_session(self, token: bytes):
+        session = self.resumable.get(token)
+        if session is not None and self.connections.get(session['key']) is not session['conn']:
+            del self.resumable[token]
+
+    def _resume(self, ip_dest: str, port_dest: int, syn: Segment, token: bytes, recv_seq: int) -> bool:
+        # The SYN says how far into our sequence space the client got, which
+        # gives its cursor back. Username and both sequence spaces carry on
+        # (partly received messages are sent again whole), and the address
+        # it comes from replaces the old one, e.g. after a NAT rebinding.
+        # False falls back to a fresh handshake.
+        session = self.resumable.get(token)
+        if session is None:
+            return False
+        old = session['conn']
+        cursor = old.cursor_at(recv_seq)
+        if cursor is None:
+            return False
+        old_key, key = session['key'], (ip_dest, port_dest)
+        username = session['username']
+        if self.connections.get(old_key) is old:
+            # Still up: the client moved, or its SYN-ACK got lost
+            username = self.client_usernames.pop(old_key, username)
+            self.connections.pop(old_key)
+        self._drop_timers(old)
+        self.temp_seqs.pop(key, None)
+        username = username or syn.get_username()
+
+        offered = syn.get_options()
+        peer_id = None
+        if OPTION_SENDER_ID in offered:
+            in_use = {conn.peer_id for conn in self.connections.values()}
+            peer_id = old.peer_id if old.peer_id is not None and old.peer_id not in in_use else self._new_sender_id()
+        conn = Connection(
+            self.ip,
+            self.port,
+            ip_dest,
+            port_dest,
+            recv_seq,
+            old.recv_seq,
+            current_index=cursor,
+            congestion=self.congestion,
+            mss=self._negotiate_mss(syn),
+            local_id=None if peer_id is None else 0,
+            peer_id=peer_id,
+            pool=self.reassembly,
+            compress=self._negotiate_compress(syn)
+        )
+        conn.token = token
+        self.connections[key] = conn
+        self.client_usernames[key] = username
+        self.resumable[token] = {'key': key, 'conn': conn, 'username': None, 'left': False}
+        self._watch_idle(key, HEARTBEAT_TIMEOUT)
+
+        reply = {OPTION_RESUME: encode_resume(token, conn.recv_seq)}
+        if OPTION_MSS in offered:
+            reply[OPTION_MSS] = encode_mss(self.mss)
+        if peer_id is not None:
+            reply[OPTION_SENDER_ID] = encode_sender_id(peer_id)
+        if conn.compress:
+            reply[OPTION_COMPRESS] = encode_compress(DICTIONARY_ID)
+        self.send_segment(Segment.syn_ack(
+            username = "Server",
+            seq_num = conn.send_seq,
+            ack_num = conn.recv_seq,
+            options = encode_options(reply)
+        ), ip_dest, port_dest)
+        print(f"[!] {username} resumed its session from {ip_dest}:{port_dest}")
+        if session['left']:
+            self.broadcast(MessageInfo(
+                "Server",
+                datetime.now(),
+                f"{username} is back"
+            ))
+        return True
+class AsyncServer(Server, AsyncNode):
+    # Server on the asyncio engine: every client is served from one event
+    # loop, idle eviction and status reports run off the same timer wheel
+    def run_server(self):
+        self._repeat(HEARTBEAT_CHECK_INTERVAL, self._sweep_sessions)
+        self._repeat(STATUS_INTERVAL, self.get_client_status)
+        self._start_history()
+        self._loop_thread.join()
+
+    def shutdown(self, username: str):
+        # Runs on the loop (from receive), so it cannot block: hand off to a task
+        self.loop.create_task(self._shutdown_async(username))
+
+    async def _shutdown_async(self, username: str):
+        shutdown_message = MessageInfo(
+            "Server",
+            datetime.now(),
+            f"Server shutting down by {username}"
+        )
+        await asyncio.gather(
+            *(self.send_encoded_async(self.get_encoded(shutdown_message, conn), ip, port)
+              for (ip, port), conn in list(self.connections.items())),
+            return_exceptions=True
+        )
+        await asyncio.gather(
+            *(self.close_async(ip, port) for (ip, port) in list(self.connections.keys())),
+            return_exceptions=True
+        )
+        print(f"[!] Server shutdown command accepted from {username}")
+        self.close_history()
+        self.stop()
+
 # Config argument
 def load_args():
     # parsing argument from CLI
     arg = argparse.ArgumentParser()
     arg.add_argument('-i', '--ip', type=str, default='localhost', help='ip server')
     arg.add_argument('-p', '--port', type=int, default=1234, help='port server')
+    arg.add_argument('-a', '--asyncio', action='store_true', help='run on the asyncio engine')
+    arg.add_argument('--cc', choices=list(CONGESTION_CONTROLS), default=CONGESTION_CONTROL, help='congestion control for client connections')
+    arg.add_argument('--history', type=str, default=None, help='directory to keep the chat history in, survives restarts')
+    arg.add_argument('--workers', type=int, default=1, help='server processes sharing the port (SO_REUSEPORT), each holds a shard of the clients')
+    arg.add_argument('--syn-cookies', choices=['auto', 'on', 'off'], default='auto', help='answer SYNs statelessly: always, never, or once SYN_BACKLOG handshakes are pending')
     args = arg.parse_args()
     return args
 
-if __name__ == '__main__':
-    args = load_args()
-    server = Server(args.ip, args.port)
-    
-    # Can also be heartbeat
-    def status_thread():
-        import time
-        while True:
-            time.sleep(10)
-            server.get_client_status()
+def serve(args, history: str | None = None, **kwargs):
+    server_class = AsyncServer if args.asyncio else Server
+    server = server_class(args.ip, args.port, congestion=args.cc, history=history, syn_cookies=args.syn_cookies, **kwargs)
 
-    status_monitor = threading.Thread(target=status_thread)
-    status_monitor.daemon = True
-    status_monitor.start()
-    
     try:
         server.run_server()
     except KeyboardInterrupt:
         print("\n[!] Server shutting down...")
         for (ip, port) in list(server.connections.keys()):
             server.close_connection(ip, port)
+        server.close_history()
         print("[!] All connections closed. Exiting.")
-        exit(0)
\ No newline at end of file
+
+def run_worker(index: int, workers: int, bus_name: str, rings: List[str], args):
+    # Every worker keeps the whole room, so each has its own history
+    history = os.path.join(args.history, f"worker-{index}") if args.history else None
+    serve(args, history=history, reuse_port=True, bus=RoomBus(index, workers, bus_name, rings))
+
+def run_workers(args):
+    # One process per core: the kernel spreads clients over the workers by
+    # address, and a client's datagrams always land on the same one
+    bus_name = RoomBus.name()
+    rings = [SharedRing(f"{bus_name}-{index}", create=True) for index in range(args.workers)]
+    workers = [multiprocessing.Process(target=run_worker, args=(index, args.workers, bus_name, [ring.name for ring in rings], args))
+               for index in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        # Ctrl+C reached the workers too, give them time to close their clients
+        for worker in workers:
+            worker.join(TIMEOUT_LISTEN * 2)
+            if worker.is_alive():
+                worker.terminate()
+    finally:
+        for ring in rings:
+            ring.close()
+            ring.unlink()
+
+if __name__ == '__main__':
+    args = load_args()
+    if args.workers > 1:
+        run_workers(args)
+    else:
+        serve(args, history=args.history)
@@ -269,15 +269,16 @@ class ChatGUI:
 
     def update_messages(self):
         """Update chat display with new messages"""
-        last_len = 0
+        last_update = 0
         while self.running:
-            if len(self.client.messages) != last_len:
-                last_len = len(self.client.messages)
+            # Bumped for every new message and every piece of one still streaming in
+            if self.client.updates != last_update:
+                last_update = self.client.updates
 
                 self.chat_display.configure(state='normal')
                 self.chat_display.delete(1.0, tk.END)
 
-                for msg_info in self.client.messages:
+                for msg_info in list(self.client.messages):
                     timestamp = msg_info.time.strftime("%H:%M:%S")
                     username_color = self.get_user_color(msg_info.username)
                     
@@ -0,0 +1,296 @@
+from __future__ import annotations
+
+from connection.Node import Node, ErrHandshake
+from connection.TimerWheel import Timer
+from lib.Segment import Segment, header_size
+from lib.MessageInfo import MessageInfo
+from lib.EncodedMessage import EncodedMessage
+from lib.Constant import TIMEOUT_LISTEN, TIMEOUT_HANDSHAKE
+from typing import Callable, Dict, List, Tuple
+import asyncio
+import random
+import threading
+
+
+class _NodeProtocol(asyncio.DatagramProtocol):
+    # Hands every datagram the event loop reads to the owning AsyncNode
+    def __init__(self, node: AsyncNode) -> None:
+        self.node = node
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]) -> None:
+        self.node._on_datagram(data, addr)
+
+    def error_received(self, exc: Exception) -> None:
+        # e.g. ICMP port unreachable from a peer that went away
+        print(f"[!] Socket error: {exc}")
+
+
+class _Session:
+    # Per-connection coroutine state: the sender task that drives the
+    # connection's SendWindow, and callers waiting for their data to be ACKed
+    def __init__(self) -> None:
+        self.wakeup = asyncio.Event()
+        self.waiters: List[Tuple[int, asyncio.Future]] = []  # (end seq, future)
+        self.task: asyncio.Task | None = None
+
+
+class AsyncNode(Node):
+    # Same protocol as Node, driven by one asyncio event loop instead of
+    # blocking reads. The loop runs in a background thread so the blocking
+    # methods (connect, _send_message, close_connection) keep working as thin
+    # wrappers around their coroutines.
+    def __init__(self, username: str, ip: str, port: int, reuse_port: bool = False) -> None:
+        super().__init__(username, ip, port, reuse_port)
+        self.loop = asyncio.new_event_loop()
+        self._transport: asyncio.DatagramTransport | None = None
+        self._sessions: Dict[Tuple[str, int], _Session] = {}
+        self._handshakes: Dict[Tuple[str, int], asyncio.Future] = {}   # waiting for SYN-ACK
+        self._closing: Dict[Tuple[str, int], asyncio.Future] = {}      # waiting for FIN-ACK
+        self._timer_handle: asyncio.TimerHandle | None = None          # loop callback that runs the wheel
+        self._timer_at: float | None = None
+
+        self._loop_thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self._loop_thread.start()
+        self._run(self._open_endpoint())
+
+    async def _open_endpoint(self) -> None:
+        # Reuse the socket Node already bound
+        self._transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: _NodeProtocol(self), sock=self._Node__socket
+        )
+
+    # -- Loop helpers --
+    def _in_loop(self) -> bool:
+        return threading.get_ident() == self._loop_thread.ident
+
+    def _run(self, coro):
+        # Blocking wrapper: run a coroutine on the loop and wait for its result
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def _spawn(self, coro) -> None:
+        # Fire-and-forget from any thread
+        if self._in_loop():
+            self.loop.create_task(coro)
+        else:
+            asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def stop(self) -> None:
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    # -- Timers --
+    # The wheel is driven by a single loop.call_at, moved earlier whenever
+    # an earlier timer shows up. Only the loop thread touches the wheel.
+    def _schedule(self, when: float, callback: Callable, *args) -> Timer:
+        timer = super()._schedule(when, callback, *args)
+        if self._timer_at is None or when < self._timer_at:
+            self._arm_timers(when)
+        return timer
+
+    def _arm_timers(self, when: float) -> None:
+        if self._timer_handle is not None:
+            self._timer_handle.cancel()
+        self._timer_at = when
+        self._timer_handle = self.loop.call_at(when, self._run_timers)
+
+    def _run_timers(self) -> None:
+        self._timer_handle = self._timer_at = None
+        self.timers.advance(self.loop.time())
+        deadline = self.timers.next_deadline()
+        if deadline is not None and (self._timer_at is None or deadline < self._timer_at):
+            self._arm_timers(deadline)
+
+    def _repeat(self, interval: float, callback: Callable, first: float | None = None) -> None:
+        if self._in_loop():
+            super()._repeat(interval, callback, first)
+        else:
+            self.loop.call_soon_threadsafe(super()._repeat, interval, callback, first)
+
+    def _add_reader(self, fileobj, callback: Callable) -> None:
+        # The loop is the only thread here, no lock to take
+        self.loop.call_soon_threadsafe(self.loop.add_reader, fileobj, callback)
+
+    # -- Receiving --
+    def _on_datagram(self, data: bytes, addr: Tuple[str, int]) -> None:
+        if len(data) < header_size(data):
+            return
+        segment = Segment.wrap(data)
+        if not segment.valid_checksum():
+            print(f"[!] Dropped corrupted segment from {addr} (checksum invalid)")
+            return
+
+        key = (addr[0], addr[1])
+        flag = segment.get_flag()
+
+        # Replies a coroutine is waiting on are consumed here
+        if flag.is_syn_ack_flag():
+            waiter = self._handshakes.get(key)
+            if waiter is not None and not waiter.done():
+                waiter.set_result(segment)
+                return
+        elif flag.is_fin_ack_flag() and not segment.get_data():
+            waiter = self._closing.get(key)
+            if waiter is not None and not waiter.done():
+                waiter.set_result(segment)
+                return
+        elif self._consume_ack(key[0], key[1], segment):
+            return
+
+        try:
+            self.receive(key[0], key[1], segment=segment)
+        except ErrHandshake as e:
+            print(e)
+        except Exception as e:
+            print(f"[!] Error handling segment from {key[0]}:{key[1]}: {e}")
+
+    def listen(self, timeout):
+        # The event loop does the reading, this only waits
+        self._loop_thread.join(timeout)
+
+    # -- Sending --
+    def send_bytes(self, data, ip: str, port: int) -> None:
+        if self._in_loop():
+            # The transport sends right away or buffers a copy, so stamped
+            # frames can be reused as soon as this returns
+            self._transport.sendto(data, (ip, port))
+        else:
+            self.loop.call_soon_threadsafe(self._transport.sendto, bytes(data), (ip, port))
+
+    def _session(self, key: Tuple[str, int]) -> _Session:
+        session = self._sessions.get(key)
+        if session is None:
+            session = _Session()
+            session.task = self.loop.create_task(self._sender(key, session))
+            self._sessions[key] = session
+        return session
+
+    def _drop_session(self, key: Tuple[str, int]) -> None:
+        session = self._sessions.pop(key, None)
+        if session is not None and session.task is not None:
+            session.task.cancel()
+
+    def _sweep_sessions(self) -> None:
+        # Sender tasks of connections removed elsewhere (eviction, remove_client)
+        for key in [key for key in self._sessions if key not in self.connections]:
+            self._drop_session(key)
+
+    def _pump(self, key: Tuple[str, int]) -> None:
+        # The connection's sender task does the sending, just wake it
+        if key in self.connections:
+            self._session(key).wakeup.set()
+
+    async def send_message_async(self, message: MessageInfo, ip: str, port: int) -> None:
+        # Queue the message on the connection's window and wait until it is ACKed
+        await self.send_encoded_async(self._encode_message(message, self.connections[(ip, port)]), ip, port)
+
+    async def send_encoded_async(self, encoded: EncodedMessage, ip: str, port: int) -> None:
+        key = (ip, port)
+        self._queue_encoded(encoded, ip, port)
+        conn = self.connections[key]
+        if not conn.send_window.is_idle():
+            done = self.loop.create_future()
+            self._session(key).waiters.append((conn.send_seq, done))
+            await done
+
+    def _send_message(self, message: MessageInfo, server_ip: str, server_port: int):
+        if self._in_loop():
+            # Called from receive(): queue it, the sender task delivers it
+            Node._send_message(self, message, server_ip, server_port)
+        else:
+            self._run(self.send_message_async(message, server_ip, server_port))
+
+    async def _sender(self, key: Tuple[str, int], session: _Session) -> None:
+        # One task per connection: sends what its window has due, then sleeps
+        # until an ACK, new data or one of its timers wakes it
+        try:
+            while key in self.connections:
+                conn = self.connections[key]
+                window = conn.send_window
+                session.wakeup.clear()
+                now = self.loop.time()
+                self._flush_outbox(conn, now)
+                self._transmit(key, window.poll(now))
+                self._flush_ack(key, conn, now)
+
+                if session.waiters and window.acked_seq is not None:
+                    still_waiting = []
+                    for end, done in session.waiters:
+                        if end <= window.acked_seq or window.is_idle():
+                            if not done.done():
+                                done.set_result(None)
+                        else:
+                            still_waiting.append((end, done))
+                    session.waiters = still_waiting
+
+                # The wheel wakes it for the next retransmit, delayed ACK or outbox flush
+                self._set_timer(conn, 'send', self._deadline(conn), self._pump, key)
+                await session.wakeup.wait()
+        finally:
+            for _, done in session.waiters:
+                if not done.done():
+                    done.cancel()
+
+    # -- Three-way handshake (active open) --
+    async def connect_async(self, ip: str, port: int) -> bool:
+        # True if it resumed the connection we still had (one round trip, no final ACK)
+        key = (ip, port)
+        initial_seq = random.randint(1000, 50000)
+        waiter = self.loop.create_future()
+        self._handshakes[key] = waiter
+
+        try:
+            # [Step 1] Send SYN, again if the SYN-ACK does not show up
+            while True:
+                self.send_segment(Segment.syn(username=self.username, seq_num=initial_seq, options=self._syn_options(key)), ip, port)
+                print("[>] Sent SYN")
+                try:
+                    # [Step 2] Wait for SYN-ACK
+                    syn_ack = await asyncio.wait_for(asyncio.shield(waiter), TIMEOUT_HANDSHAKE)
+                    break
+                except asyncio.TimeoutError:
+                    print("[!] Error waiting for SYN-ACK: timed out")
+        finally:
+            self._handshakes.pop(key, None)
+
+        print("[<] Received SYN-ACK")
+        if self._open_connection(key, initial_seq, syn_ack):
+            print("[!] Session resumed")
+            return True
+
+        # [Step 3] Send ACK
+        self.send_segment(Segment.ack(
+            username = self.username,
+            seq_num  = initial_seq + 1,
+            ack_num  = syn_ack.get_seq_number() + 1,
+            options  = self._ack_options(syn_ack)
+        ), ip, port)
+        print("[>] Sent ACK")
+        print("[!] Handshake complete")
+        return False
+
+    # -- FIN / FIN-ACK teardown --
+    async def close_async(self, ip: str, port: int) -> None:
+        key = (ip, port)
+        conn = self.connections.get(key)
+        if conn is None:
+            return
+        waiter = self.loop.create_future()
+        self._closing[key] = waiter
+        # The sender task sends (and resends) FIN once the window has drained
+        conn.send_window.close()
+        self._pump(key)
+        try:
+            await asyncio.wait_for(waiter, TIMEOUT_LISTEN)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self._closing.pop(key, None)
+        conn = self.connections.pop(key, None)
+        if conn is not None:
+            self._drop_timers(conn)
+        self._drop_session(key)
+
+    def close_connection(self, ip: str, port: int) -> None:
+        if self._in_loop():
+            self.loop.create_task(self.close_async(ip, port))
+        else:
+            self._run(self.close_async(ip, port))
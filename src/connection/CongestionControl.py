@@ -0,0 +1,98 @@
+from typing import Dict, Type
+
+from lib.Constant import WINDOW_SIZE, MAX_CWND, DUPACK_THRESHOLD
+
+
+class CongestionControl:
+    # How many frames a SendWindow may have in flight. The window reports
+    # ACK progress and losses, the algorithm moves cwnd (counted in frames).
+    name = "none"
+
+    def __init__(self) -> None:
+        self.cwnd: float = WINDOW_SIZE
+        self.ssthresh: float | None = None
+
+    def window(self) -> int:
+        return max(1, int(self.cwnd))
+
+    def on_ack(self, acked: int) -> None:
+        # `acked` frames were newly ACKed
+        pass
+
+    def on_timeout(self, flight: int) -> None:
+        # The retransmission timer expired with `flight` frames outstanding
+        pass
+
+    def on_enter_recovery(self, flight: int) -> None:
+        # Fast retransmit after duplicate ACKs, `flight` frames outstanding
+        pass
+
+    def on_dupack(self) -> None:
+        # Another duplicate ACK during fast recovery: one more frame has left the network
+        pass
+
+    def on_exit_recovery(self) -> None:
+        # Everything outstanding at the fast retransmit has been ACKed
+        pass
+
+    def get_stats(self) -> dict:
+        return {
+            'cc': self.name,
+            'cwnd': self.cwnd,
+            'ssthresh': self.ssthresh,
+        }
+
+
+class FixedWindow(CongestionControl):
+    # The old behaviour: always WINDOW_SIZE frames, whatever happens
+    name = "fixed"
+
+    def __init__(self, window_size: int = WINDOW_SIZE) -> None:
+        super().__init__()
+        self.cwnd = window_size
+
+
+class Reno(CongestionControl):
+    # Slow start up to ssthresh, then additive increase of one frame per
+    # window ACKed; a timeout halves ssthresh and restarts from one frame,
+    # duplicate ACKs halve it and continue from there (RFC 5681)
+    name = "reno"
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.ssthresh = MAX_CWND
+
+    def on_ack(self, acked: int) -> None:
+        if self.cwnd < self.ssthresh:
+            self.cwnd += acked
+        else:
+            self.cwnd += acked / self.cwnd
+        self.cwnd = min(self.cwnd, MAX_CWND)
+
+    def on_timeout(self, flight: int) -> None:
+        self.ssthresh = max(flight // 2, 2)
+        self.cwnd = 1
+
+    def on_enter_recovery(self, flight: int) -> None:
+        # The duplicate ACKs so far stand for frames that have left the network
+        self.ssthresh = max(flight // 2, 2)
+        self.cwnd = self.ssthresh + DUPACK_THRESHOLD
+
+    def on_dupack(self) -> None:
+        self.cwnd = min(self.cwnd + 1, MAX_CWND)
+
+    def on_exit_recovery(self) -> None:
+        self.cwnd = self.ssthresh
+
+
+CONGESTION_CONTROLS: Dict[str, Type[CongestionControl]] = {
+    FixedWindow.name: FixedWindow,
+    Reno.name: Reno,
+}
+
+
+def create_congestion_control(name: str) -> CongestionControl:
+    try:
+        return CONGESTION_CONTROLS[name]()
+    except KeyError:
+        raise ValueError(f"Unknown congestion control '{name}', expected one of {', '.join(CONGESTION_CONTROLS)}")
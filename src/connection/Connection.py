@@ -1,9 +1,17 @@
+from collections import deque
 from datetime import datetime
+from connection.SendWindow import SendWindow
+from connection.CongestionControl import create_congestion_control
+from lib.Constant import CONGESTION_CONTROL, PAYLOAD_SIZE
+from lib.MessageStream import MessageStream
+from lib.ReassemblyBuffer import ReassemblyBuffer, ReassemblyPool
 import time
 
 
 class Connection:
-    def __init__(self, from_ip, from_port, to_ip, to_port, send_seq=0, recv_seq=0, current_index = 0):
+    def __init__(self, from_ip, from_port, to_ip, to_port, send_seq=0, recv_seq=0, current_index = 0, congestion: str = CONGESTION_CONTROL, mss: int = PAYLOAD_SIZE,
+                 local_id: int | None = None, peer_id: int | None = None, pool: ReassemblyPool | None = None,
+                 streaming: bool = False, compress: bool = False):
         self.from_ip = from_ip
         self.from_port = from_port
         self.to_ip = to_ip
@@ -11,19 +19,92 @@ class Connection:
 
         self.last_heartbeat = datetime.now()
 
-        self.current_index_message = current_index
+        self.current_index_message = current_index      # id of the next server log message to send
+        # (send seq, cursor) each time the cursor moved, back to the last one
+        # the peer ACKed: maps a seq the peer got up to back to a cursor
+        self.cursor_marks = deque([(send_seq, current_index)])
+        self.token: bytes | None = None                 # session resumption token, see Server
 
         self.send_seq = send_seq
-        self.recv_seq = recv_seq
+        self.reassembly = ReassemblyBuffer(recv_seq, pool=pool, streaming=streaming)     # what the peer sent, by seq
+        self.stream: MessageStream | None = None        # decoding the message being received, see Node._accept_text
 
         self.is_connected = False
 
-        self.send_window = {}
+        self.mss = mss                      # payload per segment, agreed in the handshake
+        # Compact headers, agreed in the handshake: the sender id we put on
+        # our segments and the one the peer puts on its, None = full headers
+        self.local_id = local_id
+        self.peer_id = peer_id
+        self.compress = compress            # payloads may go out deflated, agreed in the handshake
+
+        self.send_window = SendWindow(create_congestion_control(congestion))     # outbound queue + sliding window
+
+        # Receive side: in-order segments waiting for a (delayed) ACK
+        self.unacked_segments = 0
+        self.ack_deadline = None            # monotonic time the delayed ACK is due
+        self.segments_received = 0
+        self.acks_sent = 0
+        self.acks_piggybacked = 0           # delayed ACKs that rode on outgoing data
+        # Send side: messages held back to go out together (compact headers only)
+        self.outbox = []
+        self.outbox_size = 0                # characters of text waiting
+        self.outbox_deadline = None         # monotonic time the outbox goes out regardless
+        self.messages_coalesced = 0         # messages that shared a payload with an earlier one
+        self.timers = {}                    # name -> Timer on the node's wheel ('send', 'idle')
         self.acknowledged = set()
         self.last_activity = time.time()
 
+    def get_stats(self) -> dict:
+        # Round-trip estimate, congestion window and retransmission state of the send side
+        stats = self.send_window.rtt.get_stats()
+        stats.update(self.send_window.congestion.get_stats())
+        stats['retransmits'] = self.send_window.retransmits
+        stats['fast_retransmits'] = self.send_window.fast_retransmits
+        stats['in_flight'] = len(self.send_window.in_flight)
+        stats['mss'] = self.mss
+        stats['messages_coalesced'] = self.messages_coalesced
+        stats['segments_received'] = self.segments_received
+        stats['acks_sent'] = self.acks_sent
+        stats['acks_piggybacked'] = self.acks_piggybacked
+        stats['acks_saved'] = self.segments_received - self.acks_sent
+        stats['reassembly'] = self.reassembly.get_stats()
+        return stats
+
+    @property
+    def recv_seq(self) -> int:
+        # Next seq expected in order, what we ACK
+        return self.reassembly.next_seq
+
     def get_current_index(self):
         return self.current_index_message
     
     def increase_index(self) -> None:
-        self.current_index_message += 1
\ No newline at end of file
+        self.set_current_index(self.current_index_message + 1)
+
+    def set_current_index(self, index: int) -> None:
+        # Called once the messages before `index` are queued
+        self.current_index_message = index
+        self.cursor_marks.append((self.send_seq, index))
+        acked = self.send_window.acked_seq
+        while acked is not None and len(self.cursor_marks) > 1 and self.cursor_marks[1][0] <= acked:
+            self.cursor_marks.popleft()
+
+    def acked_cursor(self) -> int:
+        # The first log message the peer has not ACKed all of
+        acked = self.send_window.acked_seq
+        cursor = self.cursor_at(acked) if acked is not None else None
+        return self.cursor_marks[0][1] if cursor is None else cursor
+
+    def cursor_at(self, recv_seq: int) -> int | None:
+        # The cursor for a peer that got everything before recv_seq: the
+        # first log message it is missing (part of). None if this connection
+        # never sent up to recv_seq, or it lies before what is remembered.
+        if not self.cursor_marks[0][0] <= recv_seq <= self.send_seq:
+            return None
+        cursor = self.cursor_marks[0][1]
+        for end, index in self.cursor_marks:
+            if end > recv_seq:
+                break
+            cursor = index
+        return cursor
\ No newline at end of file
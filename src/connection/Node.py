@@ -1,21 +1,43 @@
 from __future__ import annotations
 
-from lib.Segment import Segment
-from lib.Constant import PAYLOAD_SIZE, WINDOW_SIZE
+from lib.Segment import Segment, MAX_SEGMENT_SIZE, header_size
+from lib.Checksum import verify_batch
+from lib.SegmentOption import encode_options, encode_sack, decode_sack, encode_mss, decode_mss, decode_sender_id, encode_resume, decode_resume, encode_compress, decode_compress, OPTION_SACK, OPTION_MSS, OPTION_SENDER_ID, OPTION_RESUME, OPTION_COMPRESS, MAX_SACK_BLOCKS
+from lib.ReassemblyBuffer import ReassemblyPool
+from lib.Constant import PAYLOAD_SIZE, MSS, MAX_RECV_BATCH, ACK_FLAG, OPT_FLAG, FORMAT_FLAGS, TIMEOUT_ACK, TIMEOUT_LISTEN, CONGESTION_CONTROL, ACK_EVERY, ACK_DELAY, COALESCE_DELAY
 from connection.Connection import Connection
-from lib.MessageInfo import MessageInfo
+from connection.SendWindow import Frame
+from connection.TimerWheel import TimerWheel, Timer
+from lib.EncodedMessage import EncodedMessage
+from lib.MessageInfo import MessageInfo, encode_record
+from lib.MessageStream import MessageStream
+from lib.Compression import deflate, DICTIONARY_ID
 from abc import ABC, abstractmethod
 import socket
-from typing import Dict, List
+from typing import Callable, Dict, Iterator, List, Tuple
+import selectors
+import threading
 import time
 
 class Node(ABC):
-    def __init__(self, username: str, ip: str, port: int) -> None:
+    def __init__(self, username: str, ip: str, port: int, reuse_port: bool = False) -> None:
         self.username = username
         self.ip = ip
         self.port = port
         self.connections: Dict[(str, int), Connection] = {}
+        self.congestion = CONGESTION_CONTROL    # congestion control for new connections
+        self.ack_every = ACK_EVERY              # delayed ACKs: in-order segments per ACK
+        self.mss = MSS                          # payload size offered in the handshake
+        self.coalesce_delay = COALESCE_DELAY    # Nagle-like hold for small messages
+        self.resume_tokens: Dict[Tuple[str, int], bytes] = {}  # session tokens peers gave us
+        self.reassembly = ReassemblyPool()      # caps what every connection's receive side holds
+        self.streaming = False                  # hand messages out in pieces as they arrive, see _accept_text
+        self.compression = True                 # offer (or accept) compressed payloads in the handshake
         self.__socket: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if reuse_port:
+            # Several processes share the port, the kernel hashes each peer
+            # address to one of them
+            self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         if port is None:
             self.__socket.bind(('', 0))  # 0 = auto-assign
             self.port = self.__socket.getsockname()[1]
@@ -23,6 +45,21 @@ class Node(ABC):
             self.__socket.bind((ip, port))
             self.port = port
 
+        # The socket stays non-blocking, waiting for traffic goes through the
+        # selector so a wakeup can drain every queued datagram without settimeout()
+        self.__socket.setblocking(False)
+        self.__selector = selectors.DefaultSelector()
+        self.__selector.register(self.__socket, selectors.EVENT_READ)
+        self.__readers = 0                                  # other files registered, see _add_reader
+
+        # Send windows are driven by whichever thread runs poll() (the receive
+        # loop), other threads only queue into them under this lock
+        self._lock = threading.RLock()
+        self._activity = threading.Condition(self._lock)   # notified after every handled batch
+        self.timers = TimerWheel(time.monotonic())          # every protocol timer, run by poll()
+        self._receiver: threading.Thread | None = None     # thread running the receive loop
+        self._polling = False
+
     @abstractmethod
     def connect(self, ip: str, port: int) -> None:  #implement di anaknya
         raise NotImplementedError
@@ -31,150 +68,443 @@ class Node(ABC):
     def receive(self, ip_dest: str, port_dest: int, segment: Segment):
         raise NotImplementedError
 
-    def _split_message_to_segments(self, username, message: str, seq_num: int = 0, ack_num: int = 0) -> List[Segment]:
-        segments = []
+    def _split_message_to_segments(self, username, message: str | bytes, seq_num: int = 0, ack_num: int = 0, mss: int = PAYLOAD_SIZE,
+                                   sender_id: int | None = None, compress: bool = False) -> Iterator[Segment]:
+        # Encode once and cut the bytes every `mss`, seq counts bytes.
+        # A character may straddle two segments, the receiver decodes the
+        # joined payload. Segments are made one at a time and only view the
+        # encoded message, no chunk is copied until it is framed. With
+        # `compress` (agreed in the handshake) a payload that shrinks goes
+        # out deflated, ZIP_FLAG on each of its segments.
+        payload = message.encode() if isinstance(message, str) else message
+        deflated = deflate(payload) if compress else None
+        payload = memoryview(payload if deflated is None else deflated)
+        zipped = deflated is not None
 
-        for i in range(0, len(message), PAYLOAD_SIZE):
-            chunk = message[i:i + PAYLOAD_SIZE]
+        for i in range(0, len(payload), mss):
+            chunk = payload[i:i + mss]
 
-            # PSH + FIN
-            if i + PAYLOAD_SIZE >= len(message):
-                segment = Segment(username, [True, False, True, False], seq_num, ack_num, chunk.encode(), 0)    
+            # PSH + FIN, ACK is set so the peer can take the piggybacked ack_num
+            if i + mss >= len(payload):
+                yield Segment(username, [True, False, True, True, False, False, zipped], seq_num, ack_num, chunk, 0, b"", sender_id)
             else: # PSH
-                segment = Segment(username, [False, False, True, False], seq_num, ack_num, chunk.encode(), 0)
-            
-            segments.append(segment)
+                yield Segment(username, [False, False, True, True, False, False, zipped], seq_num, ack_num, chunk, 0, b"", sender_id)
+
             seq_num += len(chunk)
 
-        return segments
+    def _accept_data(self, key: Tuple[str, int], segment: Segment) -> List[Tuple[Segment, bytearray, bool]]:
+        # Buffer a data segment and ACK cumulatively: the ACK number is the
+        # next seq expected in order (conn.recv_seq), so a gap shows up at the
+        # sender as duplicate ACKs, and SACK blocks tell it what arrived past
+        # the gap. Returns (segment, payload, final) of every message the
+        # in-order data now completes, see ReassemblyBuffer.insert.
+        #
+        # In-order data is ACKed every `ack_every` segments or after ACK_DELAY,
+        # unless outgoing data carries the ACK first. Anything out of order
+        # (gap, filled gap, duplicate) is ACKed at once.
+        conn = self.connections[key]
+        conn.segments_received += 1
+        seq_num = segment.get_seq_number()
+        payload = segment.get_data()
+        expected = conn.recv_seq + len(payload) if seq_num == conn.recv_seq else None
+        completed = conn.reassembly.insert(seq_num, payload, segment)
+
+        blocks = conn.reassembly.sack_blocks(seq_num)[:MAX_SACK_BLOCKS]
+        if blocks or conn.recv_seq != expected or conn.unacked_segments + 1 >= self.ack_every:
+            self._send_ack(key, conn, blocks)
+        else:
+            conn.unacked_segments += 1
+            if conn.ack_deadline is None:
+                conn.ack_deadline = time.monotonic() + ACK_DELAY
+            self._pump(key)
+        return completed
+
+    def _accept_text(self, key: Tuple[str, int], segment: Segment) -> List[Tuple[str, str, bool]]:
+        # _accept_data, decoded: (author, text, done) for every message or
+        # record in what arrived in order, done once its text is complete.
+        # Streaming, text comes out as soon as it is in order, in as many
+        # pieces as it takes. Otherwise every piece is a whole record.
+        conn = self.connections[key]
+        pieces = []
+        for last, payload, final in self._accept_data(key, segment):
+            if conn.stream is None:
+                # A compact header has no author, the payload carries records.
+                # Held whole, a message is as big as the buffer takes inflated too.
+                conn.stream = MessageStream(None if last.get_sender_id() is not None else last.get_username(),
+                                            compressed=last.get_flag().is_zip_flag(),
+                                            limit=None if conn.reassembly.streaming else conn.reassembly.limit)
+            pieces += conn.stream.feed(payload, final)
+            if final:
+                if conn.stream.too_big:
+                    conn.reassembly.messages_dropped += 1
+                conn.stream = None
+        return pieces
+
+    def _send_ack(self, key: Tuple[str, int], conn: Connection, blocks: List[Tuple[int, int]] = ()) -> None:
+        options = encode_options({OPTION_SACK: encode_sack(blocks)}) if blocks else b""
+        self.send_segment(Segment.ack(self.username, ack_num=conn.recv_seq, options=options, sender_id=conn.local_id), key[0], key[1])
+        conn.acks_sent += 1
+        conn.unacked_segments = 0
+        conn.ack_deadline = None
+
+    def _flush_ack(self, key: Tuple[str, int], conn: Connection, now: float) -> None:
+        # Send the delayed ACK once it is due
+        if conn.ack_deadline is not None and now >= conn.ack_deadline:
+            self._send_ack(key, conn)
+
+    @staticmethod
+    def _deadline(conn: Connection) -> float | None:
+        # Next retransmit, FIN resend, delayed ACK or outbox flush of this connection
+        deadlines = [
+            deadline for deadline in (conn.send_window.next_deadline(), conn.ack_deadline, conn.outbox_deadline)
+            if deadline is not None
+        ]
+        return min(deadlines) if deadlines else None
+
+    # Handles a batch of (ip, port, segment) in arrival order
+    def receive_batch(self, batch: List[Tuple[str, int, Segment]]) -> None:
+        for ip, port, segment in batch:
+            self.receive(ip, port, segment=segment)
 
     def listen(self, timeout):
-        try:
-            segment, address, checksum_valid = self.__listen_recv(timeout)
+        # Wait up to `timeout` for traffic, then handle everything that is queued
+        datagrams = self.__drain_recv(timeout)
+        batch = []
+        for (data, address), checksum_valid in zip(datagrams, verify_batch(data for data, _ in datagrams)):
             if checksum_valid:
-                self.receive(address[0], address[1], segment=segment)
+                batch.append((address[0], address[1], Segment.wrap(data)))
             else:   # invalid checksum
                 print(f"[!] Dropped corrupted segment from {address} (checksum invalid)")
-            
-        except ErrHandshake as e:
-            print(e)
+        with self._lock:
+            batch = [item for item in batch if not self._consume_ack(*item)]
+            try:
+                self.receive_batch(batch)
+            except ErrHandshake as e:
+                print(e)
+            finally:
+                self._activity.notify_all()
 
+    def poll(self, timeout=None):
+        # One turn of the receive loop: wait for traffic or the next
+        # retransmission deadline, handle it, then service the send windows
+        self._receiver = threading.current_thread()
+        self._polling = True
+        try:
+            self.listen(self._next_timeout(timeout))
+        except socket.timeout:
+            pass
+        finally:
+            if self.__readers:
+                # A steady stream of datagrams never leaves __recv waiting
+                self.__run_readers(self.__selector.select(0))
+            with self._lock:
+                self.timers.advance(time.monotonic())
+            self._polling = False
+
+    def __recv(self, timeout=None) -> Tuple[bytes, Tuple[str, int]]:
+        # Read one datagram, waiting up to `timeout` seconds (None = forever)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                return self.__socket.recvfrom(MAX_SEGMENT_SIZE)
+            except BlockingIOError:
+                pass
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                raise socket.timeout("timed out")
+            self.__run_readers(self.__selector.select(remaining))
 
     def __listen_recv(self, timeout=None):
-        self.__socket.settimeout(timeout)
-        data, address = self.__socket.recvfrom(128)
+        data, address = self.__recv(timeout)
+        while len(data) < header_size(data):
+            data, address = self.__recv(timeout)
         segment, checksum_valid = Segment.from_bytes(data)
         return  (segment, address, checksum_valid)
 
+    def __drain_recv(self, timeout=None) -> List[Tuple[bytes, Tuple[str, int]]]:
+        # Wait for the first datagram, then take whatever else is already
+        # queued without blocking (until EAGAIN or MAX_RECV_BATCH)
+        recvfrom = self.__socket.recvfrom
+        datagrams = [self.__recv(timeout)]
+        try:
+            while len(datagrams) < MAX_RECV_BATCH:
+                datagrams.append(recvfrom(MAX_SEGMENT_SIZE))
+        except (BlockingIOError, InterruptedError):
+            pass
+        return [(data, address) for data, address in datagrams if len(data) >= header_size(data)]
+
     def send_segment(self, seg: Segment, ip:str, port:int) -> None:
         seg.update_checksum()
-        if (ip, port) in self.connections.keys():
-            self.__socket.sendto(seg.get_bytes(), (ip, port))
-        else:
-            # self.connect(ip, port)
-            self.__socket.sendto(seg.get_bytes(), (ip, port))
+        self.send_bytes(seg.get_bytes(), ip, port)
+
+    def send_bytes(self, data, ip: str, port: int) -> None:
+        # Send an already encoded datagram
+        try:
+            self.__socket.sendto(data, (ip, port))
+        except BlockingIOError:
+            # Send buffer full, same as a lost datagram: retransmission covers it
+            pass
+
+    def _encode_message(self, message: MessageInfo, conn: Connection) -> EncodedMessage:
+        # Split and encode once for the connection's MSS and header format,
+        # seq/ack are stamped per connection when sent
+        if conn.local_id is not None:
+            return self._encode_records([message], conn)
+        return EncodedMessage(self._split_message_to_segments(
+            message.get_username(), message.get_msg(), mss=conn.mss, compress=conn.compress
+        ))
+
+    def _encode_records(self, messages: List[MessageInfo], conn: Connection) -> EncodedMessage:
+        # Compact headers: the payload is a run of MessageInfo records, as
+        # many messages as were queued together
+        payload = b''.join(encode_record(message, self._record_author(message)) for message in messages)
+        return EncodedMessage(self._split_message_to_segments("", payload, mss=conn.mss, sender_id=conn.local_id, compress=conn.compress))
+
+    def _record_author(self, message: MessageInfo) -> str:
+        # The peer knows who we are, only a relay names the author
+        return ""
+
+    def _syn_options(self, key: Tuple[str, int] | None = None) -> bytes:
+        # What the SYN offers: our MSS, compact headers, compression, and
+        # resuming the connection we still have to `key` (else asking for a
+        # token to do so later)
+        options = {OPTION_MSS: encode_mss(self.mss), OPTION_SENDER_ID: b""}
+        if self.compression:
+            options[OPTION_COMPRESS] = encode_compress(DICTIONARY_ID)
+        previous = self.connections.get(key)
+        token = self.resume_tokens.get(key)
+        options[OPTION_RESUME] = encode_resume(token, previous.recv_seq) if token and previous else b""
+        return encode_options(options)
+
+    @staticmethod
+    def _ack_options(syn_ack: Segment) -> bytes:
+        # The final ACK echoes the sender id we were given and compression
+        # if it was agreed: a server answering with a SYN cookie kept no note
+        offered = syn_ack.get_options()
+        echo = {kind: offered[kind] for kind in (OPTION_SENDER_ID, OPTION_COMPRESS) if kind in offered}
+        return encode_options(echo) if echo else b""
+
+    def _open_connection(self, key: Tuple[str, int], initial_seq: int, syn_ack: Segment) -> bool:
+        # Set up the connection a SYN-ACK answers. True if it resumed the one
+        # we had: that takes no final ACK, both ends carry on in the sequence
+        # space they were in, and whatever the peer never got is sent again.
+        local_id = self._negotiate_sender_id(syn_ack)
+        peer_id = None if local_id is None else 0   # the server sends as 0
+        compress = self._negotiate_compress(syn_ack)
+        resume = decode_resume(syn_ack.get_options().get(OPTION_RESUME, b""))
+        with self._lock:
+            previous = self.connections.get(key)
+            resumed = resume is not None and previous is not None and resume[0] == self.resume_tokens.get(key)
+            if resumed:
+                # Starts receiving afresh: partly received messages are sent again whole
+                conn = Connection(self.ip, self.port, key[0], key[1], resume[1], previous.recv_seq,
+                                  congestion=self.congestion, mss=self._negotiate_mss(syn_ack),
+                                  local_id=local_id, peer_id=peer_id, pool=self.reassembly,
+                                  streaming=self.streaming, compress=compress)
+                for message in previous.send_window.unacked_messages(resume[1]):
+                    conn.send_seq = conn.send_window.push(message, conn.send_seq)
+                conn.outbox, conn.outbox_size, conn.outbox_deadline = previous.outbox, previous.outbox_size, previous.outbox_deadline
+                self._drop_timers(previous)
+            else:
+                conn = Connection(self.ip, self.port, key[0], key[1], initial_seq + 1, syn_ack.get_seq_number() + 1,
+                                  congestion=self.congestion, mss=self._negotiate_mss(syn_ack),
+                                  local_id=local_id, peer_id=peer_id, pool=self.reassembly,
+                                  streaming=self.streaming, compress=compress)
+                if previous is not None:
+                    self._drop_timers(previous)
+                if resume is not None:
+                    self.resume_tokens[key] = resume[0]
+                else:
+                    self.resume_tokens.pop(key, None)
+            self.connections[key] = conn
+            if resumed:
+                self._pump(key)
+        return resumed
+
+    def _negotiate_mss(self, segment: Segment) -> int:
+        # The smaller of both offers, PAYLOAD_SIZE for a peer that offers none
+        value = segment.get_options().get(OPTION_MSS)
+        offer = decode_mss(value) if value is not None else None
+        return min(self.mss, offer) if offer else PAYLOAD_SIZE
+
+    def _negotiate_compress(self, segment: Segment) -> bool:
+        # Both ends hold the dictionary the other names, and want it
+        value = segment.get_options().get(OPTION_COMPRESS)
+        return self.compression and value is not None and decode_compress(value) == DICTIONARY_ID
+
+    @staticmethod
+    def _negotiate_sender_id(syn_ack: Segment) -> int | None:
+        # The id the SYN-ACK gives us for compact headers, None = full headers
+        value = syn_ack.get_options().get(OPTION_SENDER_ID)
+        return decode_sender_id(value) if value is not None else None
 
     # sending segment to ip and port destination
     def _send_message(self, message: MessageInfo, server_ip: str, server_port: int):
-        conn = self.connections[(server_ip, server_port)]
-        seq = conn.send_seq  
-        ack = conn.recv_seq  
-        username = message.get_username()
-        payload = message.get_msg()
-
-        segments = self._split_message_to_segments(
-            username,
-            payload,
-            seq,
-            ack
-        )
-
-        # print(f"[DEBUG] Split message into {len(segments)} segments.")
-
-        # Sliding window
-        self.window_buffer = {}  # seq_num -> Segment
-        self.send_times = {}     # seq_num -> time
-        self.ack_received = set()
-        self.window_base = 0
-        self.next_seq_num = 0
-
-        while self.window_base < len(segments):
-            # Send segments within the window
-            while (self.next_seq_num < self.window_base + WINDOW_SIZE and
-                   self.next_seq_num < len(segments)):
-                segment = segments[self.next_seq_num]
-                seq_num = segment.get_header()['seqNumber']
-
-                # print(f"[>] Sending segment {self.next_seq_num} (seq={seq_num})")
-                self.send_segment(segment, server_ip, server_port)
-
-                self.window_buffer[seq_num] = segment
-                self.send_times[seq_num] = time.time()
-                self.next_seq_num += 1
-
-            
-            try: # Wait for ACK
-                segment, addr, checksum_valid = self.__listen_recv(timeout=2)
-
-                if segment.get_flag().is_ack_flag():
-                    ack_num = segment.get_header()['ackNumber']
-                    # print(f"[<] ACK received for seq < {ack_num}")
-                    self.ack_received.add(ack_num)
-
-                    # Slide window: remove all segments fully acked
-                    while self.window_base < len(segments):
-                        seg = segments[self.window_base]
-                        seq_num = seg.get_header()['seqNumber']
-                        seg_end = seq_num + len(seg.get_data().decode())
-
-                        if seg_end <= ack_num:
-                            del self.window_buffer[seq_num]
-                            del self.send_times[seq_num]
-                            self.window_base += 1
-                        else:
-                            break
-
-            except Exception:
-                pass  # timeout, check for resend
-
-            # Retransmit timed-out segments
-            current_time = time.time()
-            for seq_num, seg in self.window_buffer.items():
-                if seq_num not in self.ack_received:
-                    if current_time - self.send_times[seq_num] > 2.5:
-                        # print(f"[!] Timeout: Resending segment seq={seq_num}")
-                        self.send_segment(seg, server_ip, server_port)
-                        self.send_times[seq_num] = current_time
-
-        # Update connection state
-        conn.send_seq = seq
-        # print("[!] All segments sent and acknowledged successfully.")
+        # Queue the message on the connection's send window and return, the
+        # receive loop delivers it as ACKs and retransmit timers come in.
+        # On a compact connection it goes through the outbox, so messages
+        # sent in a burst share segments.
+        key = (server_ip, server_port)
+        with self._lock:
+            conn = self.connections[key]
+            if conn.local_id is None or not self.coalesce_delay:
+                self._queue_encoded(self._encode_message(message, conn), server_ip, server_port)
+                return
+            conn.outbox.append(message)
+            conn.outbox_size += len(message.get_msg())
+            if conn.outbox_deadline is None:
+                conn.outbox_deadline = time.monotonic() + self.coalesce_delay
+            self._pump(key)
+
+    def _flush_outbox(self, conn: Connection, now: float) -> None:
+        # Nagle: held messages go out once nothing is in flight, they fill a
+        # segment, or the delay is up
+        if not conn.outbox:
+            return
+        if conn.send_window.is_idle() or conn.outbox_size >= conn.mss or now >= conn.outbox_deadline:
+            messages = conn.outbox
+            conn.outbox = []
+            conn.outbox_size = 0
+            conn.outbox_deadline = None
+            conn.messages_coalesced += len(messages) - 1
+            conn.send_seq = conn.send_window.push(self._encode_records(messages, conn), conn.send_seq)
+
+    def _queue_encoded(self, encoded: EncodedMessage, ip: str, port: int) -> None:
+        # Queue an already encoded message, it takes the next slice of the
+        # connection's sequence space
+        key = (ip, port)
+        with self._lock:
+            conn = self.connections[key]
+            conn.send_seq = conn.send_window.push(encoded, conn.send_seq)
+            self._pump(key)
+
+    def _transmit(self, key: Tuple[str, int], frames: List[Frame]) -> None:
+        # Stamp each due frame with this connection's seq/ack and send it,
+        # data carries any delayed ACK along
+        conn = self.connections[key]
+        for seq_num, message, index in frames:
+            if message is None:
+                self.send_segment(Segment.fin(sender_id=conn.local_id), key[0], key[1])
+            else:
+                self.send_bytes(message.stamp(index, seq_num, conn.recv_seq), key[0], key[1])
+                if conn.unacked_segments:
+                    conn.acks_piggybacked += 1
+                    conn.unacked_segments = 0
+                    conn.ack_deadline = None
+
+    def _pump(self, key: Tuple[str, int]) -> None:
+        # Send whatever the connection's window has due right now
+        conn = self.connections.get(key)
+        if conn is None:
+            return
+        now = time.monotonic()
+        self._flush_outbox(conn, now)
+        self._transmit(key, conn.send_window.poll(now))
+        self._flush_ack(key, conn, now)
+        # Come back for the next retransmit, delayed ACK or outbox flush
+        self._set_timer(conn, 'send', self._deadline(conn), self._pump, key)
 
+    def _consume_ack(self, ip: str, port: int, segment: Segment) -> bool:
+        # Pure ACKs for data in flight belong to the send window, not receive().
+        # An ACK piggybacked on data feeds the window too, the data still
+        # goes on to receive().
+        flag = segment.get_flag_value()
+        if flag & ACK_FLAG and segment.get_data():
+            conn = self.connections.get((ip, port))
+            if conn is not None and conn.send_window.in_flight:
+                conn.send_window.on_ack(segment.get_ack_number(), time.monotonic(), carries_data=True)
+                self._pump((ip, port))
+            return False
+        if flag & ~FORMAT_FLAGS != ACK_FLAG:
+            return False
+        conn = self.connections.get((ip, port))
+        if conn is None or not conn.send_window.in_flight:
+            return False
+        # print(f"[<] ACK received for seq < {segment.get_ack_number()}")
+        # Progress frees room, a duplicate may trigger a fast retransmit
+        sack = decode_sack(segment.get_options().get(OPTION_SACK, b"")) if flag & OPT_FLAG else ()
+        conn.send_window.on_ack(segment.get_ack_number(), time.monotonic(), sack)
+        self._pump((ip, port))
+        return True
+
+    # -- Timers --
+    # Retransmits, delayed ACKs, heartbeats and idle eviction all live on
+    # self.timers. poll() runs whatever is due, AsyncNode drives it from its loop.
+    def _schedule(self, when: float, callback: Callable, *args) -> Timer:
+        return self.timers.schedule(when, callback, *args)
+
+    def _set_timer(self, conn: Connection, name: str, when: float | None, callback: Callable, *args) -> None:
+        # A connection has at most one timer per name: setting it again
+        # replaces it, when=None just cancels it
+        self.timers.cancel(conn.timers.pop(name, None))
+        if when is not None:
+            conn.timers[name] = self._schedule(when, callback, *args)
+
+    def _drop_timers(self, conn: Connection) -> None:
+        for timer in conn.timers.values():
+            self.timers.cancel(timer)
+        conn.timers.clear()
+
+    def _repeat(self, interval: float, callback: Callable, first: float | None = None) -> None:
+        # Run callback every `interval` seconds (the first time after `first`)
+        # until it returns False
+        def run():
+            if callback() is not False:
+                self._schedule(time.monotonic() + interval, run)
+        with self._lock:
+            self._schedule(time.monotonic() + (interval if first is None else first), run)
+
+    # -- Other inputs --
+    # Files besides the socket the receive loop waits on (e.g. the room bus
+    # between server workers), callback runs under the lock once fileobj
+    # is readable and has to drain it
+    def _add_reader(self, fileobj, callback: Callable) -> None:
+        self.__selector.register(fileobj, selectors.EVENT_READ, callback)
+        self.__readers += 1
+
+    def __run_readers(self, events) -> None:
+        for key, _ in events:
+            if key.data is not None:
+                with self._lock:
+                    key.data()
+
+    def _next_timeout(self, timeout):
+        # Wait no longer than the earliest timer
+        with self._lock:
+            deadline = self.timers.next_deadline()
+        if deadline is None:
+            return timeout
+        wait = max(0.0, deadline - time.monotonic())
+        return wait if timeout is None else min(wait, timeout)
 
     # closes connection
     def close_connection(self, ip:str, port:int) -> None:
-        connection = self.connections.get((ip, port))
-        # if there's no connections
-        if connection is None:
-            return
-        
-        # send FIN_FLAG
-        self.send_segment(Segment.fin(), ip, port)
-        while self.connections.get((ip, port)) is not None:
-            try:
-                segment, address, checksum_valid = self.__listen_recv(timeout=2)
-                if not checksum_valid:
-                    continue
-                flag = segment.get_flag()
-
-                if flag.is_fin_ack_flag():
-                    # print(f"[<] Received FIN-ACK from {ip}:{port}")
-                    self.connections.pop((ip, port), None)
-                    # print(f"[!] {ip}:{port} closed cleanly")
-                    break
-            except socket.timeout:
-                # try sending
-                self.send_segment(Segment.fin(), ip, port)
+        key = (ip, port)
+        with self._lock:
+            connection = self.connections.get(key)
+            # if there's no connections
+            if connection is None:
+                return
+            # FIN goes out once everything queued before it is ACKed
+            connection.send_window.close()
+            self._pump(key)
+
+        if self._polling and self._receiver is threading.current_thread():
+            return  # called from receive(), the loop finishes the close
+
+        deadline = time.monotonic() + TIMEOUT_LISTEN
+        while key in self.connections and time.monotonic() < deadline:
+            if self._receiver is not None and self._receiver.is_alive() and self._receiver is not threading.current_thread():
+                # the receive loop handles the FIN-ACK, just wait for it
+                with self._activity:
+                    self._activity.wait(TIMEOUT_ACK)
+            else:
+                self.poll(TIMEOUT_ACK)
+        with self._lock:
+            connection = self.connections.pop(key, None)
+            if connection is not None:
+                self._drop_timers(connection)
+
     def change_username(self, new_name: str, origin_addr: tuple[str, int] | None = None):
         if origin_addr is None:
             self.username = new_name
@@ -0,0 +1,102 @@
+from struct import Struct
+from typing import Callable, List, Tuple
+import os
+import socket
+
+from lib.SharedRing import SharedRing, RingReader
+
+# Every bus datagram: kind, worker that published it
+BUS_STRUCT = Struct('!BB')
+BUS_RECORDS = 1     # doorbell: the sender's ring has new records
+BUS_SHUTDOWN = 2    # utf-8 username that killed the server
+BUS_SHUTDOWN_TIMEOUT = 1.0     # seconds a shutdown waits on each worker, doorbells never wait
+BUS_MAX_DATAGRAM = 1024
+
+
+class RoomBus:
+    # Fan-out channel between the worker processes of one server. Each
+    # worker owns a shard of the clients (whichever addresses the kernel
+    # hashes to its SO_REUSEPORT socket), so a message only reaches the rest
+    # of the room once every other worker has it too.
+    #
+    # Messages go into the worker's own SharedRing, written once whatever
+    # the number of workers, and the others read them in place. The unix
+    # datagram sockets (one per worker, in the abstract namespace) only
+    # ring the doorbell, at most once per loop turn, and carry the shutdown.
+    def __init__(self, index: int, workers: int, name: str, rings: List[str]) -> None:
+        self.index = index
+        self.addresses = [f"\0{name}-{i}" for i in range(workers)]
+        self.receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.receiver.bind(self.addresses[index])
+        self.receiver.setblocking(False)
+        # A doorbell never waits on a peer: it carries nothing the ring does
+        # not hold, so one that does not fit is dropped
+        self.sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sender.setblocking(False)
+        self.unreachable = set()    # workers already warned about, until they take one again
+
+        self.ring = SharedRing(rings[index])
+        self.readers = {i: RingReader(SharedRing(ring)) for i, ring in enumerate(rings) if i != index}
+        self.ringing = False        # a doorbell is due for what was written since the last
+
+    @staticmethod
+    def name() -> str:
+        # One bus per server process tree
+        return f"chat-room-{os.getpid()}"
+
+    def fileno(self) -> int:
+        return self.receiver.fileno()
+
+    def write(self, record: bytes) -> bool:
+        # Into our ring, True if the caller has to schedule a doorbell()
+        self.ring.append(record)
+        if self.ringing:
+            return False
+        self.ringing = True
+        return True
+
+    def doorbell(self) -> None:
+        self.ringing = False
+        self.publish(BUS_RECORDS, b'')
+
+    def read(self, index: int, decode: Callable) -> Tuple[int, List]:
+        # What worker `index` wrote since we last looked, see RingReader.read
+        return self.readers[index].read(decode)
+
+    def publish(self, kind: int, payload: bytes, timeout: float = 0.0) -> None:
+        # timeout: how long to wait on a worker whose queue is full
+        data = BUS_STRUCT.pack(kind, self.index) + payload
+        self.sender.settimeout(timeout)
+        for index, address in enumerate(self.addresses):
+            if index == self.index:
+                continue
+            try:
+                self.sender.sendto(data, address)
+            except (FileNotFoundError, ConnectionRefusedError, BlockingIOError, socket.timeout):
+                # Worker not up yet, gone, or stuck with its queue full: it
+                # catches up on the next doorbell
+                if index not in self.unreachable:
+                    self.unreachable.add(index)
+                    print(f"[!] Room bus: worker {index} unreachable")
+            else:
+                self.unreachable.discard(index)
+
+    def receive(self) -> List[Tuple[int, int, bytes]]:
+        # Everything queued, as (kind, worker, payload)
+        published = []
+        try:
+            while True:
+                data = self.receiver.recv(BUS_MAX_DATAGRAM)
+                if len(data) >= BUS_STRUCT.size:
+                    kind, index = BUS_STRUCT.unpack_from(data)
+                    published.append((kind, index, data[BUS_STRUCT.size:]))
+        except (BlockingIOError, InterruptedError):
+            pass
+        return published
+
+    def close(self) -> None:
+        self.receiver.close()
+        self.sender.close()
+        self.ring.close()
+        for reader in self.readers.values():
+            reader.ring.close()
@@ -0,0 +1,46 @@
+from lib.Constant import TIMEOUT_TIME, RTO_MIN, RTO_MAX
+
+# RFC 6298 gains: SRTT moves 1/8 and RTTVAR 1/4 of the way to each sample
+RTT_ALPHA = 1 / 8
+RTT_BETA  = 1 / 4
+RTT_K     = 4
+
+
+class RttEstimator:
+    # Smoothed round-trip time and the retransmission timeout derived from
+    # it (RFC 6298). Samples must only come from segments that were sent
+    # once (Karn's rule), the owner takes care of that.
+    __slots__ = ('srtt', 'rttvar', 'rto', 'samples', 'backoffs')
+
+    def __init__(self) -> None:
+        self.srtt: float | None = None      # None until the first sample
+        self.rttvar: float | None = None
+        self.rto: float = TIMEOUT_TIME
+        self.samples = 0
+        self.backoffs = 0                   # consecutive timeouts since the last sample
+
+    def sample(self, rtt: float) -> None:
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - RTT_BETA) * self.rttvar + RTT_BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - RTT_ALPHA) * self.srtt + RTT_ALPHA * rtt
+        # A fresh sample also ends any backoff
+        self.rto = min(RTO_MAX, max(RTO_MIN, self.srtt + RTT_K * self.rttvar))
+        self.samples += 1
+        self.backoffs = 0
+
+    def backoff(self) -> None:
+        # Retransmission timer expired: double the timeout until a new sample
+        self.rto = min(RTO_MAX, self.rto * 2)
+        self.backoffs += 1
+
+    def get_stats(self) -> dict:
+        return {
+            'srtt': self.srtt,
+            'rttvar': self.rttvar,
+            'rto': self.rto,
+            'samples': self.samples,
+            'backoffs': self.backoffs,
+        }
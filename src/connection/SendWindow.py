@@ -0,0 +1,244 @@
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Set, Tuple
+
+from lib.EncodedMessage import EncodedMessage
+from lib.Constant import CONGESTION_CONTROL, DUPACK_THRESHOLD
+from connection.RttEstimator import RttEstimator
+from connection.CongestionControl import CongestionControl, create_congestion_control
+
+# What poll() hands back: (seq_num, message, frame index). A None message
+# stands for the connection's FIN.
+Frame = Tuple[int, EncodedMessage | None, int]
+
+
+class SendWindow:
+    # Outbound queue and sliding-window state of one connection. It never
+    # touches the socket: the owner feeds it ACKs and the clock, and sends
+    # whatever poll() hands back.
+    #
+    # Messages are shared EncodedMessage objects (one per broadcast, not per
+    # recipient), the window only remembers where they sit in its own
+    # sequence space.
+    def __init__(self, congestion: CongestionControl | None = None) -> None:
+        self.congestion = congestion or create_congestion_control(CONGESTION_CONTROL)
+        self.queue: Deque[Tuple[EncodedMessage, int]] = deque()     # (message, first seq) waiting for room
+        self.next_frame = 0                                          # next frame of queue[0] to send
+        self.in_flight: Dict[int, Tuple[EncodedMessage, int]] = {}  # seq_num -> (message, frame), oldest first
+        self.send_times: Dict[int, float] = {}                      # seq_num -> last time sent, in send order
+        self.lost: Dict[int, None] = {}                             # in flight, to be resent (ordered set)
+        self.resend_now: Dict[int, None] = {}                       # fast retransmits, sent regardless of cwnd
+        self.sacked: Set[int] = set()                               # in flight, but the peer has it (SACK)
+        self.retransmitted: Set[int] = set()                        # in flight, sent more than once
+        self.rtt = RttEstimator()                                   # drives the retransmission timeout
+        self.retransmits = 0
+        self.fast_retransmits = 0
+        self.dupacks = 0                                            # duplicate ACKs in a row
+        self.recover: int | None = None                             # in fast recovery until this seq is ACKed
+        self.acked_seq: int | None = None                           # end of the last in-order ACKed frame
+
+        self.closing = False                                        # send FIN once everything is ACKed
+        self.fin_sent_at: float | None = None
+
+    def push(self, message: EncodedMessage, seq_num: int) -> int:
+        # Queue a message starting at seq_num, returns the seq right after it
+        if len(message):
+            self.queue.append((message, seq_num))
+        return seq_num + message.size
+
+    def close(self) -> None:
+        self.closing = True
+
+    def unacked_messages(self, ack_num: int) -> List[EncodedMessage]:
+        # Messages the peer is missing any part of after ack_num, oldest
+        # first: what a resumed connection sends again, whole
+        messages = {}
+        for seq_num, (message, index) in self.in_flight.items():
+            if seq_num - message.offsets[index] + message.size > ack_num:
+                messages[message] = None
+        for message, _ in self.queue:
+            messages[message] = None
+        return list(messages)
+
+    def is_idle(self) -> bool:
+        return not self.queue and not self.in_flight
+
+    def has_work(self) -> bool:
+        return self.closing or not self.is_idle()
+
+    def pipe(self) -> int:
+        # Frames that are actually out in the network
+        return len(self.in_flight) - len(self.lost) - len(self.sacked)
+
+    def on_ack(self, ack_num: int, now: float, sack: Iterable[Tuple[int, int]] = (), carries_data: bool = False) -> bool:
+        # Slide window: drop every frame fully ACKed, returns True on progress.
+        # A pure ACK for the start of the oldest frame is a duplicate: the
+        # peer got something later, so that frame is probably lost. SACK
+        # blocks say exactly what it got, and only the holes between them are
+        # resent. ACKs piggybacked on data never count as duplicates.
+        acked = 0
+        rtt = None
+        for seq_num, (message, index) in list(self.in_flight.items()):
+            end = seq_num + message.lengths[index]
+            if end > ack_num:
+                break
+            del self.in_flight[seq_num]
+            sent_at = self.send_times.pop(seq_num)
+            self.lost.pop(seq_num, None)
+            self.resend_now.pop(seq_num, None)
+            self.sacked.discard(seq_num)
+            if seq_num in self.retransmitted:
+                # Karn: no telling which copy this ACK is for
+                self.retransmitted.discard(seq_num)
+            else:
+                rtt = now - sent_at
+            self.acked_seq = end
+            acked += 1
+        if rtt is not None:
+            self.rtt.sample(rtt)
+        if sack:
+            self._update_sack(sack)
+
+        if acked:
+            self.dupacks = 0
+            if self.recover is None:
+                self.congestion.on_ack(acked)
+            elif ack_num >= self.recover:
+                self.recover = None
+                self.congestion.on_exit_recovery()
+            elif self.in_flight:
+                # Partial ACK (NewReno): the next frame is missing as well
+                first = next(iter(self.in_flight))
+                if first not in self.sacked and first not in self.retransmitted:
+                    self._fast_retransmit(first)
+        elif not carries_data and self.in_flight and ack_num == next(iter(self.in_flight)):
+            self.dupacks += 1
+            if sack:
+                pass    # the scoreboard below knows better than counting
+            elif self.recover is not None:
+                self.congestion.on_dupack()
+            elif self.dupacks == DUPACK_THRESHOLD:
+                self._enter_recovery()
+                self._fast_retransmit(ack_num)
+
+        if self.sacked:
+            self._mark_sack_losses()
+        return acked > 0
+
+    def _enter_recovery(self) -> None:
+        last_seq, (message, index) = next(reversed(self.in_flight.items()))
+        self.recover = last_seq + message.lengths[index]
+        self.congestion.on_enter_recovery(self.pipe())
+
+    def _update_sack(self, blocks: Iterable[Tuple[int, int]]) -> None:
+        for seq_num, (message, index) in self.in_flight.items():
+            if seq_num in self.sacked:
+                continue
+            end = seq_num + message.lengths[index]
+            if any(left <= seq_num and end <= right for left, right in blocks):
+                self.sacked.add(seq_num)
+                self.lost.pop(seq_num, None)
+                self.resend_now.pop(seq_num, None)
+
+    def _mark_sack_losses(self) -> None:
+        # A frame is lost once DUPACK_THRESHOLD frames after it were SACKed
+        # (RFC 6675). Each hole is resent once, a lost resend is left to the RTO.
+        holes = []
+        sacked_above = 0
+        for seq_num in reversed(self.in_flight):
+            if seq_num in self.sacked:
+                sacked_above += 1
+            elif (sacked_above >= DUPACK_THRESHOLD and seq_num not in self.retransmitted
+                  and seq_num not in self.lost and seq_num not in self.resend_now):
+                holes.append(seq_num)
+        if not holes:
+            return
+        holes.reverse()
+        if self.recover is None:
+            self._enter_recovery()
+            self._fast_retransmit(holes.pop(0))
+        for seq_num in holes:
+            self.lost[seq_num] = None
+
+    def _fast_retransmit(self, seq_num: int) -> None:
+        self.lost.pop(seq_num, None)
+        self.resend_now[seq_num] = None
+        self.fast_retransmits += 1
+
+    def poll(self, now: float) -> List[Frame]:
+        # Frames due now: resends of lost frames first, then new ones, both
+        # while the congestion window has room, then the FIN once the window
+        # has drained
+        due = []
+        rto = self.rtt.rto
+        oldest = self._oldest_send_time()
+        if oldest is not None and now - oldest >= rto:
+            # Timeout: go back to the oldest unACKed frame and resend
+            # everything from there the peer has not SACKed, as the
+            # (collapsed) window allows. A second timeout in a row stops
+            # trusting the SACKs, the peer may have dropped what it held.
+            if self.rtt.backoffs:
+                self.sacked.clear()
+            self.congestion.on_timeout(self.pipe())
+            self.rtt.backoff()
+            self.lost = dict.fromkeys(seq_num for seq_num in self.in_flight if seq_num not in self.sacked)
+            self.resend_now.clear()
+            self.recover = None
+            self.dupacks = 0
+
+        for seq_num in self.resend_now:
+            message, index = self.in_flight[seq_num]
+            due.append((seq_num, message, index))
+            self._resent(seq_num, now)
+            self.retransmits += 1
+        self.resend_now.clear()
+
+        window = self.congestion.window()
+        for seq_num in list(self.lost):
+            if self.pipe() >= window:
+                break
+            del self.lost[seq_num]
+            message, index = self.in_flight[seq_num]
+            due.append((seq_num, message, index))
+            self._resent(seq_num, now)
+            self.retransmits += 1
+
+        while self.queue and self.pipe() < window:
+            message, first_seq = self.queue[0]
+            index = self.next_frame
+            seq_num = first_seq + message.offsets[index]
+            self.in_flight[seq_num] = (message, index)
+            self.send_times[seq_num] = now
+            due.append((seq_num, message, index))
+            self.next_frame += 1
+            if self.next_frame == len(message):
+                self.queue.popleft()
+                self.next_frame = 0
+
+        if self.closing and self.is_idle():
+            if self.fin_sent_at is None or now - self.fin_sent_at >= self.rtt.rto:
+                due.append((0, None, 0))
+                self.fin_sent_at = now
+        return due
+
+    def _resent(self, seq_num: int, now: float) -> None:
+        # Move it to the back, send_times stays in send order
+        del self.send_times[seq_num]
+        self.send_times[seq_num] = now
+        self.retransmitted.add(seq_num)
+
+    def _oldest_send_time(self) -> float | None:
+        # First entry the network still holds: lost and SACKed ones are only
+        # skipped, so this stays O(1) outside of loss recovery
+        for seq_num, sent_at in self.send_times.items():
+            if seq_num not in self.lost and seq_num not in self.sacked:
+                return sent_at
+        return None
+
+    def next_deadline(self) -> float | None:
+        # When poll() next has something to do, None if only an ACK can help
+        oldest = self._oldest_send_time()
+        if oldest is not None:
+            return oldest + self.rtt.rto
+        if self.closing and self.fin_sent_at is not None:
+            return self.fin_sent_at + self.rtt.rto
+        return None
@@ -0,0 +1,185 @@
+from typing import Callable, Dict, List
+
+from lib.Constant import TIMER_TICK, TIMER_SLOTS
+
+
+class Timer:
+    # One scheduled callback, the handle schedule() gives back for cancel()
+    __slots__ = ('when', 'tick', 'callback', 'args', 'bucket')
+
+    def __init__(self, when: float, tick: int, callback: Callable, args: tuple) -> None:
+        self.when = when
+        self.tick = tick                                # absolute tick it is due in
+        self.callback = callback
+        self.args = args
+        self.bucket: Dict[Timer, None] | None = None    # where it waits, None once fired or cancelled
+
+    def active(self) -> bool:
+        return self.bucket is not None
+
+
+class TimerWheel:
+    # Hierarchical timing wheel (Varghese & Lauck). The inner wheel has
+    # TIMER_SLOTS buckets of one TIMER_TICK, one per tick of the current
+    # turn. The outer wheel has TIMER_SLOTS buckets of one turn each, emptied
+    # into the inner wheel as its turn starts. Anything further out waits in
+    # an overflow bucket, looked at once per turn.
+    #
+    # schedule() and cancel() are O(1) however many timers there are, and
+    # advance() only touches timers that are due (plus one cascade per turn).
+    # It never reads the clock: the owner passes `now` (monotonic) and calls
+    # advance() from whatever loop it runs.
+    def __init__(self, now: float, tick: float = TIMER_TICK, slots: int = TIMER_SLOTS) -> None:
+        self.tick = tick
+        self.slots = slots
+        self.inner: List[Dict[Timer, None]] = [{} for _ in range(slots)]     # ordered sets
+        self.outer: List[Dict[Timer, None]] = [{} for _ in range(slots)]
+        self.overflow: Dict[Timer, None] = {}
+        self.current = int(now / tick)                  # tick advance() got up to
+        self.next_tick = self.current                   # no live timer of this turn is due before it
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def schedule(self, when: float, callback: Callable, *args) -> Timer:
+        # A time already passed is due on the next advance()
+        timer = Timer(when, max(int(when / self.tick), self.current), callback, args)
+        self.__place(timer)
+        self.count += 1
+        return timer
+
+    def cancel(self, timer: Timer | None) -> None:
+        if timer is not None and timer.bucket is not None:
+            del timer.bucket[timer]
+            timer.bucket = None
+            self.count -= 1
+
+    def __place(self, timer: Timer) -> None:
+        turns = timer.tick // self.slots - self.current // self.slots
+        if turns == 0:
+            timer.bucket = self.inner[timer.tick % self.slots]
+            self.next_tick = min(self.next_tick, timer.tick)
+        elif turns < self.slots:
+            timer.bucket = self.outer[timer.tick // self.slots % self.slots]
+        else:
+            timer.bucket = self.overflow
+        timer.bucket[timer] = None
+
+    def __cascade(self) -> None:
+        # A new turn: its outer bucket moves in, and the overflow moves out
+        # as far as it now fits
+        outer = self.outer[self.current // self.slots % self.slots]
+        moving = list(outer)
+        outer.clear()
+        if self.overflow:
+            moving.extend(timer for timer in self.overflow
+                          if timer.tick // self.slots - self.current // self.slots < self.slots)
+            for timer in moving:
+                self.overflow.pop(timer, None)
+        for timer in moving:
+            self.__place(timer)
+
+    def advance(self, now: float) -> int:
+        # Run every timer due by `now`, returns how many ran. Callbacks may
+        # schedule or cancel timers, a timer scheduled for now runs on the
+        # next call.
+        target = int(now / self.tick)
+        due = []
+        while True:
+            bucket = self.inner[self.current % self.slots]
+            if bucket:
+                ready = [timer for timer in bucket if timer.when <= now]
+                for timer in ready:
+                    del bucket[timer]
+                    timer.bucket = None
+                due.extend(ready)
+            if self.current >= target:
+                break
+            self.current += 1
+            if self.current % self.slots == 0:
+                self.__cascade()
+        self.count -= len(due)
+        for timer in due:
+            timer.callback(*timer.args)
+        return len(due)
+
+    def next_deadline(self) -> float | None:
+        # Earliest timer of the current turn, or the start of the next turn
+        # when the rest are further out. The scan starts at next_tick and
+        # leaves it where it stopped, so a turn's empty buckets are looked
+        # at once, not on every call. cancel() takes a timer out of its
+        # bucket, only live ones count.
+        if not self.count:
+            return None
+        end = (self.current // self.slots + 1) * self.slots
+        for tick in range(max(self.next_tick, self.current), end):
+            bucket = self.inner[tick % self.slots]
+            if bucket:
+                self.next_tick = tick
+                return min(timer.when for timer in bucket)
+        self.next_tick = end
+        return end * self.tick
+
+
+if __name__ == '__main__':
+    # Per-wakeup cost of finding and running due timers: scanning every
+    # connection's deadline (what the receive loop did) vs the wheel.
+    # Run from src: python -m connection.TimerWheel
+    import random
+    import timeit
+
+    wheel = TimerWheel(0.0)
+    fired = []
+    for when in (0.5, 0.005, 7.3, 0.5, 4000.0):
+        wheel.schedule(when, fired.append, when)
+    wheel.cancel(wheel.schedule(0.2, fired.append, 'cancelled'))
+    assert wheel.next_deadline() == 0.005
+    wheel.advance(1.0)
+    assert fired == [0.005, 0.5, 0.5] and len(wheel) == 2
+    wheel.advance(100.0)
+    assert fired[-1] == 7.3
+    wheel.advance(4000.0)
+    assert fired[-1] == 4000.0 and wheel.next_deadline() is None
+
+    # Cancelled timers never set the deadline, timers placed behind the
+    # scan do
+    wheel = TimerWheel(0.0)
+    wheel.schedule(2.0, int)
+    wheel.cancel(wheel.schedule(0.05, int))
+    assert wheel.next_deadline() == 2.0 and wheel.next_deadline() == 2.0
+    wheel.schedule(0.03, int)
+    assert wheel.next_deadline() == 0.03
+    wheel.advance(0.5)
+    assert wheel.next_deadline() == 2.0
+
+    rounds = 2000
+    for live in (100, 10000, 100000):
+        deadlines = {key: random.uniform(0, 30) for key in range(live)}
+
+        def scan():
+            now = 0.0
+            for _ in range(rounds):
+                now += 0.001
+                min(deadlines.values())
+                for key, deadline in deadlines.items():
+                    if deadline <= now:
+                        deadlines[key] = now + 30
+
+        timers = TimerWheel(0.0)
+        handles = {key: timers.schedule(deadline, int) for key, deadline in deadlines.items()}
+
+        def wheel_churn():
+            now = 0.0
+            for i in range(rounds):
+                now += 0.001
+                key = i % live
+                # re-arm one connection, like an ACK moving its RTO
+                timers.cancel(handles[key])
+                handles[key] = timers.schedule(now + random.uniform(0.2, 1), int)
+                timers.next_deadline()
+                timers.advance(now)
+
+        old = timeit.timeit(scan, number=1) / rounds * 1e6
+        new = timeit.timeit(wheel_churn, number=1) / rounds * 1e6
+        print(f"{live:>6} connections: scan {old:9.1f} us, wheel {new:5.1f} us per wakeup")
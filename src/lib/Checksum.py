@@ -0,0 +1,127 @@
+from struct import Struct
+from typing import Iterable, List
+
+# 16-bit one's complement checksum (RFC 1071) over a whole segment.
+# The checksum field itself sits at [13:15] of the header and is left out of
+# the sum, everything before and after it is summed as one contiguous stream.
+CHECKSUM_OFFSET = 13
+CHECKSUM_END    = CHECKSUM_OFFSET + 2
+_CHECKSUM_FIELD = Struct('!H')
+
+
+def _fold(total: int) -> int:
+    # End-around carry until the sum fits in 16 bits
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return total
+
+
+def _ones_complement_sum(data) -> int:
+    # Summing big-endian 16-bit words is the same as reducing the whole buffer,
+    # read as one big integer, modulo 0xffff (2^16 == 1 mod 0xffff). Only the
+    # zero case needs care: a non-zero buffer folds to 0xffff, not 0.
+    if len(data) & 1:
+        data = bytes(data) + b'\x00'
+    total = int.from_bytes(data, 'big')
+    if total == 0:
+        return 0
+    return total % 0xffff or 0xffff
+
+
+def calculate_checksum(data) -> int:
+    # Checksum of a buffer that does not contain a checksum field
+    return ~_ones_complement_sum(data) & 0xffff
+
+
+def segment_checksum(datagram) -> int:
+    # Checksum a full segment, skipping its own checksum field
+    return calculate_checksum(b''.join((datagram[:CHECKSUM_OFFSET], datagram[CHECKSUM_END:])))
+
+
+def verify_checksum(datagram) -> bool:
+    return segment_checksum(datagram) == _CHECKSUM_FIELD.unpack_from(datagram, CHECKSUM_OFFSET)[0]
+
+
+def verify_batch(datagrams: Iterable) -> List[bool]:
+    # Verify many received datagrams in one call, same order as the input
+    unpack_from = _CHECKSUM_FIELD.unpack_from
+    join = b''.join
+    results = []
+    append = results.append
+    for datagram in datagrams:
+        data = join((datagram[:CHECKSUM_OFFSET], datagram[CHECKSUM_END:]))
+        if len(data) & 1:
+            data += b'\x00'
+        total = int.from_bytes(data, 'big')
+        total = (total % 0xffff or 0xffff) if total else 0
+        append((~total & 0xffff) == unpack_from(datagram, CHECKSUM_OFFSET)[0])
+    return results
+
+
+def adjust_checksum(checksum: int, old_value: int, new_value: int, size: int = 4) -> int:
+    # Incremental update (RFC 1624, eqn. 3) for a field of `size` bytes that
+    # starts on an even offset, e.g. seqNumber [4:8] or ackNumber [8:12]:
+    #   HC' = ~(~HC + ~m + m')
+    total = ~checksum & 0xffff
+    for shift in range(0, size * 8, 16):
+        total += (~old_value >> shift) & 0xffff
+        total += (new_value >> shift) & 0xffff
+    return ~_fold(total) & 0xffff
+
+
+if __name__ == '__main__':
+    # Microbenchmark against the per-word loop Segment used before (with its
+    # fold fixed to >> 16 so both sides produce the same numbers)
+    import os
+    import timeit
+    from struct import pack
+
+    def legacy_checksum(data_bytes: bytes) -> int:
+        sum = 0
+        if (len(data_bytes) % 2 != 0):
+            data_bytes += b'\x00'
+        for i in range(0, len(data_bytes), 2):
+            sum += int.from_bytes(data_bytes[i:i+2], byteorder='big')
+        while sum >> 16:
+            sum = (sum & 0xffff) + (sum >> 16)
+        return ~sum & 0xffff
+
+    def make_datagram(payload_size: int) -> bytes:
+        body = pack('!HHIIB', 0, 0, 1000, 2000, 0x04) + b'alice'.ljust(10, b'\x00') + os.urandom(payload_size)
+        checksum = calculate_checksum(body)
+        return body[:CHECKSUM_OFFSET] + pack('!H', checksum) + body[CHECKSUM_OFFSET:]
+
+    for payload_size in (0, 63, 64, 1400):
+        datagram = make_datagram(payload_size)
+        body = datagram[:CHECKSUM_OFFSET] + datagram[CHECKSUM_END:]
+        assert legacy_checksum(body) == calculate_checksum(body)
+        assert verify_checksum(datagram)
+
+    # Incremental update must agree with a full recompute
+    datagram = bytearray(make_datagram(64))
+    old_checksum = _CHECKSUM_FIELD.unpack_from(datagram, CHECKSUM_OFFSET)[0]
+    datagram[4:8] = pack('!I', 123456789)
+    new_checksum = adjust_checksum(old_checksum, 1000, 123456789)
+    assert new_checksum == segment_checksum(datagram)
+
+    runs = 20000
+    print(f"{'case':32} {'legacy us':>10} {'new us':>10} {'speedup':>8}")
+    for payload_size in (0, 64, 1400):
+        datagram = make_datagram(payload_size)
+        body = datagram[:CHECKSUM_OFFSET] + datagram[CHECKSUM_END:]
+        legacy = timeit.timeit(lambda: legacy_checksum(body), number=runs) / runs * 1e6
+        new = timeit.timeit(lambda: calculate_checksum(body), number=runs) / runs * 1e6
+        print(f"{f'checksum, {payload_size}B payload':32} {legacy:10.2f} {new:10.2f} {legacy / new:7.1f}x")
+
+    datagram = make_datagram(64)
+    legacy = timeit.timeit(lambda: legacy_checksum(datagram[:CHECKSUM_OFFSET] + datagram[CHECKSUM_END:]), number=runs) / runs * 1e6
+    new = timeit.timeit(lambda: adjust_checksum(old_checksum, 1000, 2000), number=runs) / runs * 1e6
+    print(f"{'seq change, 64B payload':32} {legacy:10.2f} {new:10.2f} {legacy / new:7.1f}x")
+
+    batch = [make_datagram(64) for _ in range(1000)]
+    batch_runs = 50
+    legacy = timeit.timeit(
+        lambda: [legacy_checksum(d[:CHECKSUM_OFFSET] + d[CHECKSUM_END:]) == _CHECKSUM_FIELD.unpack_from(d, CHECKSUM_OFFSET)[0] for d in batch],
+        number=batch_runs) / batch_runs * 1e3
+    new = timeit.timeit(lambda: verify_batch(batch), number=batch_runs) / batch_runs * 1e3
+    print(f"{'verify 1000 x 64B (ms)':32} {legacy:10.2f} {new:10.2f} {legacy / new:7.1f}x")
@@ -3,14 +3,58 @@ FIN_FLAG        = 0x01
 SYN_FLAG        = 0x02
 PSH_FLAG        = 0x04
 ACK_FLAG        = 0x08
+OPT_FLAG        = 0x10  # payload starts with options (see SegmentOption)
+CMP_FLAG        = 0x20  # compact header: 16-bit sender id instead of the username
+ZIP_FLAG        = 0x40  # payload compressed (see lib/Compression), on every segment of the message
+FORMAT_FLAGS    = OPT_FLAG | CMP_FLAG | ZIP_FLAG    # describe the layout, not what the segment is for
 
-PAYLOAD_SIZE    = 64
-WINDOW_SIZE     = 4
-TIMEOUT_TIME    = 1
+PAYLOAD_SIZE    = 64    # payload per segment for peers that offer no MSS
+MSS             = 1400  # largest payload we offer in the SYN
+WINDOW_SIZE     = 4     # initial congestion window, and the whole window for 'fixed'
+MAX_CWND        = 64    # frames in flight, whatever the congestion control says
+DUPACK_THRESHOLD = 3    # duplicate ACKs that trigger a fast retransmit
+ACK_EVERY       = 2     # in-order segments per ACK (1 = ACK every segment)
+ACK_DELAY       = 0.04  # longest an in-order segment waits for its ACK
+COALESCE_DELAY  = 0.01  # longest a message waits to share a segment (0 = send each alone)
+TIMER_TICK      = 0.01  # resolution of the timer wheel
+TIMER_SLOTS     = 512   # wheel buckets, one turn = TIMER_TICK * TIMER_SLOTS seconds
+CONGESTION_CONTROL = "reno"
+TIMEOUT_TIME    = 1     # initial retransmission timeout, before any RTT sample
 TIMEOUT_LISTEN  = 30
+TIMEOUT_ACK     = 2     # wait for an ACK before checking for retransmits
+RTO_MIN         = 0.2   # bounds of the adaptive retransmission timeout
+RTO_MAX         = 60
+TIMEOUT_HANDSHAKE = 5
+SYN_BACKLOG     = 256   # half-open handshakes kept before answering with SYN cookies
 MAX_BUFFER      = 10
 MESSAGES_LIMIT  = 20
+MESSAGE_LOG_SIZE = 1024  # messages the server keeps for clients catching up
+HISTORY_SEGMENT_BYTES = 16 * 1024 * 1024    # on-disk history: size a log file rolls over at
+HISTORY_SYNC_INTERVAL = 1                   # seconds between fsyncs of the on-disk history
+ROOM_RING_BYTES = 8 * 1024 * 1024           # shared-memory ring per server worker, room messages for the others
+REASSEMBLY_LIMIT = 1024 * 1024               # bytes one connection may have buffered for reassembly
+REASSEMBLY_POOL_LIMIT = 64 * 1024 * 1024     # the same, over every connection of a node
+MAX_RECV_BATCH  = 64    # datagrams handled per wakeup
+COMPRESS_MIN    = 64    # payloads shorter than this go out uncompressed
 
 HEARTBEAT_INTERVAL = 1
+RESUME_LIFETIME = 300   # seconds a dropped client's session can still be resumed
 
-MAX_WIDTH       = 40
\ No newline at end of file
+MAX_WIDTH       = 40
+
+# Text emoticons the server turns into emoji, also part of the compression dictionary
+EMOTICONS = {
+    ":smile:": "😊",
+    ":sad:": "😢",
+    ":laugh:": "😂",
+    ":grin:": "😁",
+    ":cool:": "😎",
+    ":cry:": "😭",
+    ":sleeping:": "😴",
+    ":heart:": "❤️",
+    ":wink:": "😉",
+    ":angry:": "😠",
+    ":surprise:": "😲",
+    ":thumbsup:": "👍",
+    ":wave:": "👋"
+}
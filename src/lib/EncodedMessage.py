@@ -0,0 +1,81 @@
+from struct import Struct
+from typing import Iterable, List
+
+from .Segment import Segment, SEQ_OFFSET, CHECKSUM_STRUCT
+from .Checksum import adjust_checksum, CHECKSUM_OFFSET
+
+SEQ_ACK_STRUCT = Struct('!II')
+
+
+class EncodedMessage:
+    # A message split and encoded once, numbered from seq 0 with ack 0.
+    # Every recipient sends the same frames: stamp() writes its own seq/ack
+    # into the frame buffer and patches the checksum incrementally, so fanning
+    # out costs no re-encoding, no Segment objects and no payload copies.
+    __slots__ = ('frames', 'checksums', 'offsets', 'lengths', 'size')
+
+    def __init__(self, segments: Iterable[Segment]) -> None:
+        self.frames: List[bytearray] = []   # wire bytes, stamped in place
+        self.checksums: List[int] = []      # checksum of each frame with seq = ack = 0
+        self.offsets: List[int] = []        # seq of each frame relative to the first
+        self.lengths: List[int] = []        # sequence space each frame takes
+        for segment in segments:
+            self.frames.append(bytearray(segment.get_bytes()))
+            self.checksums.append(adjust_checksum(segment.get_checksum(), segment.get_seq_number(), 0))
+            self.offsets.append(segment.get_seq_number())
+            self.lengths.append(len(segment.get_data()))
+        self.size = self.offsets[-1] + self.lengths[-1] if self.frames else 0
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+    def stamp(self, index: int, seq_num: int, ack_num: int) -> bytearray:
+        # Frame `index` as sent with these seq/ack numbers. The buffer is
+        # reused by the next stamp(), send it before stamping again.
+        frame = self.frames[index]
+        SEQ_ACK_STRUCT.pack_into(frame, SEQ_OFFSET, seq_num, ack_num)
+        # adjust_checksum() from zero fields, inlined: ~(~HC + seq + ack)
+        total = (~self.checksums[index] & 0xffff) + (seq_num >> 16) + (seq_num & 0xffff) + (ack_num >> 16) + (ack_num & 0xffff)
+        total = (total & 0xffff) + (total >> 16)
+        total = (total & 0xffff) + (total >> 16)
+        CHECKSUM_STRUCT.pack_into(frame, CHECKSUM_OFFSET, ~total & 0xffff)
+        return frame
+
+
+if __name__ == '__main__':
+    # Fan-out cost per recipient: re-splitting into fresh Segments (what the
+    # heartbeat path did for every client) vs stamping the shared frames
+    import timeit
+    from .Constant import PAYLOAD_SIZE
+
+    def split(text: str, seq_num: int, ack_num: int) -> List[Segment]:
+        segments = []
+        payload = text.encode()
+        for i in range(0, len(payload), PAYLOAD_SIZE):
+            chunk = payload[i:i + PAYLOAD_SIZE]
+            flag = [i + PAYLOAD_SIZE >= len(payload), False, True, True]
+            segments.append(Segment("alice", flag, seq_num, ack_num, chunk))
+            seq_num += len(chunk)
+        return segments
+
+    recipients = 100
+    for text in ("hello", "héllo 😊 " * 40):
+        encoded = EncodedMessage(split(text, 0, 0))
+        for seq_num in (0, 123456):
+            assert all(bytes(encoded.stamp(i, seq_num + encoded.offsets[i], 77)) == segment.get_bytes()
+                       for i, segment in enumerate(split(text, seq_num, 77)))
+
+        def resplit():
+            for client in range(recipients):
+                for segment in split(text, client * 1000, client):
+                    segment.get_bytes()
+
+        def stamp():
+            for client in range(recipients):
+                for index, offset in enumerate(encoded.offsets):
+                    encoded.stamp(index, client * 1000 + offset, client)
+
+        runs = 50
+        old = timeit.timeit(resplit, number=runs) / runs * 1e3
+        new = timeit.timeit(stamp, number=runs) / runs * 1e3
+        print(f"{len(encoded)} frame(s) x {recipients} clients: re-split {old:.2f} ms, stamp {new:.2f} ms ({old / new:.1f}x)")
@@ -0,0 +1,215 @@
+import mmap
+import os
+import time
+from array import array
+from bisect import bisect_right
+from struct import Struct
+from typing import Dict, Iterator, List
+
+from lib.Constant import HISTORY_SEGMENT_BYTES
+from lib.MessageInfo import MessageInfo, RECORD_STRUCT, encode_record
+from lib.SegmentOption import RESUME_TOKEN_SIZE
+
+# Each entry: when the server logged it (unix time), then the message as the
+# wire record (RECORD_STRUCT, author, text) it is sent as on compact connections
+ENTRY_STRUCT = Struct('!d')
+# The sessions file: a resume token and the id its client is up to, each
+SESSION_STRUCT = Struct(f'!{RESUME_TOKEN_SIZE}sQ')
+SESSIONS_FILE = 'sessions'
+
+
+class _LogFile:
+    # One file of the log, named after the id of its first entry
+    def __init__(self, path: str, first_id: int) -> None:
+        self.path = path
+        self.first_id = first_id
+        self.offsets = array('Q')       # where each entry starts
+        self.size = 0
+        self.map: mmap.mmap | None = None
+        self.mapped = 0                 # bytes self.map covers
+
+
+class HistoryLog:
+    # Append-only chat history on disk, so it survives a restart and clients
+    # far behind can be replayed more than the in-memory log keeps. Entries
+    # go to the newest file until it reaches segment_bytes, then a new file
+    # starts. Writes hit the OS right away, sync() makes them durable.
+    #
+    # Replay reads through mmap and hands out the wire records as slices of
+    # the mapping: no MessageInfo, no decoding, no copy until it is framed.
+    def __init__(self, directory: str, segment_bytes: int = HISTORY_SEGMENT_BYTES) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.files: List[_LogFile] = []
+        for name in sorted(os.listdir(directory)):
+            stem, ext = os.path.splitext(name)
+            if ext == '.log' and stem.isdigit():
+                self.files.append(self.__recover(os.path.join(directory, name), int(stem)))
+        self.next_id = self.files[-1].first_id + len(self.files[-1].offsets) if self.files else 0
+        self.writer = None              # newest file, opened for appending
+        self.dirty = False              # written since the last sync()
+        self.sessions: Dict[bytes, int] = {}    # as last saved
+
+    def __recover(self, path: str, first_id: int) -> _LogFile:
+        # Index the entries of an existing file, cutting off a torn last one.
+        # Walked through the mapping replay uses, only the headers are read,
+        # then unmapped: replay maps it again when it needs it.
+        log_file = _LogFile(path, first_id)
+        log_file.size = os.path.getsize(path)
+        if not log_file.size:
+            return log_file
+        data = self.__view(log_file)
+        header = ENTRY_STRUCT.size + RECORD_STRUCT.size
+        i = 0
+        while i + header <= len(data):
+            author_size, text_size = RECORD_STRUCT.unpack_from(data, i + ENTRY_STRUCT.size)
+            end = i + header + author_size + text_size
+            if end > len(data):
+                break
+            log_file.offsets.append(i)
+            i = end
+        data.release()
+        log_file.map.close()
+        log_file.map, log_file.mapped = None, 0
+        if i < log_file.size:
+            print(f"[!] History: dropped a torn entry at the end of {path}")
+            os.truncate(path, i)
+        log_file.size = i
+        return log_file
+
+    def __len__(self) -> int:
+        return self.next_id
+
+    def append(self, message: MessageInfo) -> int:
+        if not self.files or (self.files[-1].size >= self.segment_bytes and self.files[-1].offsets):
+            self.__roll()
+        if self.writer is None:
+            self.writer = open(self.files[-1].path, 'ab', buffering=0)
+        entry = ENTRY_STRUCT.pack(message.time.timestamp()) + encode_record(message)
+        self.writer.write(entry)
+        log_file = self.files[-1]
+        log_file.offsets.append(log_file.size)
+        log_file.size += len(entry)
+        self.dirty = True
+        message_id = self.next_id
+        self.next_id += 1
+        return message_id
+
+    def __roll(self) -> None:
+        if self.writer is not None:
+            self.sync()
+            self.writer.close()
+            self.writer = None
+        self.files.append(_LogFile(os.path.join(self.directory, f"{self.next_id:020d}.log"), self.next_id))
+
+    def sync(self) -> None:
+        if self.dirty and self.writer is not None:
+            os.fsync(self.writer.fileno())
+            self.dirty = False
+
+    def close(self) -> None:
+        self.sync()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def save_sessions(self, sessions: Dict[bytes, int]) -> None:
+        # Where each resumable client is up to, {token: id}, so it can be
+        # replayed the rest after a restart. Written aside then renamed over
+        # the old file: a crash leaves one or the other whole.
+        if sessions == self.sessions:
+            return
+        path = os.path.join(self.directory, SESSIONS_FILE)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(b''.join(SESSION_STRUCT.pack(token, cursor) for token, cursor in sessions.items()))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        self.sessions = dict(sessions)
+
+    def load_sessions(self) -> Dict[bytes, int]:
+        # What the last run saved, without ids past the end of the log
+        try:
+            with open(os.path.join(self.directory, SESSIONS_FILE), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return {}
+        data = data[:len(data) - len(data) % SESSION_STRUCT.size]
+        self.sessions = {token: cursor for token, cursor in SESSION_STRUCT.iter_unpack(data) if cursor <= self.next_id}
+        return dict(self.sessions)
+
+    def __view(self, log_file: _LogFile) -> memoryview:
+        # The file mapped read-only, mapped again once it has grown. An old
+        # mapping is only dropped, slices still handed out keep it alive.
+        if log_file.mapped < log_file.size:
+            with open(log_file.path, 'rb') as f:
+                log_file.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            log_file.mapped = len(log_file.map)
+        return memoryview(log_file.map)
+
+    def records(self, start: int, end: int) -> Iterator[memoryview]:
+        # Wire records of ids [start, end), as slices of the mapped files
+        start = max(start, 0)
+        end = min(end, self.next_id)
+        if start >= end:
+            return
+        index = bisect_right([log_file.first_id for log_file in self.files], start) - 1
+        while start < end:
+            log_file = self.files[index]
+            view = self.__view(log_file)
+            last = min(end, log_file.first_id + len(log_file.offsets))
+            for i in range(start - log_file.first_id, last - log_file.first_id):
+                stop = log_file.offsets[i + 1] if i + 1 < len(log_file.offsets) else log_file.size
+                yield view[log_file.offsets[i] + ENTRY_STRUCT.size:stop]
+            start = last
+            index += 1
+
+
+if __name__ == '__main__':
+    # Replay cost per message: decoding into MessageInfo and encoding again
+    # vs handing out the mapped wire records
+    import tempfile
+    import timeit
+    import tracemalloc
+    from datetime import datetime
+    from lib.MessageInfo import decode_records
+
+    with tempfile.TemporaryDirectory() as directory:
+        log = HistoryLog(directory, segment_bytes=64 * 1024)
+        for i in range(20000):
+            log.append(MessageInfo(f"user{i % 7}", datetime.now(), f"message number {i} " * 3))
+        log.close()
+
+        log = HistoryLog(directory, segment_bytes=64 * 1024)
+        assert len(log) == 20000 and len(log.files) > 1
+        assert [m.get_msg() for m in decode_records(b''.join(log.records(19998, 30000)))] == \
+            [f"message number {i} " * 3 for i in (19998, 19999)]
+        with open(log.files[-1].path, 'ab') as f:
+            f.write(b'\x00' * 5)      # torn write
+        log = HistoryLog(directory, segment_bytes=64 * 1024)
+        assert len(log) == 20000
+
+        # Recovery walks the mappings, it does not read the files in
+        tracemalloc.start()
+        HistoryLog(directory, segment_bytes=64 * 1024)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"recovering {len(log.files)} files of 64 KiB: {peak // 1024} KiB peak")
+        log = HistoryLog(directory, segment_bytes=64 * 1024)
+
+        # Session cursors survive a reopen, ones past the end of the log do not
+        log.save_sessions({b'a' * RESUME_TOKEN_SIZE: 19990, b'b' * RESUME_TOKEN_SIZE: 30000})
+        assert HistoryLog(directory).load_sessions() == {b'a' * RESUME_TOKEN_SIZE: 19990}
+
+        def decode():
+            for message in decode_records(b''.join(log.records(0, 20000))):
+                encode_record(message)
+
+        def mapped():
+            b''.join(log.records(0, 20000))
+
+        old = timeit.timeit(decode, number=5) / 5 / 20000 * 1e6
+        new = timeit.timeit(mapped, number=5) / 5 / 20000 * 1e6
+        print(f"replay: decode + re-encode {old:.2f} us, mapped records {new:.2f} us per message")
+        log.close()
@@ -1,7 +1,13 @@
 import datetime
+from struct import Struct
+from typing import List, Tuple
 from lib.Constant import MAX_WIDTH
 import textwrap
 
+# A message as a record inside a payload, for peers whose segment headers
+# carry no username: author length, text length, author, text (UTF-8)
+RECORD_STRUCT = Struct('!BI')
+
 class MessageInfo:
     def __init__(self, fromName: str, time: datetime, msg: str):
         self.username = fromName
@@ -35,4 +41,37 @@ class MessageInfo:
         return self.msg
     
     def get_username(self) -> str:
-        return self.username
\ No newline at end of file
+        return self.username
+
+
+def encode_record(message: MessageInfo, author: str | None = None) -> bytes:
+    # author defaults to the message's, "" leaves it to the receiver
+    author = (message.get_username() if author is None else author).encode()[:255]
+    text = message.get_msg().encode()
+    return RECORD_STRUCT.pack(len(author), len(text)) + author + text
+
+
+def decode_records(data) -> List[MessageInfo]:
+    # Every complete record in data, stamped with the time they arrived
+    messages = []
+    now = datetime.datetime.now()
+    i = 0
+    while i + RECORD_STRUCT.size <= len(data):
+        author_size, text_size = RECORD_STRUCT.unpack_from(data, i)
+        i += RECORD_STRUCT.size
+        if i + author_size + text_size > len(data):
+            break
+        author = bytes(data[i:i + author_size]).decode(errors='ignore')
+        i += author_size
+        text = bytes(data[i:i + text_size]).decode(errors='ignore')
+        i += text_size
+        messages.append(MessageInfo(author, now, text))
+    return messages
+
+
+def record_parts(record) -> Tuple[str, memoryview]:
+    # Author and text of one encoded record, the text left as raw bytes
+    record = memoryview(record)
+    author_size, text_size = RECORD_STRUCT.unpack_from(record)
+    text_start = RECORD_STRUCT.size + author_size
+    return bytes(record[RECORD_STRUCT.size:text_start]).decode(errors='ignore'), record[text_start:text_start + text_size]
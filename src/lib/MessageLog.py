@@ -0,0 +1,40 @@
+from typing import List, Tuple
+
+from lib.Constant import MESSAGE_LOG_SIZE
+from lib.MessageInfo import MessageInfo
+
+
+class MessageLog:
+    # The server's chat history, bounded. Every message gets the next id
+    # (ids never repeat or shift), only the last `capacity` are kept, in a
+    # ring indexed by id % capacity. Clients hold a cursor: the id of the
+    # next message they have not been sent.
+    def __init__(self, capacity: int = MESSAGE_LOG_SIZE, start_id: int = 0) -> None:
+        self.capacity = capacity
+        self.ring: List[MessageInfo | None] = [None] * capacity
+        self.start_id = start_id        # first id this log held (ids before it are on disk, if anywhere)
+        self.next_id = start_id         # id the next append gets
+
+    def __len__(self) -> int:
+        return self.next_id - self.first_id()
+
+    def first_id(self) -> int:
+        # Oldest id still kept
+        return max(self.start_id, self.next_id - self.capacity)
+
+    def append(self, message: MessageInfo) -> int:
+        message_id = self.next_id
+        self.ring[message_id % self.capacity] = message     # drops the oldest once full
+        self.next_id += 1
+        return message_id
+
+    def get(self, message_id: int) -> MessageInfo:
+        if not self.first_id() <= message_id < self.next_id:
+            raise KeyError(message_id)
+        return self.ring[message_id % self.capacity]
+
+    def since(self, cursor: int) -> Tuple[int, List[MessageInfo]]:
+        # Everything from `cursor` on that is still kept, and how many
+        # messages before those were dropped from under the cursor
+        start = max(cursor, self.first_id())
+        return start - cursor, [self.ring[i % self.capacity] for i in range(start, self.next_id)]
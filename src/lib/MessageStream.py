@@ -0,0 +1,129 @@
+import codecs
+from typing import List, Tuple
+
+from lib.Compression import inflater
+from lib.MessageInfo import RECORD_STRUCT
+
+
+class MessageStream:
+    # Decodes one message from the pieces its payload arrives in, in order.
+    # A full-header message is UTF-8 text by the segments' author, a compact
+    # one is records (see encode_record), each with its own. A character or
+    # record header split between pieces waits for the rest of it.
+    #
+    # A compressed payload (ZIP_FLAG) is inflated first. At most `limit`
+    # bytes come out of it, a message that inflates past that is dropped.
+    def __init__(self, author: str | None, compressed: bool = False, limit: int | None = None) -> None:
+        self.author = author                # None: the payload is records
+        self.inflater = inflater() if compressed else None
+        self.limit = limit
+        self.inflated = 0
+        self.too_big = False
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+        self.head = bytearray()             # header + author of the record under way
+        self.record_author = ""
+        self.text_left: int | None = None   # text bytes to come of the record, None = in its head
+
+    def feed(self, data, final: bool) -> List[Tuple[str, str, bool]]:
+        # (author, text, done) for what data adds to the message, done
+        # closes a record: the whole text for a full-header message
+        if self.inflater is not None:
+            data = self.__inflate(data)
+            if self.too_big:
+                return []
+        if self.author is not None:
+            text = self.decoder.decode(data, final)
+            return [(self.author, text, final)] if text or final else []
+        pieces = self.__records(memoryview(data))
+        if final:
+            # Anything left is a record cut short, decode_records drops it too
+            self.head.clear()
+            self.text_left = None
+            self.decoder.reset()
+        return pieces
+
+    def __inflate(self, data) -> bytes:
+        if self.limit is None:
+            return self.inflater.decompress(data)
+        data = self.inflater.decompress(data, self.limit - self.inflated + 1)
+        self.inflated += len(data)
+        if self.inflated > self.limit:
+            self.too_big = True
+            self.inflater = None
+        return data
+
+    def __records(self, data: memoryview) -> List[Tuple[str, str, bool]]:
+        pieces = []
+        while True:
+            if self.text_left is None:
+                if len(self.head) < RECORD_STRUCT.size:
+                    data = self.__fill(data, RECORD_STRUCT.size)
+                    if len(self.head) < RECORD_STRUCT.size:
+                        break
+                author_size, text_size = RECORD_STRUCT.unpack_from(self.head)
+                data = self.__fill(data, RECORD_STRUCT.size + author_size)
+                if len(self.head) < RECORD_STRUCT.size + author_size:
+                    break
+                self.record_author = bytes(self.head[RECORD_STRUCT.size:]).decode(errors='ignore')
+                self.text_left = text_size
+                self.head.clear()
+
+            size = min(self.text_left, len(data))
+            self.text_left -= size
+            done = self.text_left == 0
+            text = self.decoder.decode(data[:size], done)
+            data = data[size:]
+            if text or done:
+                pieces.append((self.record_author, text, done))
+            if done:
+                self.text_left = None
+                self.decoder.reset()
+            elif not data:
+                break
+        return pieces
+
+    def __fill(self, data: memoryview, size: int) -> memoryview:
+        # Head up to size bytes out of data, returns the rest
+        take = min(size - len(self.head), len(data))
+        self.head += data[:take]
+        return data[take:]
+
+
+if __name__ == '__main__':
+    from datetime import datetime
+    from lib.Compression import deflate
+    from lib.MessageInfo import MessageInfo, encode_record, decode_records
+
+    # Any split of the payload gives back the same text
+    text = "héllo wörld 👋 " * 5
+    payload = text.encode()
+    for size in (1, 2, 3, 7, len(payload)):
+        stream = MessageStream("alice")
+        chunks = [payload[i:i + size] for i in range(0, len(payload), size)]
+        pieces = []
+        for i, chunk in enumerate(chunks):
+            pieces += stream.feed(chunk, i == len(chunks) - 1)
+        assert "".join(piece for _, piece, _ in pieces) == text and pieces[-1][2]
+        assert all(author == "alice" for author, _, _ in pieces)
+
+    records = b"".join(encode_record(MessageInfo(author, datetime.now(), msg))
+                       for author, msg in (("bob", "first ✓"), ("carol", ""), ("", "third " * 40)))
+    expected = [(info.get_username(), info.get_msg()) for info in decode_records(records)]
+    for size in (1, 4, 5, 9, len(records)):
+        stream = MessageStream(None)
+        chunks = [records[i:i + size] for i in range(0, len(records), size)]
+        pieces, current = [], ""
+        for i, chunk in enumerate(chunks):
+            for author, piece, done in stream.feed(chunk, i == len(chunks) - 1):
+                current += piece
+                if done:
+                    pieces.append((author, current))
+                    current = ""
+        assert pieces == expected, (size, pieces)
+
+    # Compressed, and past the limit once inflated
+    compressed = deflate(records)
+    stream = MessageStream(None, compressed=True)
+    assert [piece for piece in stream.feed(compressed, True) if piece[2]] == [(a, t, True) for a, t in expected]
+    stream = MessageStream(None, compressed=True, limit=100)
+    assert not stream.feed(compressed, True) and stream.too_big
@@ -0,0 +1,309 @@
+from bisect import bisect_left, bisect_right, insort
+from typing import Dict, List, Tuple
+from weakref import WeakSet
+
+from lib.Constant import REASSEMBLY_LIMIT, REASSEMBLY_POOL_LIMIT
+from lib.Segment import Segment
+
+
+class ReassemblyPool:
+    # Bytes held by every ReassemblyBuffer sharing it (one per Node), kept
+    # under `limit` by taking back out-of-order data from the buffers that
+    # hold the most. The sender still has that data and sends it again.
+    def __init__(self, limit: int = REASSEMBLY_POOL_LIMIT) -> None:
+        self.limit = limit
+        self.held = 0
+        self.evicted = 0                    # bytes taken back
+        self.buffers: WeakSet[ReassemblyBuffer] = WeakSet()
+
+    def _update(self, delta: int) -> None:
+        self.held += delta
+        while self.held > self.limit:
+            victim = max(self.buffers, key=ReassemblyBuffer.out_of_order, default=None)
+            if victim is None or not victim.out_of_order():
+                break       # only in-order data left, the per-buffer limit bounds it
+            self.evicted += victim.drop_out_of_order()
+
+
+class ReassemblyBuffer:
+    # Receive side of one connection: payload bytes by position in the
+    # peer's sequence space, from the start of the message being assembled
+    # (base) on. Bytes before next_seq arrived in order, anything past it
+    # sits in sorted, merged [start, end) ranges until the gap fills. FINs
+    # mark where messages end, a message is handed out as soon as the
+    # in-order data covers its end: no per-segment objects, no sort.
+    #
+    # At most `limit` bytes are held from base on. Out-of-order data past
+    # that is dropped (the sender retransmits it). A message that outgrows
+    # it is discarded, up to its FIN, and counted in messages_dropped.
+    #
+    # Streaming, a message also goes out in pieces: whatever is in order
+    # past base as soon as the segment that ends it arrives (it names the
+    # author), so only out-of-order data is ever held and no message is too
+    # big.
+    def __init__(self, next_seq: int, limit: int = REASSEMBLY_LIMIT, pool: ReassemblyPool | None = None,
+                 streaming: bool = False) -> None:
+        self.base = next_seq
+        self.next_seq = next_seq
+        self.data = bytearray()             # data[i] is seq base + i, gaps zero-filled
+        self.starts: List[int] = []         # out-of-order ranges, all past next_seq
+        self.ends: List[int] = []
+        self.fin_ends: List[int] = []       # sorted, where buffered messages end
+        self.fins: Dict[int, Segment] = {}  # end -> the FIN segment (author, sender id)
+        self.limit = limit
+        self.pool = pool
+        self.streaming = streaming
+        self.held = 0
+        self.discarding = False             # current message outgrew the limit
+        self.duplicates = 0                 # bytes received again
+        self.dropped = 0                    # bytes past the limit
+        self.messages_dropped = 0
+        if pool is not None:
+            pool.buffers.add(self)
+
+    def out_of_order(self) -> int:
+        # Bytes held past next_seq (zero fill included)
+        return max(len(self.data) - (self.next_seq - self.base), 0)
+
+    def insert(self, seq_num: int, payload: bytes, segment: Segment) -> List[Tuple[Segment, bytearray, bool]]:
+        # Take a data segment in, returns (segment, payload, final) of every
+        # message it completes, in order, final with the FIN segment. Only
+        # streaming is there a last one that is not final: the message so far.
+        end = seq_num + len(payload)
+        if seq_num == self.next_seq and not self.starts and end - self.base <= self.limit:
+            # The usual case: next in order with nothing past it, so it goes
+            # on the end
+            self.data += payload
+            self.next_seq = end
+            if segment.get_flag().is_fin_flag():
+                self.fins[end] = segment
+                self.fin_ends.append(end)
+            elif not self.discarding and not self.streaming:
+                self.__account()
+                return []
+            completed = self.__collect(segment)
+            self.__account()
+            return completed
+
+        if end <= self.next_seq or self.__covered(seq_num, end):
+            self.duplicates += len(payload)
+            return []
+        if end - self.base > self.limit:
+            if seq_num > self.next_seq:
+                self.dropped += len(payload)
+                return []
+            if not self.streaming:
+                self.discarding = True
+        if seq_num < self.next_seq:
+            payload = payload[self.next_seq - seq_num:]
+            seq_num = self.next_seq
+
+        offset = seq_num - self.base
+        if len(self.data) < offset + len(payload):
+            self.data.extend(bytes(offset + len(payload) - len(self.data)))
+        self.data[offset:offset + len(payload)] = payload
+        if segment.get_flag().is_fin_flag() and end not in self.fins:
+            self.fins[end] = segment
+            insort(self.fin_ends, end)
+
+        if seq_num == self.next_seq:
+            self.next_seq = end
+            # The ranges this reaches (or touches) are in order now
+            i = bisect_right(self.starts, self.next_seq)
+            if i:
+                self.next_seq = max(self.next_seq, self.ends[i - 1])
+                del self.starts[:i], self.ends[:i]
+        else:
+            # Past a gap, it cannot complete anything
+            self.__add_range(seq_num, end)
+            self.__account()
+            return []
+        # Ranges it reached end somewhere it cannot name the author of
+        completed = self.__collect(segment if self.next_seq == end else None)
+        self.__account()
+        return completed
+
+    def __covered(self, start: int, end: int) -> bool:
+        i = bisect_right(self.starts, start) - 1
+        return i >= 0 and self.ends[i] >= end
+
+    def __add_range(self, start: int, end: int) -> None:
+        # Merge with every range it overlaps or touches
+        i = bisect_left(self.ends, start)
+        j = bisect_right(self.starts, end)
+        if i < j:
+            start = min(start, self.starts[i])
+            end = max(end, self.ends[j - 1])
+        self.starts[i:j] = [start]
+        self.ends[i:j] = [end]
+
+    def __collect(self, tail: Segment | None = None) -> List[Tuple[Segment, bytearray, bool]]:
+        completed = []
+        done = 0
+        while done < len(self.fin_ends) and self.fin_ends[done] <= self.next_seq:
+            end = self.fin_ends[done]
+            segment = self.fins.pop(end)
+            size = end - self.base
+            if self.discarding:
+                self.discarding = False
+                self.messages_dropped += 1
+            else:
+                completed.append((segment, self.data[:size], True))
+            del self.data[:size]
+            self.base = end
+            done += 1
+        del self.fin_ends[:done]
+        if self.discarding:
+            # Nothing of this message is kept, only where it has got to
+            del self.data[:self.next_seq - self.base]
+            self.base = self.next_seq
+        elif self.streaming and tail is not None and self.next_seq > self.base:
+            # The message so far, `tail` ends it
+            size = self.next_seq - self.base
+            completed.append((tail, self.data[:size], False))
+            del self.data[:size]
+            self.base = self.next_seq
+        return completed
+
+    def __account(self) -> None:
+        delta = len(self.data) - self.held
+        self.held = len(self.data)
+        if self.pool is not None and delta:
+            self.pool._update(delta)
+
+    def drop_out_of_order(self) -> int:
+        # Forget everything past next_seq, returns the bytes freed. It was
+        # never ACKed (only SACKed), so the sender still has it.
+        freed = self.out_of_order()
+        del self.data[self.next_seq - self.base:]
+        self.starts.clear()
+        self.ends.clear()
+        cut = bisect_right(self.fin_ends, self.next_seq)
+        for end in self.fin_ends[cut:]:
+            del self.fins[end]
+        del self.fin_ends[cut:]
+        self.held = len(self.data)
+        if self.pool is not None:
+            self.pool.held -= freed
+        return freed
+
+    def sack_blocks(self, latest_seq: int) -> List[Tuple[int, int]]:
+        # The ranges past the gap at next_seq, the one holding the latest
+        # segment first (RFC 2018)
+        blocks = list(zip(self.starts, self.ends))
+        i = bisect_right(self.starts, latest_seq) - 1
+        if i > 0 and latest_seq < self.ends[i]:
+            blocks.insert(0, blocks.pop(i))
+        return blocks
+
+    def get_stats(self) -> dict:
+        return {
+            'held': self.held,
+            'out_of_order': self.out_of_order(),
+            'duplicates': self.duplicates,
+            'dropped': self.dropped,
+            'messages_dropped': self.messages_dropped,
+        }
+
+
+if __name__ == '__main__':
+    # Reassembling one message: the old dict of whole segments, sorted and
+    # joined on FIN, vs the buffer. Time per message, and memory held while
+    # everything but the first segment is in.
+    import random
+    import timeit
+    import tracemalloc
+
+    def segment(seq_num, payload, fin=False):
+        return Segment("bench", [fin, False, True, True], seq_num, 0, payload, 0, b"")
+
+    def segments(first_seq, message, mss, fin=True):
+        return [segment(first_seq + i, message[i:i + mss], fin and i + mss >= len(message))
+                for i in range(0, len(message), mss)]
+
+    buffer = ReassemblyBuffer(100)
+    parts = segments(100, b"hello world, in pieces", 4)
+    random.shuffle(parts)
+    completed = []
+    for part in parts + parts:
+        completed += buffer.insert(part.get_seq_number(), part.get_data(), part)
+    assert [bytes(payload) for _, payload, _ in completed] == [b"hello world, in pieces"]
+    assert buffer.next_seq == 122 and buffer.held == 0 and buffer.duplicates == 22
+
+    # Out-of-order data past the limit is dropped, a message past it discarded
+    buffer = ReassemblyBuffer(0, limit=64)
+    assert not buffer.insert(70, b"x" * 8, segment(70, b"x" * 8)) and buffer.dropped == 8
+    for part in segments(0, b"y" * 100, 10) + segments(100, b"short", 10):
+        completed = buffer.insert(part.get_seq_number(), part.get_data(), part)
+    assert [bytes(payload) for _, payload, _ in completed] == [b"short"] and buffer.messages_dropped == 1
+
+    # Over the pool limit, the biggest out-of-order holder gives its data back
+    pool = ReassemblyPool(limit=100)
+    first, second = ReassemblyBuffer(0, pool=pool), ReassemblyBuffer(0, pool=pool)
+    first.insert(10, b"a" * 50, segment(10, b"a" * 50))
+    second.insert(10, b"b" * 30, segment(10, b"b" * 30))
+    assert pool.held == 100
+    second.insert(45, b"b" * 10, segment(45, b"b" * 10))
+    assert first.held == 0 and pool.evicted == 60 and pool.held == second.held == 55
+    assert first.sack_blocks(10) == [] and second.sack_blocks(45) == [(45, 55), (10, 40)]
+
+    # Streaming: in-order data goes out as the segment ending it arrives,
+    # data reached by filling a gap waits for the next one, nothing is too big
+    buffer = ReassemblyBuffer(0, limit=8, streaming=True)
+    parts = segments(0, b"abcdefghijkl", 2)
+    pieces = []
+    for part in [parts[0], parts[2], parts[1], parts[3], parts[5], parts[4]]:
+        pieces += [(bytes(payload), final) for _, payload, final in buffer.insert(part.get_seq_number(), part.get_data(), part)]
+    assert pieces == [(b"ab", False), (b"cdefgh", False), (b"ijkl", True)]
+    assert buffer.held == 0 and not buffer.messages_dropped
+
+    message = random.randbytes(64 * 1024)
+    for mss, order in ((1400, "in order"), (128, "in order"), (1400, "shuffled"), (128, "shuffled")):
+        parts = segments(1000, message, mss)
+        if order == "shuffled":
+            random.shuffle(parts)
+
+        def old():
+            buffer, recv_seq = {}, 1000
+            for part in parts:
+                buffer.setdefault(part.get_seq_number(), part)
+                while recv_seq in buffer:
+                    in_order = buffer[recv_seq]
+                    recv_seq += len(in_order.get_data())
+                    if in_order.get_flag().is_fin_flag():
+                        ordered = [buffer.pop(seq) for seq in sorted(seq for seq in buffer if seq < recv_seq)]
+                        b''.join(seg.get_data() for seg in ordered)
+
+        def new():
+            buffer = ReassemblyBuffer(1000)
+            for part in parts:
+                buffer.insert(part.get_seq_number(), part.get_data(), part)
+
+        runs = 20
+        before = timeit.timeit(old, number=runs) / runs * 1e3
+        after = timeit.timeit(new, number=runs) / runs * 1e3
+        print(f"64 KiB in {len(parts)} segments, {order}: dict + sort {before:.2f} ms, buffer {after:.2f} ms")
+
+    # As received: every datagram is wrapped, the old way keeps all of them
+    datagrams = [part.get_bytes() for part in segments(1000, message, 128)]
+
+    def keep_segments():
+        held = {}
+        for datagram in datagrams[1:]:
+            part = Segment.wrap(bytes(datagram))
+            held.setdefault(part.get_seq_number(), part).get_data()
+        return held
+
+    def keep_bytes():
+        buffer = ReassemblyBuffer(1000)
+        for datagram in datagrams[1:]:
+            part = Segment.wrap(bytes(datagram))
+            buffer.insert(part.get_seq_number(), part.get_data(), part)
+        return buffer
+
+    for name, hold in (("dict of segments", keep_segments), ("buffer", keep_bytes)):
+        tracemalloc.start()
+        held = hold()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print(f"waiting on the first of {len(datagrams)} segments: {name} holds {size // 1024} KiB")
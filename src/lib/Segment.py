@@ -1,206 +1,395 @@
-from struct import unpack, pack
+from struct import Struct
 from .Constant import *
 from .SegmentFlag import *
+from .Checksum import calculate_checksum, adjust_checksum, verify_checksum, CHECKSUM_OFFSET
+from .SegmentOption import decode_options, MAX_OPTIONS_SIZE
 
+from types import MappingProxyType
 from typing import Dict, Union
 
+# Wire layout: srcPort, dstPort, seqNumber, ackNumber, flag, checksum, username
+HEADER_STRUCT   = Struct('!HHIIBH10s')
+HEADER_SIZE     = HEADER_STRUCT.size        # 25 bytes
+USERNAME_SIZE   = 10
+# Compact header (CMP_FLAG): the username is replaced by a 16-bit sender id
+# handed out in the handshake, the peer knows the name behind it
+COMPACT_HEADER_STRUCT = Struct('!HHIIBHH')
+COMPACT_HEADER_SIZE   = COMPACT_HEADER_STRUCT.size  # 17 bytes
+FLAG_OFFSET     = 12
+CHECKSUM_STRUCT = Struct('!H')              # checksum field lives at [13:15]
+WORD32_STRUCT   = Struct('!I')
+SEQ_OFFSET      = 4
+ACK_OFFSET      = 8
+# Largest datagram a peer sends: options, then up to the MSS we offered
+MAX_SEGMENT_SIZE = HEADER_SIZE + 1 + MAX_OPTIONS_SIZE + MSS
+
+
+def header_size(data) -> int:
+    # Header length of a datagram, told by its flag byte
+    return COMPACT_HEADER_SIZE if len(data) > FLAG_OFFSET and data[FLAG_OFFSET] & CMP_FLAG else HEADER_SIZE
+
+
+def _flag_value(flag) -> int:
+    # Accept bitfield, [FIN, SYN, PSH, ACK] list or SegmentFlag
+    if isinstance(flag, int):
+        return flag
+    if isinstance(flag, SegmentFlag):
+        return flag.get_flag_value()
+    return SegmentFlag(flag).get_flag_value()
+
+
 class Segment:
-    def __init__(self, username: str, flag: list, seq_num: int = 0, ack_num: int = 0, data: bytes = b"", checksum: int = 0) -> None:
-        # Initalize segment
-        self.header: Dict[str, Union[int, SegmentFlag]] = {
-            'srcPort'  : 0,
-            'dstPort'  : 0,
-            'seqNumber': seq_num,
-            'ackNumber': ack_num,
-            'flag'     : SegmentFlag(flag),
-            'checksum' : checksum,
-            'username' : username
-        }
-        
-        self.data = data  # payload
-        self.update_checksum()
+    # A segment either wraps the datagram it was received as (_raw) and decodes
+    # fields from it on first access, or holds plain fields and encodes on demand.
+    __slots__ = (
+        '_raw',             # wire bytes, None once a field has been changed
+        '_decoded',         # header fields below are filled in
+        '_src_port',
+        '_dst_port',
+        '_seq_num',
+        '_ack_num',
+        '_flag',            # flag bitfield (int)
+        '_checksum',        # None -> recomputed on demand
+        '_username',        # decoded username, None until asked for
+        '_username_bytes',
+        '_sender_id',       # compact header only, None for a full one
+        '_options',         # encoded options (OPT_FLAG), None until asked for
+        '_data',            # payload, None until asked for
+    )
+
+    def __init__(self, username: str, flag: list, seq_num: int = 0, ack_num: int = 0, data: bytes = b"", checksum: int = 0, options: bytes = b"", sender_id: int | None = None) -> None:
+        # Initalize segment, checksum is always computed from the content.
+        # With a sender_id the segment gets the compact header and no username.
+        self._raw = None
+        self._decoded = True
+        self._src_port = 0
+        self._dst_port = 0
+        self._seq_num = seq_num
+        self._ack_num = ack_num
+        self._flag = _flag_value(flag)
+        self._checksum = None
+        self._sender_id = sender_id
+        if sender_id is None:
+            self._username = username
+            self._username_bytes = username.encode('utf-8')[:USERNAME_SIZE]
+        else:
+            self._flag |= CMP_FLAG
+            self._username = ''
+            self._username_bytes = b''
+        self._options = options
+        if options:
+            self._flag |= OPT_FLAG
+        self._data = data  # payload
 
     def __str__(self):
         # Optional, override this method for easier print(segmentA)
         output = ""
-        output += f"{'Source port':24} | {self.header['srcPort']}\n"
-        output += f"{'Destination port':24} | {self.header['dstPort']}\n"
-        output += f"{'Sequence number':24} | {self.header['seqNumber']}\n"
-        output += f"{'Acknowledgement number':24} | {self.header['ackNumber']}\n"
-        output += f"{'Checksum':24} | {self.header['checksum']}\n"
-        output += f"{'Flag':24} | {SegmentFlag(self.header['flag']).get_flag_value()}\n"
-        output += f"{'Payload':24} | {self.data}\n"
+        output += f"{'Source port':24} | {self.get_src_port()}\n"
+        output += f"{'Destination port':24} | {self.get_dst_port()}\n"
+        output += f"{'Sequence number':24} | {self.get_seq_number()}\n"
+        output += f"{'Acknowledgement number':24} | {self.get_ack_number()}\n"
+        output += f"{'Checksum':24} | {self.get_checksum()}\n"
+        output += f"{'Flag':24} | {self.get_flag_value()}\n"
+        output += f"{'Payload':24} | {self.get_data()}\n"
         return output
 
+    # -- Lazy decoding --
+    def __decode(self) -> None:
+        if self._raw[FLAG_OFFSET] & CMP_FLAG:
+            (self._src_port, self._dst_port, self._seq_num, self._ack_num,
+             self._flag, self._checksum, self._sender_id) = COMPACT_HEADER_STRUCT.unpack_from(self._raw)
+            self._username_bytes = b''
+        else:
+            (self._src_port, self._dst_port, self._seq_num, self._ack_num,
+             self._flag, self._checksum, self._username_bytes) = HEADER_STRUCT.unpack_from(self._raw)
+            self._sender_id = None
+        self._decoded = True
+
+    def __materialize(self) -> None:
+        # Pull everything out of _raw before a field changes, then drop it
+        if not self._decoded:
+            self.__decode()
+        self.get_username()
+        self.get_options_bytes()
+        self.get_data()
+        self._raw = None
+        self._checksum = None
+
     # -- Setter --
     def set_header(self, header : dict):
         # Set header from dictionary
-        self.header = header
-        self.update_checksum()
+        self.__materialize()
+        self._src_port = header.get('srcPort', self._src_port)
+        self._dst_port = header.get('dstPort', self._dst_port)
+        self._seq_num = header.get('seqNumber', self._seq_num)
+        self._ack_num = header.get('ackNumber', self._ack_num)
+        if 'flag' in header:
+            self._flag = _flag_value(header['flag'])
+        if 'username' in header:
+            self._username = header['username']
+            self._username_bytes = self._username.encode('utf-8')[:USERNAME_SIZE]
 
     def set_data(self, data: bytes):
-        if len(data) > 64:
-            raise ValueError("Payload too large. The maximum is 64 bytes.")
-        self.data = data
-        self.update_checksum()
-    
+        if len(data) > MSS:
+            raise ValueError(f"Payload too large. The maximum is {MSS} bytes.")
+        self.__materialize()
+        self._data = data
+
+    def set_options(self, options: bytes):
+        # Encoded options (see SegmentOption.encode_options), b"" for none
+        self.__materialize()
+        self._options = options
+        if options:
+            self._flag |= OPT_FLAG
+        else:
+            self._flag &= ~OPT_FLAG
+
     def set_seq_number(self, seq_number : int):
         # Set sequence number
-        self.header['seqNumber'] = seq_number
-        self.update_checksum()
-    
+        if self._raw is not None:
+            self.__restamp(SEQ_OFFSET, self.get_seq_number(), seq_number)
+        self._seq_num = seq_number
+
     def set_ack_number(self, ack_number : int):
         # Set acknowledgement number
-        self.header['ackNumber'] = ack_number
-        self.update_checksum()
+        if self._raw is not None:
+            self.__restamp(ACK_OFFSET, self.get_ack_number(), ack_number)
+        self._ack_num = ack_number
+
+    def __restamp(self, offset: int, old_value: int, new_value: int) -> None:
+        # Patch a 32-bit field in the encoded bytes and adjust the checksum
+        # incrementally instead of re-encoding the whole segment
+        checksum = adjust_checksum(self.get_checksum(), old_value, new_value)
+        raw = bytearray(self._raw)
+        WORD32_STRUCT.pack_into(raw, offset, new_value)
+        CHECKSUM_STRUCT.pack_into(raw, CHECKSUM_OFFSET, checksum)
+        self._raw = bytes(raw)
+        self._checksum = checksum
 
     def set_flag(self, flag_list : list):
         # Set flag from list of flag (SYN, ACK, FIN)
-        self.header['flag'] = SegmentFlag(flag_list)
-        self.update_checksum()
+        self.__materialize()
+        self._flag = _flag_value(flag_list)
+
+    def set_from_bytes(self, src: bytes):
+        # Re-point this segment at a received datagram
+        self._raw = src
+        self._decoded = False
+        self._checksum = None
+        self._username = None
+        self._options = None
+        self._data = None
 
 
     # ------------ Getter ------------
     def get_flag(self) -> SegmentFlag:
         # return flag in segmentflag
-        return self.header['flag']
+        if not self._decoded:
+            self.__decode()
+        return SegmentFlag.of(self._flag)
+
+    def get_flag_value(self) -> int:
+        if not self._decoded:
+            self.__decode()
+        return self._flag
 
     def get_header(self) -> dict:
         # Return header in dictionary form
-        return self.header
+        header: Dict[str, Union[int, SegmentFlag]] = {
+            'srcPort'  : self.get_src_port(),
+            'dstPort'  : self.get_dst_port(),
+            'seqNumber': self.get_seq_number(),
+            'ackNumber': self.get_ack_number(),
+            'flag'     : self.get_flag(),
+            'checksum' : self.get_checksum(),
+            'username' : self.get_username(),
+            'senderId' : self.get_sender_id()
+        }
+        return header
+
+    @property
+    def header(self) -> MappingProxyType:
+        # Snapshot kept for older callers. Read-only, so writing to it fails
+        # instead of being lost: use the setters
+        return MappingProxyType(self.get_header())
+
+    def get_src_port(self) -> int:
+        if not self._decoded:
+            self.__decode()
+        return self._src_port
+
+    def get_dst_port(self) -> int:
+        if not self._decoded:
+            self.__decode()
+        return self._dst_port
+
+    def get_seq_number(self) -> int:
+        if not self._decoded:
+            self.__decode()
+        return self._seq_num
+
+    def get_ack_number(self) -> int:
+        if not self._decoded:
+            self.__decode()
+        return self._ack_num
+
+    def get_checksum(self) -> int:
+        if self._checksum is None:
+            if self._raw is None:
+                self.get_bytes()
+            else:
+                self._checksum = CHECKSUM_STRUCT.unpack_from(self._raw, CHECKSUM_OFFSET)[0]
+        return self._checksum
 
     def get_data(self) -> bytes:
-        # Return payload in bytes
-        return self.data
-    
-    def get_username(self) -> str:
-        return self.header['username']
+        # Return payload in bytes, without the options in front of it
+        if self._data is None:
+            self._data = bytes(self._raw[self.__data_offset():])
+        return self._data
 
-    def set_from_bytes(self, src: bytes):
-        header_bytes = src[:15]
-        header_tup = unpack('!HHIIBH', header_bytes)
-        self.header = {
-            'srcPort': header_tup[0],
-            'dstPort': header_tup[1],
-            'seqNumber': header_tup[2],
-            'ackNumber': header_tup[3],
-            'flag': header_tup[4],
-            'checksum': header_tup[5],
-        }
-        self.data = src[15:]
+    def get_options_bytes(self) -> bytes:
+        if self._options is None:
+            offset = self.__data_offset()
+            size = header_size(self._raw)
+            self._options = bytes(self._raw[size + 1:offset]) if offset > size else b""
+        return self._options
+
+    def get_options(self) -> Dict[int, bytes]:
+        # {kind: value}, empty without OPT_FLAG
+        options = self.get_options_bytes()
+        return decode_options(options) if options else {}
 
-        # self.update_checksum()
+    def __data_offset(self) -> int:
+        # Where the payload starts in _raw: after the options length byte and the options
+        if not self._decoded:
+            self.__decode()
+        size = header_size(self._raw)
+        if not self._flag & OPT_FLAG or len(self._raw) <= size:
+            return size
+        return min(len(self._raw), size + 1 + self._raw[size])
+
+    def get_username(self) -> str:
+        # Empty for a compact header, the connection knows who sent it
+        if self._username is None:
+            if not self._decoded:
+                self.__decode()
+            self._username = self._username_bytes.rstrip(b'\x00').decode('utf-8', errors='ignore')
+        return self._username
+
+    def get_sender_id(self) -> int | None:
+        if not self._decoded:
+            self.__decode()
+        return self._sender_id
 
     def get_bytes(self) -> bytes:
-        # Convert this object to pure bytes
-        header_bytes = pack(
-            '!HHIIBH',
-            self.header['srcPort'],
-            self.header['dstPort'],
-            self.header['seqNumber'],
-            self.header['ackNumber'],
-            self.header['flag'].get_flag_value(), 
-            self.header['checksum']
-        )
-        username_str = self.header.get('username', '')
-        username_bytes = username_str.encode('utf-8')[:10]         # max 10 bytes
-        username_bytes = username_bytes.ljust(10, b'\x00')         # pad with nulls if shorter
-
-        return header_bytes + username_bytes + self.data
+        # Convert this object to pure bytes, received segments are returned as-is
+        if self._raw is None:
+            # OPT_FLAG and CMP_FLAG always follow what there is to encode
+            self._flag = (self._flag | OPT_FLAG) if self._options else (self._flag & ~OPT_FLAG)
+            self._flag = (self._flag & ~CMP_FLAG) if self._sender_id is None else (self._flag | CMP_FLAG)
+            if self._sender_id is None:
+                struct, tail = HEADER_STRUCT, self._username_bytes
+            else:
+                struct, tail = COMPACT_HEADER_STRUCT, self._sender_id
+            body = bytes((len(self._options),)) + self._options + self._data if self._options else self._data
+            buffer = bytearray(struct.size + len(body))
+            struct.pack_into(
+                buffer, 0,
+                self._src_port,
+                self._dst_port,
+                self._seq_num,
+                self._ack_num,
+                self._flag,
+                0,
+                tail
+            )
+            buffer[struct.size:] = body
+            if self._checksum is None:
+                self._checksum = calculate_checksum(self.__without_checksum(buffer))
+            CHECKSUM_STRUCT.pack_into(buffer, CHECKSUM_OFFSET, self._checksum)
+            self._raw = bytes(buffer)
+        return bytes(self._raw)
 
     def get_bytes_no_checksum(self) -> bytes:
-        header_bytes = pack('!HHIIB',
-            self.header['srcPort'],
-            self.header['dstPort'],
-            self.header['seqNumber'],
-            self.header['ackNumber'],
-            self.header['flag'].get_flag_value(),
-        )
-        username_str = self.header.get('username', '')
-        username_bytes = username_str.encode('utf-8')[:10]
-        username_bytes = username_bytes.ljust(10, b'\x00')  # pad with null bytes
+        return self.__without_checksum(self.get_bytes())
 
-        return header_bytes + username_bytes + self.data
+    @staticmethod
+    def __without_checksum(raw) -> bytes:
+        return b''.join((raw[:CHECKSUM_OFFSET], raw[CHECKSUM_OFFSET + 2:]))
 
 
     # -- Checksum --
     def valid_checksum(self) -> bool:
-        # Use __calculate_checksum() and check integrity of this object
-        return self.__calculate_checksum() == self.header['checksum']
-    
-    def __calculate_checksum(self) -> int:
-        # Calculate checksum here, return checksum result
-        sum = 0
-        data_bytes = self.get_bytes_no_checksum()
-
-        if (len(data_bytes) % 2 != 0):
-            data_bytes += b'\x00'
-            
-        for i in range(0, len(data_bytes), 2):
-            sum += int.from_bytes(data_bytes[i:i+2], byteorder='big')
-
-        while sum >> 0xffff:
-            sum = (sum & 0xffff) + (sum >> 16)
-
-        return ~sum & 0xffff
+        # Check the integrity of the encoded bytes
+        if self._raw is None:
+            self.get_bytes()
+        return verify_checksum(self._raw)
 
     def update_checksum(self):
-        checksum = self.__calculate_checksum()
-        checksum &= 0xffff
-        self.header['checksum'] = checksum
+        # Only a received segment can carry a stale checksum, built ones encode lazily
+        if self._raw is not None and not self.valid_checksum():
+            self.__materialize()
 
     @staticmethod
     def syn(
         username: str = '',
         seq_num:  int = 0,
-        ack_num:  int = 0
-    ): return Segment(username, [False, True, False, False], seq_num, ack_num, b"", 0)
-    
+        ack_num:  int = 0,
+        options:  bytes = b""
+    ): return Segment(username, SYN_FLAG, seq_num, ack_num, b"", 0, options)
+
     @staticmethod
     def ack(
-        username: str = '',
-        seq_num:  int = 0, 
-        ack_num:  int = 0
-    ): return Segment(username, [False, False, False, True], seq_num, ack_num, b"", 0)
-    
+        username:  str = '',
+        seq_num:   int = 0,
+        ack_num:   int = 0,
+        options:   bytes = b"",
+        sender_id: int | None = None
+    ): return Segment(username, ACK_FLAG, seq_num, ack_num, b"", 0, options, sender_id)
+
     @staticmethod
     def syn_ack(
         username: str = '',
-        seq_num:  int =  0, 
-        ack_num:  int = 0
-    ): return Segment(username, [False, True, False, True], seq_num, ack_num, b"", 0)
-  
+        seq_num:  int =  0,
+        ack_num:  int = 0,
+        options:  bytes = b""
+    ): return Segment(username, SYN_FLAG | ACK_FLAG, seq_num, ack_num, b"", 0, options)
+
     @staticmethod
     def fin(
-        username: str = '',
-        seq_num:  int =  0, 
-        ack_num:  int = 0
-    ): return Segment(username, [True, False, False, False], seq_num, ack_num, b"", 0)
-    
+        username:  str = '',
+        seq_num:   int =  0,
+        ack_num:   int = 0,
+        sender_id: int | None = None
+    ): return Segment(username, FIN_FLAG, seq_num, ack_num, b"", 0, b"", sender_id)
+
     @staticmethod
     def fin_ack(
         username: str = '',
-        seq_num:  int =  0, 
+        seq_num:  int =  0,
         ack_num:  int = 0
-    ): return Segment(username, [True, False, False, True], seq_num, ack_num, b"", 0)
-    
+    ): return Segment(username, FIN_FLAG | ACK_FLAG, seq_num, ack_num, b"", 0)
+
     @staticmethod
     def psh(
-        username: str = '',
-        seq_num:  int =  0, 
-        ack_num:  int = 0
-    ): return Segment(username, [False, False, True, False], seq_num, ack_num, b"", 0)
-    
+        username:  str = '',
+        seq_num:   int =  0,
+        ack_num:   int = 0,
+        sender_id: int | None = None
+    ): return Segment(username, PSH_FLAG, seq_num, ack_num, b"", 0, b"", sender_id)
+
+    @staticmethod
+    def wrap(data: bytes):
+        # Wrap the datagram without verifying it, fields are decoded only when read
+        if len(data) < header_size(data):
+            raise SegmentError(f"Segment too short ({len(data)} bytes)")
+        segment = Segment.__new__(Segment)
+        segment.set_from_bytes(data)
+        return segment
+
     @staticmethod
     def from_bytes(data: bytes):
-        src_port, dst_port, seq_num, ack_num, flag, checksum = unpack("!HHIIBH", data[:15])
-        username_bytes = data[15:25]
-        username = username_bytes.rstrip(b'\x00').decode('utf-8', errors='ignore')
-
-        payload = data[25:]
-        segment = Segment(username, flag, seq_num, ack_num, payload, checksum)
-        segment.header['srcPort'] = src_port
-        segment.header['dstPort'] = dst_port
+        segment = Segment.wrap(data)
         return segment, segment.valid_checksum()
 
 class SegmentError(Exception):
@@ -208,13 +397,8 @@ class SegmentError(Exception):
         super().__init__(*args)
 
 if __name__ == '__main__':
-    segment = Segment()
-    segment.header['seqNumber'] = 1
-    segment.header['ackNumber'] = 2
-    segment.header['flag'] = SegmentFlag(SYN_FLAG)
-    segment.data = b"Hello World"
-    segment.update_checksum()
-    print(segment.calculate_checksum())
+    segment = Segment('', SYN_FLAG, 1, 2, b"Hello World")
+    print(segment.get_checksum())
     if segment.valid_checksum():
         print("Checksum valid")
     else:
@@ -2,6 +2,7 @@
 from .Constant import *
 
 class SegmentFlag:
+    __slots__ = ('fin', 'syn', 'psh', 'ack', 'opt', 'cmp', 'zip')
     
     def __init__(self, flag: list) -> None:
         if isinstance(flag, int):
@@ -10,11 +11,17 @@ class SegmentFlag:
             self.syn = bool(flag & SYN_FLAG)
             self.psh = bool(flag & PSH_FLAG)
             self.ack = bool(flag & ACK_FLAG)
+            self.opt = bool(flag & OPT_FLAG)
+            self.cmp = bool(flag & CMP_FLAG)
+            self.zip = bool(flag & ZIP_FLAG)
         elif isinstance(flag, list):
             self.fin = bool(flag[0])
             self.syn = bool(flag[1])
             self.psh = bool(flag[2])
             self.ack = bool(flag[3])
+            self.opt = len(flag) > 4 and bool(flag[4])
+            self.cmp = len(flag) > 5 and bool(flag[5])
+            self.zip = len(flag) > 6 and bool(flag[6])
 
     def __str__(self):
         return f"SYN={self.syn}, ACK={self.ack}, FIN={self.fin}"
@@ -26,6 +33,9 @@ class SegmentFlag:
         flag |= (SYN_FLAG if self.syn else DEFAULT_FLAG)
         flag |= (PSH_FLAG if self.psh else DEFAULT_FLAG)
         flag |= (ACK_FLAG if self.ack else DEFAULT_FLAG)
+        flag |= (OPT_FLAG if self.opt else DEFAULT_FLAG)
+        flag |= (CMP_FLAG if self.cmp else DEFAULT_FLAG)
+        flag |= (ZIP_FLAG if self.zip else DEFAULT_FLAG)
         return flag
     
     def is_default_flag(self) -> bool:
@@ -39,6 +49,15 @@ class SegmentFlag:
     
     def is_ack_flag(self) -> bool:
         return self.ack
+
+    def is_opt_flag(self) -> bool:
+        return self.opt
+
+    def is_cmp_flag(self) -> bool:
+        return self.cmp
+
+    def is_zip_flag(self) -> bool:
+        return self.zip
     
     def is_fin_flag(self) -> bool:
         return self.fin
@@ -52,6 +71,15 @@ class SegmentFlag:
     def is_syn_fin_flag(self) -> bool:
         return self.syn and self.fin
 
+    @staticmethod
+    def of(flag: int) -> 'SegmentFlag':
+        # Shared, read-only instance for a flag byte (no allocation per segment)
+        return _FLAG_TABLE[flag & 0xff]
+
+
+# One SegmentFlag per possible flag byte, handed out by SegmentFlag.of()
+_FLAG_TABLE = tuple(SegmentFlag(value) for value in range(256))
+
 if __name__ == "__main__":
     seg = SegmentFlag(0x02)
     print(seg.get_flag_value())
@@ -0,0 +1,84 @@
+from struct import Struct
+from typing import Dict, Iterable, List, Tuple
+
+# Options ride at the front of the payload when OPT_FLAG is set:
+#   optionsLength (1 byte), then kind (1), length (1), value ... per option
+# The length of an option counts its own kind and length bytes, like TCP.
+OPTION_MSS       = 2            # largest payload the sender takes, 16 bits (SYN only)
+OPTION_SACK      = 5            # SACK blocks: (left, right) pairs of 32-bit seqs
+OPTION_SENDER_ID = 32           # compact headers: empty in the SYN (an offer), the
+                                # id the client puts on its segments in the SYN-ACK
+OPTION_RESUME    = 33           # session resumption: empty in the SYN (asks for a token),
+                                # else a token and the seq its sender resumes from
+OPTION_COMPRESS  = 34           # payload compression: id of the preset dictionary, offered
+                                # in the SYN, accepted in the SYN-ACK, echoed in the final ACK
+MAX_OPTIONS_SIZE = 40
+MAX_SACK_BLOCKS  = 4
+SACK_BLOCK_STRUCT = Struct('!II')
+WORD16_STRUCT     = Struct('!H')
+RESUME_TOKEN_SIZE = 16
+RESUME_STRUCT     = Struct(f'!{RESUME_TOKEN_SIZE}sI')   # token, seq
+
+
+def encode_options(options: Dict[int, bytes]) -> bytes:
+    encoded = b''.join(bytes((kind, 2 + len(value))) + value for kind, value in options.items())
+    if len(encoded) > MAX_OPTIONS_SIZE:
+        raise ValueError(f"Options too large ({len(encoded)} bytes). The maximum is {MAX_OPTIONS_SIZE} bytes.")
+    return encoded
+
+
+def decode_options(data) -> Dict[int, bytes]:
+    # Unknown kinds are kept, a truncated option ends the list
+    options = {}
+    i = 0
+    while i + 2 <= len(data):
+        kind, length = data[i], data[i + 1]
+        if length < 2 or i + length > len(data):
+            break
+        options[kind] = bytes(data[i + 2:i + length])
+        i += length
+    return options
+
+
+def encode_mss(mss: int) -> bytes:
+    return WORD16_STRUCT.pack(mss)
+
+
+def decode_mss(value: bytes) -> int | None:
+    # None for a malformed option
+    return WORD16_STRUCT.unpack(value)[0] if len(value) == WORD16_STRUCT.size else None
+
+
+def encode_sender_id(sender_id: int) -> bytes:
+    return WORD16_STRUCT.pack(sender_id)
+
+
+def decode_sender_id(value: bytes) -> int | None:
+    # None for the offer (empty) or a malformed option
+    return WORD16_STRUCT.unpack(value)[0] if len(value) == WORD16_STRUCT.size else None
+
+
+def encode_sack(blocks: Iterable[Tuple[int, int]]) -> bytes:
+    return b''.join(SACK_BLOCK_STRUCT.pack(left, right) for left, right in list(blocks)[:MAX_SACK_BLOCKS])
+
+
+def decode_sack(value: bytes) -> List[Tuple[int, int]]:
+    return [block for block in SACK_BLOCK_STRUCT.iter_unpack(value[:len(value) - len(value) % SACK_BLOCK_STRUCT.size])]
+
+
+def encode_compress(dictionary_id: int) -> bytes:
+    return bytes((dictionary_id,))
+
+
+def decode_compress(value: bytes) -> int | None:
+    # None for a malformed option
+    return value[0] if len(value) == 1 else None
+
+
+def encode_resume(token: bytes, seq_num: int) -> bytes:
+    return RESUME_STRUCT.pack(token, seq_num)
+
+
+def decode_resume(value: bytes) -> Tuple[bytes, int] | None:
+    # (token, seq), None for the request (empty) or a malformed option
+    return RESUME_STRUCT.unpack(value) if len(value) == RESUME_STRUCT.size else None
@@ -0,0 +1,240 @@
+import zlib
+from collections import deque
+from multiprocessing import shared_memory
+from struct import Struct
+from typing import Callable, List, Tuple
+
+from lib.Constant import ROOM_RING_BYTES
+
+# Ring header: position and seq of the oldest entry still intact (the writer
+# moves it before overwriting), then of the next entry. Positions count bytes
+# written since the start and never wrap, offset = position % capacity.
+HEADER_STRUCT = Struct('QQQQ')
+HEADER_SIZE = 64
+# Each entry: seq + 1 (0 is never written), record length, CRC-32 of both
+# and the record, then the record padded to 8 bytes. The seq is stored last.
+SLOT_STRUCT = Struct('QII')
+SEQ_STRUCT = Struct('Q')
+CHECKED_STRUCT = Struct('QI')       # what the CRC covers ahead of the record
+LENGTH_CHECK_STRUCT = Struct('II')
+WRAP = 0xffffffff       # length of the filler entry that sends readers back to offset 0
+
+
+class SharedRing:
+    # Single-writer, multi-reader ring of encoded message records in shared
+    # memory. The owning worker appends, every other worker reads from its
+    # own cursor, straight out of the mapping. Readers never block the
+    # writer: one that falls a whole ring behind finds out and skips ahead.
+    #
+    # No locks, and no reliance on the CPU keeping stores in order (x86-64
+    # does, ARM does not): a reader checks the entry's CRC, which covers the
+    # seq, in place. Seeing the seq before the rest of the entry, or reading
+    # it while the writer laps it, shows up as a bad CRC: the entry is read
+    # again, or skipped once the tail has moved past it.
+    def __init__(self, name: str | None = None, size: int = ROOM_RING_BYTES, create: bool = False) -> None:
+        if create:
+            self.memory = shared_memory.SharedMemory(name, create=True, size=HEADER_SIZE + size)
+        else:
+            # Attached by a worker, the process that created it unlinks it
+            self.memory = shared_memory.SharedMemory(name, track=False)
+        self.name = self.memory.name
+        self.buffer = self.memory.buf
+        self.capacity = (self.memory.size - HEADER_SIZE) & ~7
+        self.position, self.seq = 0, 0     # writer side
+        self.entries = deque()              # (position, seq) of every entry in the ring
+        self.tail = (0, 0)
+
+    def append(self, record: bytes) -> int:
+        # Returns the record's seq
+        size = SLOT_STRUCT.size + (len(record) + 7 & ~7)
+        if size > self.capacity // 2:
+            raise ValueError(f"record of {len(record)} bytes does not fit the ring")
+        offset = self.position % self.capacity
+        if offset + size > self.capacity:
+            # Not enough room before the end: a filler entry, then from the start
+            if self.capacity - offset >= SLOT_STRUCT.size:
+                self.__reserve(self.capacity - offset)
+                self.__slot(HEADER_SIZE + offset, WRAP)
+            self.position += self.capacity - offset
+            offset = 0
+        self.__reserve(size)
+        start = HEADER_SIZE + offset
+        self.buffer[start + SLOT_STRUCT.size:start + SLOT_STRUCT.size + len(record)] = record
+        self.__slot(start, len(record), record)
+        self.entries.append((self.position, self.seq))
+        self.position += size
+        self.seq += 1
+        HEADER_STRUCT.pack_into(self.buffer, 0, *self.tail, self.position, self.seq)
+        return self.seq - 1
+
+    def __slot(self, start: int, length: int, record: bytes = b"") -> None:
+        check = zlib.crc32(record, zlib.crc32(CHECKED_STRUCT.pack(self.seq + 1, length)))
+        LENGTH_CHECK_STRUCT.pack_into(self.buffer, start + SEQ_STRUCT.size, length, check)
+        SEQ_STRUCT.pack_into(self.buffer, start, self.seq + 1)
+
+    def __reserve(self, size: int) -> None:
+        # Entries about to be overwritten leave the ring first, a reader
+        # still on one sees the tail move past it
+        low = self.position + size - self.capacity
+        while self.entries and self.entries[0][0] < low:
+            self.entries.popleft()
+        self.tail = self.entries[0] if self.entries else (self.position, self.seq)
+        HEADER_STRUCT.pack_into(self.buffer, 0, *self.tail, self.position, self.seq)
+
+    def close(self) -> None:
+        self.buffer.release()
+        self.memory.close()
+
+    def unlink(self) -> None:
+        self.memory.unlink()
+
+
+class RingReader:
+    # One reader's cursor into a SharedRing
+    def __init__(self, ring: SharedRing) -> None:
+        self.ring = ring
+        self.position, self.seq = 0, 0
+
+    def read(self, decode: Callable) -> Tuple[int, List]:
+        # decode() every record written since the last call, it gets a
+        # memoryview into the ring and has to copy what it keeps. Returns
+        # (missed, decoded): missed counts records the writer overwrote
+        # before they were read.
+        buffer, capacity = self.ring.buffer, self.ring.capacity
+        decoded = []
+        missed = 0
+        while True:
+            offset = self.position % capacity
+            if capacity - offset < SLOT_STRUCT.size:
+                self.position += capacity - offset
+                continue
+            start = HEADER_SIZE + offset
+            seq, length, check = SLOT_STRUCT.unpack_from(buffer, start)
+            if seq - 1 != self.seq:
+                if seq - 1 < self.seq or not self.__lapped():
+                    break           # nothing new yet
+                missed += self.__skip()
+                continue
+            record = buffer[start + SLOT_STRUCT.size:start + SLOT_STRUCT.size + (0 if length == WRAP else length)]
+            if zlib.crc32(record, zlib.crc32(CHECKED_STRUCT.pack(seq, length))) != check:
+                # Not all of it visible yet (the writer stored it all before
+                # the seq, so read it again), or overwritten under us
+                if self.__lapped():
+                    missed += self.__skip()
+                continue
+            if length == WRAP:
+                self.position += capacity - offset
+                continue
+            item = decode(record)
+            if self.__lapped():
+                # Overwritten while decoding, whatever it read is garbage
+                missed += self.__skip()
+                continue
+            decoded.append(item)
+            self.position += SLOT_STRUCT.size + (length + 7 & ~7)
+            self.seq += 1
+        return missed, decoded
+
+    def __lapped(self) -> bool:
+        tail = HEADER_STRUCT.unpack_from(self.ring.buffer)[0]
+        return tail > self.position
+
+    def __skip(self) -> int:
+        # Carry on from the oldest entry left
+        while True:
+            header = HEADER_STRUCT.unpack_from(self.ring.buffer)
+            if header == HEADER_STRUCT.unpack_from(self.ring.buffer):
+                break
+        position, seq, _, _ = header
+        missed = seq - self.seq
+        self.position, self.seq = position, seq
+        return missed
+
+
+if __name__ == '__main__':
+    # Room fan-out, messages per second from one worker to the others:
+    # every record sent to each peer over a unix socket (the room bus as it
+    # was) vs written once into the ring and read by each peer in place
+    import multiprocessing
+    import os
+    import socket
+    import time
+    from datetime import datetime
+    from lib.MessageInfo import MessageInfo, encode_record, decode_records
+
+    ring = SharedRing(size=4096, create=True)
+    reader = RingReader(SharedRing(ring.name))
+    for i in range(100):
+        ring.append(f"record {i}".encode())
+    missed, records = reader.read(bytes)
+    assert missed == 0 and records == [f"record {i}".encode() for i in range(100)]
+    for i in range(1000):
+        ring.append(f"record {i}".encode())
+    missed, records = reader.read(bytes)
+    assert missed > 0 and missed + len(records) == 1000 and records[-1] == b"record 999"
+    reader.ring.close()
+    ring.close()
+    ring.unlink()
+
+    count = 100000
+    records = [encode_record(MessageInfo(f"user{i % 7}", datetime.now(), f"message number {i} " * 3))
+               for i in range(count)]
+
+    def read_ring(name, done):
+        reader = RingReader(SharedRing(name))
+        got = 0
+        while got < count:
+            missed, messages = reader.read(decode_records)
+            got += missed + len(messages)
+            assert not missed
+            if not messages:
+                time.sleep(0.0005)      # the doorbell's job in the server
+        done.put(got)
+
+    def read_socket(address, done):
+        receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        receiver.bind(address)
+        done.put(0)
+        for _ in range(count):
+            decode_records(receiver.recv(65536))
+        done.put(count)
+
+    def fan_out(readers, use_ring):
+        done = multiprocessing.Queue()
+        if use_ring:
+            ring = SharedRing(size=64 * 1024 * 1024, create=True)
+            targets = [(read_ring, (ring.name, done))] * readers
+        else:
+            addresses = [f"\0ring-bench-{os.getpid()}-{i}" for i in range(readers)]
+            targets = [(read_socket, (address, done)) for address in addresses]
+        processes = [multiprocessing.Process(target=target, args=args) for target, args in targets]
+        for process in processes:
+            process.start()
+        start = time.perf_counter()
+        if use_ring:
+            for record in records:
+                ring.append(record)
+        else:
+            for _ in processes:
+                done.get()      # bound
+            start = time.perf_counter()
+            sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            for record in records:
+                for address in addresses:
+                    sender.sendto(record, address)
+        for _ in processes:
+            done.get()
+        elapsed = time.perf_counter() - start
+        for process in processes:
+            process.join()
+        if use_ring:
+            ring.close()
+            ring.unlink()
+        return count / elapsed
+
+    print(f"{os.cpu_count()} cpus, {count} messages of {len(records[0])} bytes")
+    for readers in (1, 2, 4, 8):
+        old = fan_out(readers, False)
+        new = fan_out(readers, True)
+        print(f"{readers} workers: socket {old:9.0f}, ring {new:9.0f} messages/s")
@@ -0,0 +1,52 @@
+import hashlib
+import secrets
+import time
+from struct import Struct
+from typing import Tuple
+
+from lib.Constant import PAYLOAD_SIZE
+
+# A SYN cookie is the server's ISN, nothing about the handshake is stored:
+#   0 (1 bit) | time counter (5 bits) | MSS index (3 bits) | MAC (23 bits)
+# The top bit stays clear, sequence numbers here never wrap around 2^32.
+# The final ACK acknowledges ISN + 1 and echoes the sender id it was given,
+# that is all it takes to check the MAC and set the connection up.
+COOKIE_MSS    = (PAYLOAD_SIZE, 128, 256, 536, 1024, 1200, 1360, 1400)  # MSS the 3 bits can say
+COOKIE_PERIOD = 64          # seconds per tick of the time counter, a cookie lives 1-2 ticks
+COOKIE_STRUCT = Struct('!HIIiB')    # what the MAC covers: port, client seq, time counter, sender id (-1 = none), MSS index; then the ip
+
+
+class SynCookies:
+    def __init__(self, secret: bytes | None = None) -> None:
+        self.secret = secret or secrets.token_bytes(16)
+
+    @staticmethod
+    def mss_index(mss: int) -> int:
+        # Largest MSS the cookie can carry that is no more than mss
+        return max(i for i, size in enumerate(COOKIE_MSS) if size <= max(mss, PAYLOAD_SIZE))
+
+    def __mac(self, key: Tuple[str, int], client_seq: int, counter: int, mss_index: int, sender_id: int | None) -> int:
+        message = COOKIE_STRUCT.pack(key[1], client_seq, counter, -1 if sender_id is None else sender_id, mss_index)
+        return int.from_bytes(hashlib.blake2b(message + key[0].encode(), key=self.secret, digest_size=3).digest()) >> 1
+
+    def make(self, key: Tuple[str, int], client_seq: int, mss: int, sender_id: int | None, now: float | None = None) -> Tuple[int, int]:
+        # (ISN, MSS it stands for)
+        counter = int((time.time() if now is None else now) / COOKIE_PERIOD)
+        index = self.mss_index(mss)
+        isn = (counter % 32) << 26 | index << 23 | self.__mac(key, client_seq, counter, index, sender_id)
+        return isn, COOKIE_MSS[index]
+
+    def check(self, key: Tuple[str, int], client_seq: int, isn: int, sender_id: int | None, now: float | None = None) -> int | None:
+        # The MSS of a cookie we made for this peer in the last two ticks, else None
+        counter = int((time.time() if now is None else now) / COOKIE_PERIOD)
+        index = isn >> 23 & 0x7
+        for age in (0, 1):
+            if (counter - age) % 32 == isn >> 26 and \
+                    self.__mac(key, client_seq, counter - age, index, sender_id) == isn & 0x7fffff:
+                return COOKIE_MSS[index]
+        return None
+
+    def token(self, key: Tuple[str, int], client_seq: int, isn: int, size: int) -> bytes:
+        # Session resumption token, derived so it needs no storing either
+        message = COOKIE_STRUCT.pack(key[1], client_seq, isn, -1, 0) + key[0].encode()
+        return hashlib.blake2b(message, key=self.secret, digest_size=size, person=b'resume').digest()
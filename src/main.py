@@ -1,5 +1,5 @@
 from chat_gui import ChatGUI
-from Client import Client
+from Client import Client, AsyncClient
 import argparse
 
 def load_args():
@@ -9,14 +9,16 @@ def load_args():
     arg.add_argument('-si', '--server_ip', type=str, required=True, help='ip to listen on')
     arg.add_argument('-sp', '--server_port', type=int, required=True, help='port to listen on')
     arg.add_argument('-un', '--username', type=str, default='User', help='username of the client')
+    arg.add_argument('-a', '--asyncio', action='store_true', help='run on the asyncio engine')
     return arg.parse_args()
 
 if __name__ == '__main__':
     args = load_args()
-    client = Client(username=args.username,
-                    client_ip=args.client_ip,
-                    client_port=None,
-                    server_ip=args.server_ip,
-                    server_port=args.server_port)
+    client_class = AsyncClient if args.asyncio else Client
+    client = client_class(username=args.username,
+                          client_ip=args.client_ip,
+                          client_port=None,
+                          server_ip=args.server_ip,
+                          server_port=args.server_port)
     gui = ChatGUI(client)
     gui.run()